@@ -0,0 +1,390 @@
+# filename: benchmark.py
+#
+# Times every analysis stage of the 15-minute refresh on fixed fixture data, so a change can be
+# checked for speed-ups or slowdowns before it ships. Candle stages run on the mastercache
+# parquets in warmup_ohlc_data_fixed/ (read-only); the options stages on a seeded synthetic
+# chain. Each stage runs in its own worker process, so its peak RSS is not mixed with others.
+#
+#   python benchmark.py                    run all stages, append to the history, compare to baseline
+#   python benchmark.py --save-baseline    also store this run as the new baseline
+#   python benchmark.py --stages add_indicators find_clusters_dbscan --repeat 10
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tracemalloc
+import importlib.util
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Callable, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import resource  # Not available on Windows; peak RSS is then left out
+except ImportError:
+    resource = None
+
+# --- Configuration ---
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_DIR = "warmup_ohlc_data_fixed"
+HISTORY_FILE = "benchmark_history.json"
+BASELINE_FILE = "benchmark_baseline.json"
+DEFAULT_REPEAT = 5
+MAX_HISTORY_RUNS = 500
+# A stage regresses when its median wall time or allocation peak grows past this share...
+REGRESSION_THRESHOLD = 0.15
+# ...and by more than this much in absolute terms (timer noise on sub-millisecond stages)
+MIN_TIME_DELTA_MS = 0.5
+MIN_ALLOC_DELTA_MB = 0.5
+
+FIXTURE_SYMBOL = 'BTCUSDT'
+# The mastercaches keep growing as the refresh runs, so each fixture is pinned to the candles
+# up to FIXTURE_END: the same rows on every run, whatever was appended since.
+FIXTURE_END = pd.Timestamp('2025-12-18 00:00', tz='UTC')
+FIXTURE_ROWS = {'15m': 19000, '30m': 19000, '1h': 19000, '2h': 18000, '4h': 9000}
+SIGNAL_CANDLES = 999  # get_historical_data(symbol, tf, 1000) keeps the 999 newest closed candles
+SR_LOOKBACK_DAYS = 270
+PROFILE_LOOKBACK_DAYS = 1095
+
+# Synthetic option chain: expiries must fall before the analyzer's END_DATE filter
+OPTIONS_AS_OF = datetime(2025, 6, 1, 8, tzinfo=timezone.utc)
+OPTIONS_SPOT = 100000.0
+OPTIONS_EXPIRIES = ['06JUN25', '13JUN25', '20JUN25', '27JUN25', '25JUL25', '29AUG25', '26SEP25', '26DEC25']
+OPTIONS_STRIKE_STEP = 1000.0
+OPTIONS_STRIKE_RANGE = 0.5
+OPTIONS_SEED = 7
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s',
+                    datefmt='%Y-%m-%d %H:%M:%S')
+
+Stage = Tuple[Callable[[], Any], int]  # (timed callable, rows it processes)
+
+
+# --- Fixtures ---
+def _load_script(module_name: str, filename: str):
+    """Imports one of the analysis scripts by path (some file names are not valid module names)."""
+    spec = importlib.util.spec_from_file_location(module_name, os.path.join(REPO_DIR, filename))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def load_fixture(interval: str, symbol: str = FIXTURE_SYMBOL, fixture_dir: str = FIXTURE_DIR) -> pd.DataFrame:
+    """The FIXTURE_ROWS[interval] candles up to FIXTURE_END from a mastercache file, as the lowercase
+    OHLCV frame KlineStore serves, indexed by UTC open time."""
+    path = os.path.join(REPO_DIR, fixture_dir, f"{symbol}_{interval}_mastercache.parquet")
+    df = pd.read_parquet(path)
+    if df.index.tz is None:
+        df.index = df.index.tz_localize('UTC')
+    rows = FIXTURE_ROWS[interval]
+    df = df.sort_index().loc[:FIXTURE_END].tail(rows).copy()
+    if len(df) != rows or df.index[-1] != FIXTURE_END:
+        raise ValueError(f"{path} no longer holds {rows} candles ending {FIXTURE_END}; "
+                         f"got {len(df)} ending {df.index[-1] if len(df) else None}")
+    # Candles cached before quote volume was stored have it missing or NaN; base volume at the
+    # close is a close enough stand-in
+    stand_in = df['volume'] * df['close']
+    df['quote_volume'] = df['quote_volume'].fillna(stand_in) if 'quote_volume' in df else stand_in
+    return df
+
+
+def capitalized(df: pd.DataFrame) -> pd.DataFrame:
+    return df[['open', 'high', 'low', 'close', 'volume']].rename(columns=str.capitalize)
+
+
+def synthetic_option_tickers() -> List[Dict[str, Any]]:
+    """A seeded option chain in the shape of `_get_chain_snapshot` output, with greeks attached."""
+    from black76 import black76_greeks
+    rng = np.random.default_rng(OPTIONS_SEED)
+    strikes = np.arange(OPTIONS_SPOT * (1 - OPTIONS_STRIKE_RANGE), OPTIONS_SPOT * (1 + OPTIONS_STRIKE_RANGE) + 1,
+                        OPTIONS_STRIKE_STEP)
+    tickers = []
+    for expiry in OPTIONS_EXPIRIES:
+        expiry_dt = datetime.strptime(expiry, "%d%b%y").replace(hour=8, tzinfo=timezone.utc)
+        years = (expiry_dt - OPTIONS_AS_OF).total_seconds() / (365.0 * 86400)
+        forward = OPTIONS_SPOT * (1 + 0.05 * years)
+        for is_call in (True, False):
+            iv = 0.5 + 0.3 * ((strikes / forward) - 1) ** 2 + rng.normal(0, 0.01, len(strikes))
+            oi = np.round(rng.gamma(1.5, 200.0, len(strikes)) * np.exp(-4 * np.abs(strikes / OPTIONS_SPOT - 1)), 1)
+            greeks = black76_greeks(forward, strikes, years, iv, is_call)
+            for i, strike in enumerate(strikes):
+                tickers.append({
+                    'instrument_name': f"BTC-{expiry}-{int(strike)}-{'C' if is_call else 'P'}",
+                    'open_interest': float(oi[i]), 'mark_iv': float(iv[i] * 100), 'underlying_price': forward,
+                    'interest_rate': 0.0, 'stats': {'volume': float(oi[i] * 0.1)},
+                    'greeks': {key: float(greeks[key][i]) for key in greeks},
+                })
+    return tickers
+
+
+def _options_analyzer():
+    options = _load_script('option_open_interest', 'option-open-interest-json.py')
+    analyzer = options.DeribitMarketAnalyzer('BTC', os.devnull, os.devnull)
+    analyzer.all_tickers = synthetic_option_tickers()
+    analyzer.spot_price, analyzer.as_of = OPTIONS_SPOT, OPTIONS_AS_OF
+    return options, analyzer
+
+
+# --- Stages (each returns the timed callable; setup is not timed) ---
+def stage_parse_klines() -> Stage:
+    from kline_store import parse_klines
+    df = load_fixture('15m')
+    open_ms = df.index.as_unit('ms').asi8
+    step = int(pd.Timedelta('15m') / pd.Timedelta('1ms'))
+    # Raw Binance rows: prices and volumes arrive as strings
+    klines = [[int(t), f"{o:.2f}", f"{h:.2f}", f"{l:.2f}", f"{c:.2f}", f"{v:.5f}", int(t) + step - 1, f"{q:.4f}",
+               1000, "0", "0", "0"]
+              for t, o, h, l, c, v, q in zip(open_ms, df['open'], df['high'], df['low'], df['close'],
+                                             df['volume'], df['quote_volume'])]
+    return (lambda: parse_klines(klines)), len(klines)
+
+
+def stage_add_indicators() -> Stage:
+    ma = _load_script('generate_accurate_ma', 'generate_accurate_ma.py')
+    df = load_fixture('1h')
+    return (lambda: ma.add_indicators(df, ma.MA_PERIODS)), len(df)
+
+
+def stage_find_latest_combined_signal() -> Stage:
+    signals = _load_script('s_signal_analysis', 's_signal_analysis.py')
+    df = load_fixture('1h')[['open', 'high', 'low', 'close', 'volume']].iloc[-SIGNAL_CANDLES - 1:-1]
+    return (lambda: signals.find_latest_combined_signal(df)), len(df)
+
+
+def stage_calculate_volume_profile() -> Stage:
+    profile = _load_script('volume_profile', 'volume-profile.py')
+    df = load_fixture(profile.TIMEFRAME_FOR_PROFILE)
+    df = df[df.index > FIXTURE_END - pd.Timedelta(days=PROFILE_LOOKBACK_DAYS)]
+    df = df.drop(columns='volume').rename(columns={'quote_volume': 'Volume'}).rename(columns=str.capitalize)
+    price_bins = profile.create_price_grid(FIXTURE_SYMBOL, df)
+    return (lambda: profile.calculate_volume_profile(df, price_bins)), len(df)
+
+
+def _sr_inputs(sr) -> Tuple[Dict[str, pd.DataFrame], float]:
+    frames = {}
+    for tf in sr.TIMEFRAMES_TO_ANALYZE:
+        df = capitalized(load_fixture(tf))
+        frames[tf] = df[df.index > FIXTURE_END - pd.Timedelta(days=SR_LOOKBACK_DAYS)]
+    atr_df = frames[sr.ATR_TIMEFRAME]
+    atr_percent = float(sr.calc_atr(atr_df).iloc[-1] / atr_df['Close'].iloc[-1])
+    return frames, atr_percent
+
+
+def stage_generate_pivots_for_timeframe() -> Stage:
+    sr = _load_script('sr_levels_analysis', 'sr_levels_analysis.py')
+    frames, atr_percent = _sr_inputs(sr)
+
+    def run():
+        for tf, df in frames.items():
+            sr.generate_pivots_for_timeframe(FIXTURE_SYMBOL, tf, SR_LOOKBACK_DAYS, atr_percent, df=df)
+    return run, sum(map(len, frames.values()))
+
+
+def stage_find_clusters_dbscan() -> Stage:
+    sr = _load_script('sr_levels_analysis', 'sr_levels_analysis.py')
+    frames, atr_percent = _sr_inputs(sr)
+    pivots = pd.concat([sr.generate_pivots_for_timeframe(FIXTURE_SYMBOL, tf, SR_LOOKBACK_DAYS, atr_percent, df=df)
+                        for tf, df in frames.items()], ignore_index=True)
+    support, resistance = pivots[pivots['Type'] == 'Support'], pivots[pivots['Type'] == 'Resistance']
+
+    def run():
+        sr.find_clusters_dbscan(support, FIXTURE_SYMBOL, atr_percent)
+        sr.find_clusters_dbscan(resistance, FIXTURE_SYMBOL, atr_percent)
+    return run, len(pivots)
+
+
+def stage_aggregate_market_data() -> Stage:
+    options, analyzer = _options_analyzer()
+
+    def run():
+        # Every refresh is a fresh process, so instrument names are parsed cold
+        options.DeribitMarketAnalyzer._parse_instrument.cache_clear()
+        return analyzer._aggregate_market_data()
+    return run, len(analyzer.all_tickers)
+
+
+def stage_calculate_max_pain() -> Stage:
+    options, analyzer = _options_analyzer()
+    chain = analyzer._aggregate_market_data()
+    by_strike = chain.groupby(['expiry', 'strike'])[['call_oi', 'put_oi', 'gamma']].sum()
+    per_expiry = [by_strike.loc[expiry] for expiry in by_strike.index.unique('expiry')]
+
+    def run():
+        for strikes in per_expiry:
+            options.DeribitMarketAnalyzer._calculate_max_pain(strikes)
+    return run, len(by_strike)
+
+
+STAGES: Dict[str, Callable[[], Stage]] = {
+    'parse_klines': stage_parse_klines,
+    'add_indicators': stage_add_indicators,
+    'find_latest_combined_signal': stage_find_latest_combined_signal,
+    'calculate_volume_profile': stage_calculate_volume_profile,
+    'generate_pivots_for_timeframe': stage_generate_pivots_for_timeframe,
+    'find_clusters_dbscan': stage_find_clusters_dbscan,
+    '_aggregate_market_data': stage_aggregate_market_data,
+    '_calculate_max_pain': stage_calculate_max_pain,
+}
+
+
+# --- Measurement ---
+def _peak_rss_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, KiB elsewhere
+
+
+def measure_stage(name: str, repeat: int = DEFAULT_REPEAT) -> Dict[str, Any]:
+    """
+    Sets the stage up, runs it once to warm up, then `repeat` timed runs and one run under
+    tracemalloc for the allocation peak. `stage_rss_mb` is how far the stage pushed the
+    process's peak RSS past what setup had already reached.
+    """
+    logging.getLogger().setLevel(logging.WARNING)  # The stages log per call
+    run, rows = STAGES[name]()
+    setup_rss = _peak_rss_mb()
+    run()
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        timings.append((time.perf_counter() - start) * 1000)
+    peak_rss = _peak_rss_mb()
+    tracemalloc.start()
+    run()
+    _, alloc_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'rows': rows,
+        'repeat': repeat,
+        'wall_ms_median': round(statistics.median(timings), 3),
+        'wall_ms_min': round(min(timings), 3),
+        'peak_rss_mb': round(peak_rss, 1) if peak_rss is not None else None,
+        'stage_rss_mb': round(peak_rss - setup_rss, 1) if peak_rss is not None else None,
+        'alloc_peak_mb': round(alloc_peak / 1024 ** 2, 3),
+    }
+
+
+def run_benchmarks(stage_names: List[str], repeat: int, isolate: bool = True) -> Dict[str, Dict[str, Any]]:
+    results = {}
+    for name in stage_names:
+        if isolate:
+            # A fresh spawned worker per stage keeps imports and peaks of other stages out of its RSS
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                results[name] = pool.submit(measure_stage, name, repeat).result()
+        else:
+            results[name] = measure_stage(name, repeat)
+            logging.getLogger().setLevel(logging.INFO)
+        result = results[name]
+        logging.info(f"{name:<32} {result['wall_ms_median']:>10.2f} ms (min {result['wall_ms_min']:.2f})  "
+                     f"alloc {result['alloc_peak_mb']:>8.2f} MB  rss +{result['stage_rss_mb']} MB  rows {result['rows']}")
+    return results
+
+
+# --- History and regressions ---
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=REPO_DIR).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_record(results: Dict[str, Dict[str, Any]]) -> Dict[str, Any]:
+    return {
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'commit': _git_commit(),
+        'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'pandas': pd.__version__,
+                        'platform': platform.platform(), 'cpu_count': os.cpu_count()},
+        'stages': results,
+    }
+
+
+def find_regressions(record: Dict[str, Any], baseline: Dict[str, Any],
+                     threshold: float = REGRESSION_THRESHOLD) -> List[Dict[str, Any]]:
+    """Stages whose median wall time or allocation peak grew past `threshold` against the baseline."""
+    regressions = []
+    for name, result in record['stages'].items():
+        before = baseline.get('stages', {}).get(name)
+        if not before:
+            continue
+        for metric, min_delta in (('wall_ms_median', MIN_TIME_DELTA_MS), ('alloc_peak_mb', MIN_ALLOC_DELTA_MB)):
+            old, new = before.get(metric), result.get(metric)
+            if not old or new is None:
+                continue
+            if new > old * (1 + threshold) and new - old > min_delta:
+                regressions.append({'stage': name, 'metric': metric, 'baseline': old, 'current': new,
+                                    'change': round(new / old - 1, 3)})
+    return regressions
+
+
+def load_json_file(filename: str, default: Any) -> Any:
+    if not os.path.exists(filename):
+        return default
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (IOError, json.JSONDecodeError) as e:
+        logging.error(f"Could not read {filename}: {e}")
+        return default
+
+
+def save_json_file(filename: str, data: Any):
+    tmp_path = filename + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, indent=2)
+    os.replace(tmp_path, filename)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark every analysis stage on fixed fixture data.")
+    parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=list(STAGES),
+                        help="Stages to run (default: all).")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="Timed runs per stage.")
+    parser.add_argument('--threshold', type=float, default=REGRESSION_THRESHOLD,
+                        help="Relative growth flagged as a regression.")
+    parser.add_argument('--history', default=HISTORY_FILE, help="JSON file each run is appended to.")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="JSON file holding the baseline run.")
+    parser.add_argument('--save-baseline', action='store_true', help="Store this run as the new baseline.")
+    parser.add_argument('--no-isolate', action='store_true',
+                        help="Run all stages in this process (faster; RSS figures then overlap).")
+    parser.add_argument('--fail-on-regression', action='store_true', help="Exit with status 1 on any regression.")
+    args = parser.parse_args()
+
+    logging.info(f"--- Benchmarking {len(args.stages)} stage(s), {args.repeat} run(s) each ---")
+    record = build_record(run_benchmarks(args.stages, args.repeat, isolate=not args.no_isolate))
+
+    history = load_json_file(args.history, [])
+    history.append(record)
+    save_json_file(args.history, history[-MAX_HISTORY_RUNS:])
+
+    baseline = load_json_file(args.baseline, None)
+    regressions = find_regressions(record, baseline, args.threshold) if baseline else []
+    if baseline is None:
+        logging.info(f"No baseline at {args.baseline}; run with --save-baseline to store one.")
+    elif baseline.get('environment') != record['environment']:
+        logging.warning("Baseline was recorded in a different environment; comparisons may not be meaningful.")
+    for regression in regressions:
+        logging.warning(f"REGRESSION {regression['stage']}: {regression['metric']} {regression['baseline']} -> "
+                        f"{regression['current']} ({regression['change']:+.0%})")
+    if baseline and not regressions:
+        logging.info(f"No regressions against the baseline from {baseline.get('timestamp')} ({baseline.get('commit')}).")
+    if args.save_baseline:
+        save_json_file(args.baseline, record)
+        logging.info(f"Saved this run as the baseline in {args.baseline}.")
+    sys.exit(1 if regressions and args.fail_on_regression else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,217 @@
+# filename: chain_archive.py
+#
+# Archive of every full option-chain snapshot, one per currency. The first snapshot of each
+# UTC day is stored whole (a keyframe); every later one only as the instruments that changed,
+# with unchanged fields left null, which Parquet stores as a bitmap and zstd shrinks further.
+# Locally computed greeks are not archived: they follow from IV, forward, rate and the snapshot
+# time, so any past GEX / max pain / skew can be recomputed offline by replaying the archive.
+# Exchange greeks (ticker-source snapshots) cannot be recomputed and are stored in the
+# EXCHANGE_GREEK_FIELDS; they stay null for instruments whose greeks were computed locally.
+#
+#   <currency>/latest.parquet              full chain of the last snapshot (the delta base)
+#   <currency>/segments/<timestamp>.parquet  one snapshot each, appended per refresh
+#   <currency>/days/<YYYY-MM-DD>.parquet   a closed day's segments, compacted
+
+import os
+import glob
+import logging
+from datetime import datetime
+from typing import Optional, List, Tuple, Iterator
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from clock import utc_now
+
+# --- Configuration ---
+ARCHIVE_DIR = "options_chain_archive"
+EXCHANGE_GREEK_FIELDS = ['exchange_delta', 'exchange_gamma', 'exchange_vega', 'exchange_theta']
+VALUE_FIELDS = ['open_interest', 'mark_iv', 'underlying_price', 'interest_rate', 'volume', 'open_interest_change',
+                *EXCHANGE_GREEK_FIELDS]
+COMPRESSION = 'zstd'
+COMPRESSION_LEVEL = 9
+
+SCHEMA = pa.schema([
+    ('snapshot_time', pa.timestamp('us', tz='UTC')),
+    ('spot_price', pa.float64()),
+    ('keyframe', pa.bool_()),
+    ('instrument_name', pa.string()),
+    ('removed', pa.bool_()),
+    *[(field, pa.float64()) for field in VALUE_FIELDS],
+])
+
+Snapshot = Tuple[pd.Timestamp, float, pd.DataFrame]
+
+
+class ChainArchive:
+    def __init__(self, currency: str, root_dir: str = ARCHIVE_DIR):
+        self.currency = currency.upper()
+        self.base_dir = os.path.join(root_dir, currency.lower())
+        self.latest_path = os.path.join(self.base_dir, "latest.parquet")
+
+    # --- Writes ---
+    def append(self, timestamp: datetime, spot_price: float, chain: pd.DataFrame):
+        """
+        Archives one snapshot. `chain` has an instrument_name column plus VALUE_FIELDS; missing
+        values should be NaN. Stored as a delta against the previous snapshot of the same UTC day.
+        """
+        timestamp = pd.Timestamp(timestamp)
+        chain = chain.drop_duplicates('instrument_name', keep='last').set_index('instrument_name')
+        chain = chain.reindex(columns=VALUE_FIELDS).astype(float)
+        previous = self.load()
+        if previous is None or previous[0].date() != timestamp.date() or previous[0] >= timestamp:
+            table = self._encode(timestamp, spot_price, chain, None)
+        else:
+            table = self._encode(timestamp, spot_price, chain, previous[2].set_index('instrument_name'))
+        self._write(table, self._path('segments', timestamp.strftime('%Y%m%dT%H%M%S%f')))
+        self._write(self._encode(timestamp, spot_price, chain, None), self.latest_path)
+        logging.info(f"[{self.currency}] Archived chain snapshot ({table.num_rows}/{len(chain)} rows stored).")
+
+    def compact(self, now: Optional[datetime] = None):
+        """Merges the segments of every closed UTC day into that day's file."""
+        today = pd.Timestamp(now or utc_now()).strftime('%Y%m%d')
+        by_day = {}
+        for path in self._files('segments'):
+            if self._name(path)[:8] < today:
+                by_day.setdefault(self._name(path)[:8], []).append(path)
+        for day, paths in by_day.items():
+            day_path = self._path('days', f"{day[:4]}-{day[4:6]}-{day[6:]}")
+            tables = ([pq.read_table(day_path)] if os.path.exists(day_path) else []) + [pq.read_table(p) for p in paths]
+            self._write(pa.concat_tables([self._conform(t) for t in tables]), day_path)
+            for path in paths:
+                os.remove(path)
+        if by_day:
+            logging.info(f"[{self.currency}] Compacted chain archive for {len(by_day)} closed day(s).")
+
+    # --- Reads ---
+    def load(self, as_of: Optional[datetime] = None) -> Optional[Snapshot]:
+        """The last snapshot at or before `as_of` (default: the latest one) as (time, spot, chain)."""
+        if as_of is None:
+            if not os.path.exists(self.latest_path):
+                return None
+            return next(self._decode_day(self._conform(pq.read_table(self.latest_path))), None)
+        as_of = pd.Timestamp(as_of)
+        for day in reversed([d for d in self._days() if d <= as_of.strftime('%Y%m%d')]):
+            found = None
+            for snapshot in self._replay_day(day):
+                if snapshot[0] > as_of:
+                    break
+                found = snapshot
+            if found is not None:
+                return found
+        return None
+
+    def iter_snapshots(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> Iterator[Snapshot]:
+        """Every archived snapshot with start <= time <= end, oldest first, each as a full chain."""
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        for day in self._days():
+            if (start is not None and day < start.strftime('%Y%m%d')) or (end is not None and day > end.strftime('%Y%m%d')):
+                continue
+            for snapshot in self._replay_day(day):
+                if (start is None or snapshot[0] >= start) and (end is None or snapshot[0] <= end):
+                    yield snapshot
+
+    # --- Delta encoding ---
+    @staticmethod
+    def _encode(timestamp: pd.Timestamp, spot_price: float, chain: pd.DataFrame,
+                previous: Optional[pd.DataFrame]) -> pa.Table:
+        names = chain.index.to_numpy(dtype=object)
+        values = chain.to_numpy()
+        if previous is None:
+            changed = np.ones(values.shape, dtype=bool)
+            removed_names = np.array([], dtype=object)
+        else:
+            before = previous.reindex(chain.index).to_numpy()
+            is_new = ~chain.index.isin(previous.index)
+            same = (values == before) | (np.isnan(values) & np.isnan(before))
+            changed = ~same | is_new[:, None]
+            removed_names = previous.index[~previous.index.isin(chain.index)].to_numpy(dtype=object)
+        rows = changed.any(axis=1)
+        names, values, changed = names[rows], values[rows], changed[rows]
+        if previous is not None and not len(names) and not len(removed_names):
+            # Nothing changed; one empty row still records that the snapshot was taken
+            names, values, changed = np.array([None], dtype=object), np.full((1, len(VALUE_FIELDS)), np.nan), \
+                np.zeros((1, len(VALUE_FIELDS)), dtype=bool)
+        n, n_removed = len(names), len(removed_names)
+        columns = {
+            'snapshot_time': pa.array([timestamp] * (n + n_removed), type=SCHEMA.field('snapshot_time').type),
+            'spot_price': pa.array(np.full(n + n_removed, spot_price, dtype=float)),
+            'keyframe': pa.array(np.full(n + n_removed, previous is None)),
+            'instrument_name': pa.array(list(names) + list(removed_names), type=pa.string()),
+            'removed': pa.array(np.arange(n + n_removed) >= n),
+        }
+        for i, field in enumerate(VALUE_FIELDS):
+            mask = np.concatenate((~changed[:, i], np.ones(n_removed, dtype=bool)))
+            columns[field] = pa.array(np.concatenate((values[:, i], np.full(n_removed, np.nan))), mask=mask)
+        return pa.table(columns, schema=SCHEMA)
+
+    def _replay_day(self, day: str) -> Iterator[Snapshot]:
+        paths = [p for p in self._files('days') if self._name(p).replace('-', '') == day]
+        paths += [p for p in self._files('segments') if self._name(p)[:8] == day]
+        if paths:
+            yield from self._decode_day(pa.concat_tables([self._conform(pq.read_table(p)) for p in paths]))
+
+    @staticmethod
+    def _conform(table: pa.Table) -> pa.Table:
+        """`table` in SCHEMA order; columns added to SCHEMA after it was written read as null."""
+        columns = [table.column(field.name) if field.name in table.column_names else pa.nulls(table.num_rows, field.type)
+                   for field in SCHEMA]
+        return pa.table(columns, schema=SCHEMA)
+
+    @staticmethod
+    def _decode_day(table: pa.Table) -> Iterator[Snapshot]:
+        table = table.sort_by([('snapshot_time', 'ascending')])
+        times = table.column('snapshot_time').cast(pa.int64()).to_numpy()
+        bounds = np.flatnonzero(np.r_[True, times[1:] != times[:-1], True])
+        index: Optional[pd.Index] = None
+        values = np.empty((0, len(VALUE_FIELDS)))
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            part = table.slice(lo, hi - lo)
+            keyframe = part.column('keyframe')[0].as_py()
+            if index is None and not keyframe:
+                logging.warning("Chain archive day does not start with a keyframe; skipping its deltas.")
+                continue
+            names = np.array(part.column('instrument_name').to_pylist(), dtype=object)
+            removed = part.column('removed').to_numpy(zero_copy_only=False)
+            present = ~removed & pd.notna(names)
+            if keyframe:
+                index, values = pd.Index(names[present], name='instrument_name'), np.full((present.sum(), len(VALUE_FIELDS)), np.nan)
+            else:
+                kept = ~index.isin(names[removed])
+                new = pd.Index(names[present]).difference(index)
+                index = index[kept].append(new).rename('instrument_name')
+                values = np.vstack((values[kept], np.full((len(new), len(VALUE_FIELDS)), np.nan)))
+            rows = index.get_indexer(names)
+            for i, field in enumerate(VALUE_FIELDS):
+                column = part.column(field)
+                valid = pc.is_valid(column).to_numpy(zero_copy_only=False) & present
+                values[rows[valid], i] = column.fill_null(np.nan).to_numpy()[valid]
+            chain = pd.DataFrame(values.copy(), index=index, columns=VALUE_FIELDS).reset_index()
+            yield pd.Timestamp(times[lo], unit='us', tz='UTC'), part.column('spot_price')[0].as_py(), chain
+
+    # --- Files ---
+    def _path(self, kind: str, name: str) -> str:
+        return os.path.join(self.base_dir, kind, f"{name}.parquet")
+
+    def _files(self, kind: str) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.base_dir, kind, "*.parquet")))
+
+    def _days(self) -> List[str]:
+        days = {self._name(p).replace('-', '') for p in self._files('days')}
+        days |= {self._name(p)[:8] for p in self._files('segments')}
+        return sorted(days)
+
+    @staticmethod
+    def _name(path: str) -> str:
+        return os.path.splitext(os.path.basename(path))[0]
+
+    @staticmethod
+    def _write(table: pa.Table, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        pq.write_table(table, tmp_path, compression=COMPRESSION, compression_level=COMPRESSION_LEVEL)
+        os.replace(tmp_path, path)
@@ -0,0 +1,20 @@
+# filename: clock.py
+#
+# The one place the analysis scripts read "now" for anything that affects their output
+# (candle freshness, fetch end times, greeks' time to expiry, state age, last_updated).
+# replay_server.py sets ANALYSIS_NOW_UTC to the time a recording was made, so a replay sees
+# the same clock no matter when it runs; unset, this is the wall clock.
+
+import os
+from datetime import datetime, timezone
+
+FROZEN_NOW_ENV = "ANALYSIS_NOW_UTC"
+
+
+def utc_now() -> datetime:
+    """Timezone-aware current UTC time, or the frozen time from ANALYSIS_NOW_UTC (ISO-8601)."""
+    frozen = os.environ.get(FROZEN_NOW_ENV)
+    if frozen:
+        now = datetime.fromisoformat(frozen)
+        return now.replace(tzinfo=timezone.utc) if now.tzinfo is None else now.astimezone(timezone.utc)
+    return datetime.now(timezone.utc)
@@ -1,12 +1,11 @@
 import pandas as pd
-import os
 import logging
 import sys
-import requests
-import time
 import json
-from datetime import datetime, timezone, timedelta
-from typing import Optional, List, Any, Dict
+
+from kline_store import KlineStore
+from run_metrics import span, write_run_metrics
+from clock import utc_now
 
 # --- Configuration ---
 SYMBOLS = ["BTC/USDT", "ETH/USDT"]
@@ -24,13 +23,6 @@ TIMEFRAME_CONFIG = {
 }
 MA_PERIODS = [13, 49, 100, 200, 500, 1000]
 OUTPUT_FILENAME = "ma_analysis.json"
-CACHE_DATA_DIR = "warmup_ohlc_data_fixed"
-MAX_ROWS_TO_KEEP_IN_CACHE = 20000
-
-# --- API Configuration ---
-API_RETRY_ATTEMPTS = 3
-API_RETRY_DELAY = 5
-API_KLINE_LIMIT = 1000
 
 # --- Logging Setup ---
 logging.basicConfig(level=logging.INFO,
@@ -42,97 +34,6 @@ def get_safe_symbol(symbol):
     """Converts a symbol like 'BTC/USDT' to 'BTC-USDT'."""
     return symbol.replace('/', '-')
 
-# --- DataHandler Class ---
-class DataHandler:
-    BASE_URL = "https://api.binance.com/api/v3"
-
-    @staticmethod
-    def _make_api_request(params: Dict) -> Optional[List[Any]]:
-        url = f"{DataHandler.BASE_URL}/klines"
-        for attempt in range(API_RETRY_ATTEMPTS):
-            try:
-                response = requests.get(url, params=params, timeout=15)
-                response.raise_for_status()
-                return response.json()
-            except requests.RequestException as e:
-                logging.warning(f"API request failed (attempt {attempt + 1}): {e}")
-                time.sleep(API_RETRY_DELAY)
-        return None
-
-    @staticmethod
-    def load_ohlc_from_cache(symbol: str, interval: str) -> Optional[pd.DataFrame]:
-        logging.info(f"[{symbol}/{interval}] Searching for cache file...")
-        if not os.path.exists(CACHE_DATA_DIR):
-            logging.warning(f"Cache directory '{CACHE_DATA_DIR}' not found. Creating it.")
-            os.makedirs(CACHE_DATA_DIR)
-            return None
-        
-        cache_filename = f"{symbol.upper()}_{interval}_mastercache.parquet"
-        file_path = os.path.join(CACHE_DATA_DIR, cache_filename)
-
-        if not os.path.exists(file_path):
-            logging.info(f"[{symbol}/{interval}] No cache file found at {file_path}.")
-            return None
-            
-        try:
-            logging.info(f"[{symbol}/{interval}] Loading data from: {file_path}")
-            df = pd.read_parquet(file_path)
-            if df.empty: return None
-            required_cols = ['open', 'high', 'low', 'close', 'volume']
-            df = df[[col for col in required_cols if col in df.columns]]
-            if not isinstance(df.index, pd.DatetimeIndex): raise TypeError("Cache data has no DatetimeIndex.")
-            if df.index.tz is None: df.index = df.index.tz_localize('UTC')
-            logging.info(f"[{symbol}/{interval}] Loaded {len(df)} candles from cache.")
-            return df
-        except Exception as e:
-            logging.error(f"[{symbol}/{interval}] CRITICAL: Failed to load or parse cache file: {e}")
-            return None
-
-    @staticmethod
-    def save_ohlc_to_cache(df: pd.DataFrame, symbol: str, interval: str):
-        if df.empty:
-            logging.warning(f"[{symbol}/{interval}] DataFrame is empty, skipping cache save.")
-            return
-            
-        cache_filename = f"{symbol.upper()}_{interval}_mastercache.parquet"
-        file_path = os.path.join(CACHE_DATA_DIR, cache_filename)
-        try:
-            columns_to_save = ['open', 'high', 'low', 'close', 'volume']
-            df_to_save = df[columns_to_save].tail(MAX_ROWS_TO_KEEP_IN_CACHE)
-            df_to_save.to_parquet(file_path)
-            logging.info(f"[{symbol}/{interval}] Successfully saved {len(df_to_save)} clean candles to cache: {file_path}")
-        except Exception as e:
-            logging.error(f"[{symbol}/{interval}] CRITICAL: Could not save cache to {file_path}. Error: {e}")
-
-    @staticmethod
-    def fetch_new_data(symbol: str, interval: str, start_dt: pd.Timestamp) -> Optional[pd.DataFrame]:
-        api_symbol = symbol.replace('/', '').upper()
-        all_klines = []
-        current_start_ms = int(start_dt.timestamp() * 1000)
-        logging.info(f"[{symbol}/{interval}] Fetching new data from API since {start_dt.strftime('%Y-%m-%d %H:%M:%S')} UTC...")
-        
-        while True:
-            params = {"symbol": api_symbol, "interval": interval, "limit": API_KLINE_LIMIT, "startTime": current_start_ms}
-            klines_batch = DataHandler._make_api_request(params)
-            if klines_batch is None: return None
-            if not klines_batch: break
-            all_klines.extend(klines_batch)
-            last_candle_ts = int(klines_batch[-1][0])
-            current_start_ms = last_candle_ts + 1
-            if len(klines_batch) < API_KLINE_LIMIT: break
-            # A small delay to be kind to the API
-            time.sleep(0.1)
-
-        if not all_klines: return pd.DataFrame()
-        
-        df = pd.DataFrame(all_klines, columns=['open_time', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_asset_volume', 'number_of_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore'])
-        numeric_cols = ['open', 'high', 'low', 'close', 'volume']
-        for col in numeric_cols: df[col] = pd.to_numeric(df[col], errors='coerce')
-        df['open_time'] = pd.to_datetime(df['open_time'], unit='ms', utc=True)
-        df = df.set_index('open_time')
-        df = df[numeric_cols].dropna()
-        return df
-
 # --- Indicator Calculation ---
 def add_indicators(df: pd.DataFrame, periods: list[int]) -> pd.DataFrame:
     if df.empty: return df
@@ -152,6 +53,7 @@ def add_indicators(df: pd.DataFrame, periods: list[int]) -> pd.DataFrame:
 if __name__ == "__main__":
     logging.info(f"--- Starting Accurate Market Snapshot Script ---")
     analysis_payload = {}
+    STORE = KlineStore()
 
     for symbol in SYMBOLS:
         safe_symbol = get_safe_symbol(symbol)
@@ -161,38 +63,23 @@ if __name__ == "__main__":
             print("-" * 50)
             logging.info(f"Processing {symbol} on the {tf_api} timeframe")
 
-            df_cache = DataHandler.load_ohlc_from_cache(symbol.replace('/',''), tf_api)
-            
-            if df_cache is not None and not df_cache.empty:
-                start_fetch_dt = df_cache.index[-1] + timedelta(milliseconds=1)
-            else:
-                # --- MODIFIED: Smart lookback logic for warm-up ---
-                logging.warning(f"[{symbol}/{tf_api}] No valid cache found. Performing a large historical fetch.")
-                if tf_api in ['1w', '1M']:
-                    # For weekly/monthly, we need a much longer lookback to warm up large MAs
-                    start_fetch_dt = datetime(2017, 1, 1, tzinfo=timezone.utc)
-                    logging.info(f"--> Using extended lookback for {tf_api}, starting from {start_fetch_dt.date()}.")
-                else:
-                    # Standard lookback for smaller timeframes is sufficient
-                    start_fetch_dt = datetime.now(timezone.utc) - timedelta(days=365 * 4)
-                logging.warning(f"--> This may take a moment...")
-
-            df_new = DataHandler.fetch_new_data(symbol, tf_api, start_dt=start_fetch_dt)
-
-            df_list = [df for df in [df_cache, df_new] if df is not None and not df.empty]
-            if not df_list:
+            # Full cached history: the long EMAs need the warm-up. The shared store tail-syncs
+            # the mastercache once per run (or performs the initial historical fetch).
+            with span('fetch.frame', symbol=symbol, interval=tf_api) as frame_span:
+                df_combined = STORE.get_frame(symbol.replace('/', ''), tf_api)
+                frame_span.count(rows=len(df_combined))
+            if df_combined.empty:
                 logging.error(f"[{symbol}/{tf_api}] No data available from cache or API. Skipping.")
                 continue
+            if not STORE.is_current(symbol.replace('/', ''), tf_api):
+                logging.error(f"[{symbol}/{tf_api}] Cached data is stale (sync failed). Skipping.")
+                continue
 
-            df_combined = pd.concat(df_list)
-            # Remove any potential duplicates from overlapping fetches and sort
-            df_combined = df_combined[~df_combined.index.duplicated(keep='last')].sort_index()
-            
-            DataHandler.save_ohlc_to_cache(df_combined, symbol.replace('/',''), tf_api)
-            
             # Make a copy for indicator calculation to avoid SettingWithCopyWarning
             df_for_indicators = df_combined.copy()
-            data_with_indicators = add_indicators(df_for_indicators, MA_PERIODS)
+            with span('compute.add_indicators', symbol=symbol, interval=tf_api) as indicator_span:
+                indicator_span.count(rows=len(df_for_indicators))
+                data_with_indicators = add_indicators(df_for_indicators, MA_PERIODS)
             
             if data_with_indicators.empty:
                 logging.warning(f"[{symbol}/{tf_api}] DataFrame is empty after adding indicators. Skipping.")
@@ -214,11 +101,11 @@ if __name__ == "__main__":
     if analysis_payload:
         full_payload = {
             'data': analysis_payload,
-            'last_updated': datetime.now(timezone.utc).isoformat()
+            'last_updated': utc_now().isoformat()
         }
         logging.info(f"\nWriting final payload to {OUTPUT_FILENAME}...")
         try:
-            with open(OUTPUT_FILENAME, 'w') as json_file:
+            with span('write.json', file=OUTPUT_FILENAME), open(OUTPUT_FILENAME, 'w') as json_file:
                 json.dump(full_payload, json_file, indent=4)
             logging.info(f"SUCCESS: Analysis data saved to {OUTPUT_FILENAME}.")
         except IOError as e:
@@ -227,4 +114,7 @@ if __name__ == "__main__":
     else:
         logging.warning("No data was processed, JSON file not created.")
 
+    STORE.close()
+    write_run_metrics('generate_accurate_ma')
+
     print("-" * 80 + "\nScript finished.")
@@ -0,0 +1,414 @@
+# filename: kline_store.py
+#
+# Shared local kline store. Every analysis script reads its OHLCV history from the
+# `warmup_ohlc_data_fixed/*_mastercache.parquet` files through this module instead of
+# paginating Binance on its own. Each (symbol, interval) is tail-synced at most once per
+# process; after that all reads are served from memory.
+
+import os
+import time
+import random
+import asyncio
+import logging
+from datetime import datetime, timezone
+from typing import Optional, List, Any, Dict, Tuple, Iterable
+
+import numpy as np
+import pandas as pd
+import requests
+
+from run_metrics import span, traced, count
+from clock import utc_now
+
+# --- Configuration ---
+CACHE_DATA_DIR = "warmup_ohlc_data_fixed"
+# Large enough for 3y of 1h candles (volume profile) and 270d of 15m candles (S/R levels).
+MAX_ROWS_TO_KEEP_IN_CACHE = 30000
+EARLIEST_START = datetime(2017, 1, 1, tzinfo=timezone.utc)
+
+OHLCV_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+KLINE_COLUMNS = OHLCV_COLUMNS + ['quote_volume']
+RAW_KLINE_COLUMNS = ['open_time', 'open', 'high', 'low', 'close', 'volume', 'close_time', 'quote_volume',
+                     'number_of_trades', 'taker_buy_base_asset_volume', 'taker_buy_quote_asset_volume', 'ignore']
+
+# --- API Configuration ---
+BASE_URL = os.environ.get("BINANCE_API_URL", "https://api.binance.com/api/v3")  # replay_server.py overrides it
+API_RETRY_ATTEMPTS = 4
+API_KLINE_LIMIT = 1000
+DEFAULT_TIMEOUT = 15
+
+# --- Rate limiting ---
+# Binance meters request weight per IP per minute and reports the running total in the
+# X-MBX-USED-WEIGHT-1M response header. Pages are downloaded concurrently under a token
+# bucket holding a share of that budget; failures back off exponentially with jitter.
+API_WEIGHT_LIMIT_PER_MINUTE = 6000
+API_WEIGHT_BUDGET_SHARE = 0.5
+KLINE_REQUEST_WEIGHT = 2
+API_MAX_CONCURRENCY = 4
+API_BACKOFF_BASE = 1.0
+API_BACKOFF_MAX = 60.0
+USED_WEIGHT_HEADER = 'X-MBX-USED-WEIGHT-1M'
+
+# Approximate candle lengths. '1M' is only used for sizing fetch windows; open/closed
+# checks use the exact calendar offset from `interval_to_offset`.
+INTERVAL_DELTAS = {
+    '1m': pd.Timedelta(minutes=1), '3m': pd.Timedelta(minutes=3), '5m': pd.Timedelta(minutes=5),
+    '15m': pd.Timedelta(minutes=15), '30m': pd.Timedelta(minutes=30),
+    '1h': pd.Timedelta(hours=1), '2h': pd.Timedelta(hours=2), '4h': pd.Timedelta(hours=4),
+    '6h': pd.Timedelta(hours=6), '8h': pd.Timedelta(hours=8), '12h': pd.Timedelta(hours=12),
+    '1d': pd.Timedelta(days=1), '3d': pd.Timedelta(days=3), '1w': pd.Timedelta(weeks=1),
+    '1M': pd.Timedelta(days=31),
+}
+
+
+def interval_to_offset(interval: str):
+    """Exact candle length for `interval` (a calendar month for '1M')."""
+    if interval == '1M':
+        return pd.DateOffset(months=1)
+    return INTERVAL_DELTAS[interval]
+
+
+def parse_klines(klines: List[List[Any]]) -> pd.DataFrame:
+    """Converts raw Binance kline rows into a float DataFrame indexed by UTC open time."""
+    if not klines:
+        return pd.DataFrame(columns=KLINE_COLUMNS, index=pd.DatetimeIndex([], tz='UTC', name='open_time'))
+    raw = np.asarray(klines, dtype=object)
+    df = pd.DataFrame({col: pd.to_numeric(raw[:, RAW_KLINE_COLUMNS.index(col)], errors='coerce')
+                       for col in KLINE_COLUMNS})
+    df.index = pd.DatetimeIndex(pd.to_datetime(raw[:, 0].astype('int64'), unit='ms', utc=True),
+                                name='open_time').as_unit('ns')
+    return df.dropna(subset=OHLCV_COLUMNS)
+
+
+class WeightLimiter:
+    """
+    Token bucket over request weight. Callers reserve weight up front (the balance may go
+    negative) and sleep off the debt, so no lock is needed inside one event loop. The balance
+    is pulled down to what the server reports as still unused after every response.
+    """
+
+    def __init__(self, weight_per_minute: float = API_WEIGHT_LIMIT_PER_MINUTE * API_WEIGHT_BUDGET_SHARE):
+        self.capacity = float(weight_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, weight: float):
+        self._refill()
+        self.tokens -= weight
+        wait = max(self.blocked_until - time.monotonic(), -self.tokens / self.rate)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def observe_used_weight(self, used_weight: int):
+        self._refill()
+        self.tokens = min(self.tokens, self.capacity - used_weight)
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class AsyncKlineDownloader:
+    """
+    Downloads a known kline range as fixed page windows of API_KLINE_LIMIT candles, fetched
+    concurrently; a window the server answers in several shorter pages is followed up. The
+    blocking `requests.Session` runs on worker threads, so no async HTTP client is needed;
+    any object with a requests-style `get` works (e.g. a mock server URL).
+    """
+
+    def __init__(self, session: requests.Session, base_url: str = BASE_URL, limiter: Optional[WeightLimiter] = None,
+                 max_concurrency: int = API_MAX_CONCURRENCY):
+        self.session = session
+        self.base_url = base_url
+        self.limiter = limiter or WeightLimiter()
+        self.max_concurrency = max_concurrency
+        self.request_count = 0
+
+    @staticmethod
+    def page_windows(interval: str, start_ms: int, end_ms: int) -> List[Tuple[int, int]]:
+        """Splits [start_ms, end_ms] into windows that each hold at most API_KLINE_LIMIT candle opens."""
+        if interval == '1M':
+            return [(start_ms, end_ms)]
+        span = int(INTERVAL_DELTAS[interval] / pd.Timedelta(milliseconds=1)) * API_KLINE_LIMIT
+        return [(page_start, min(page_start + span - 1, end_ms)) for page_start in range(start_ms, end_ms + 1, span)]
+
+    async def _request(self, params: Dict) -> Optional[List[Any]]:
+        url = f"{self.base_url}/klines"
+        for attempt in range(API_RETRY_ATTEMPTS):
+            backoff = min(API_BACKOFF_MAX, API_BACKOFF_BASE * 2 ** attempt) * random.uniform(0.5, 1.0)
+            await self.limiter.acquire(KLINE_REQUEST_WEIGHT)
+            try:
+                self.request_count += 1
+                count(requests=1)
+                response = await asyncio.to_thread(self.session.get, url, params=params, timeout=DEFAULT_TIMEOUT)
+                count(bytes_downloaded=len(getattr(response, 'content', None) or b''))
+                headers = getattr(response, 'headers', None) or {}
+                if headers.get(USED_WEIGHT_HEADER):
+                    self.limiter.observe_used_weight(int(headers[USED_WEIGHT_HEADER]))
+                status = getattr(response, 'status_code', 200)
+                if status in (418, 429):
+                    retry_after = float(headers.get('Retry-After') or backoff)
+                    logging.warning(f"API rate limit hit (HTTP {status}); pausing requests for {retry_after:.0f}s.")
+                    self.limiter.pause(retry_after)
+                    count(retries=1)
+                    continue
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException as e:
+                logging.warning(f"API request failed (attempt {attempt + 1}): {e}")
+                if attempt < API_RETRY_ATTEMPTS - 1:
+                    count(retries=1)
+                    await asyncio.sleep(backoff)
+        return None
+
+    async def _fetch_windows(self, symbol: str, interval: str, windows: List[Tuple[int, int]]) -> List[Optional[List]]:
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        step = interval_to_offset(interval)
+
+        async def fetch_window(window: Tuple[int, int]) -> Optional[List]:
+            # A server may cap pages below API_KLINE_LIMIT; a page ending before the window does is
+            # continued from the candle after its last one, so short pages never leave gaps
+            rows, start = [], window[0]
+            while start <= window[1]:
+                async with semaphore:
+                    page = await self._request({"symbol": symbol, "interval": interval, "limit": API_KLINE_LIMIT,
+                                                "startTime": start, "endTime": window[1]})
+                if page is None:
+                    return None
+                if not page:
+                    break
+                rows.extend(page)
+                next_start = int((pd.Timestamp(int(page[-1][0]), unit='ms', tz='UTC') + step).timestamp() * 1000)
+                if next_start <= start:
+                    break
+                start = next_start
+            return rows
+
+        return await asyncio.gather(*(fetch_window(window) for window in windows))
+
+    def fetch(self, symbol: str, interval: str, start_ms: int, end_ms: int) -> Optional[List[List[Any]]]:
+        """Raw klines opening in [start_ms, end_ms] in time order, or None if any page failed."""
+        windows = self.page_windows(interval, start_ms, end_ms)
+        pages = asyncio.run(self._fetch_windows(symbol, interval, windows))
+        if any(page is None for page in pages):
+            return None
+        return [kline for page in pages for kline in page]
+
+
+class KlineStore:
+    """
+    In-process view over the on-disk mastercache files.
+
+    `sync` brings one (symbol, interval) up to date with a forward tail fetch starting at
+    the last cached candle (so a previously stored, still-forming candle is refreshed), and
+    backfills older history only when a caller asks for more rows than are cached.
+    Readers get DataFrame slices or read-only NumPy arrays; they never trigger a second
+    network round-trip for the same key in the same run. A key whose tail sync failed keeps
+    serving its cache, but `is_current` reports it so callers don't publish stale values.
+    """
+
+    def __init__(self, cache_dir: str = CACHE_DATA_DIR, session: Optional[requests.Session] = None,
+                 base_url: str = BASE_URL):
+        self.cache_dir = cache_dir
+        self.session = session or requests.Session()
+        self.downloader = AsyncKlineDownloader(self.session, base_url=base_url)
+        self._frames: Dict[Tuple[str, str], pd.DataFrame] = {}
+        self._synced: Dict[Tuple[str, str], Tuple[int, frozenset]] = {}
+        self._stale: set = set()  # Keys whose tail sync failed this run
+
+    @property
+    def request_count(self) -> int:
+        return self.downloader.request_count
+
+    # --- Network ---
+    def _fetch_range(self, symbol: str, interval: str, start: pd.Timestamp,
+                     end: Optional[pd.Timestamp] = None) -> Optional[pd.DataFrame]:
+        """Downloads `start` (inclusive) to `end` (inclusive) or the latest candle, pages in parallel."""
+        start_ms = int(start.timestamp() * 1000)
+        end_ms = int((end if end is not None else pd.Timestamp(utc_now())).timestamp() * 1000)
+        logging.info(f"[{symbol}/{interval}] Fetching klines since {start.strftime('%Y-%m-%d %H:%M:%S')} UTC...")
+        with span('fetch.klines', symbol=symbol, interval=interval):
+            klines = self.downloader.fetch(symbol, interval, start_ms, end_ms)
+        if klines is None:
+            return None
+        with span('parse.klines', symbol=symbol, interval=interval) as parse_span:
+            parse_span.count(rows=len(klines))
+            return parse_klines(klines)
+
+    # --- Disk cache ---
+    def _cache_path(self, symbol: str, interval: str) -> str:
+        return os.path.join(self.cache_dir, f"{symbol.upper()}_{interval}_mastercache.parquet")
+
+    @traced('read.kline_cache')
+    def _load_cache(self, symbol: str, interval: str) -> pd.DataFrame:
+        file_path = self._cache_path(symbol, interval)
+        empty = parse_klines([])
+        if not os.path.exists(file_path):
+            logging.info(f"[{symbol}/{interval}] No cache file found at {file_path}.")
+            return empty
+        try:
+            df = pd.read_parquet(file_path)
+            if not isinstance(df.index, pd.DatetimeIndex):
+                raise TypeError("Cache data has no DatetimeIndex.")
+            if df.index.tz is None:
+                df.index = df.index.tz_localize('UTC')
+            # Older caches were written without quote volume; those rows are re-fetched on demand.
+            df = df.reindex(columns=KLINE_COLUMNS).astype(float)
+            df.index = df.index.as_unit('ns').rename('open_time')
+            logging.info(f"[{symbol}/{interval}] Loaded {len(df)} candles from cache.")
+            count(rows=len(df))
+            return df.sort_index()
+        except Exception as e:
+            logging.error(f"[{symbol}/{interval}] CRITICAL: Failed to load or parse cache file: {e}")
+            return empty
+
+    @traced('write.kline_cache')
+    def _save_cache(self, df: pd.DataFrame, symbol: str, interval: str):
+        if df.empty:
+            logging.warning(f"[{symbol}/{interval}] DataFrame is empty, skipping cache save.")
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        file_path = self._cache_path(symbol, interval)
+        tmp_path = file_path + ".tmp"
+        try:
+            df[KLINE_COLUMNS].tail(MAX_ROWS_TO_KEEP_IN_CACHE).to_parquet(tmp_path)
+            os.replace(tmp_path, file_path)
+            count(rows=min(len(df), MAX_ROWS_TO_KEEP_IN_CACHE))
+            logging.info(f"[{symbol}/{interval}] Saved {min(len(df), MAX_ROWS_TO_KEEP_IN_CACHE)} candles to cache.")
+        except Exception as e:
+            logging.error(f"[{symbol}/{interval}] CRITICAL: Could not save cache to {file_path}. Error: {e}")
+
+    @staticmethod
+    def _merge(frames: Iterable[Optional[pd.DataFrame]]) -> pd.DataFrame:
+        frames = [f for f in frames if f is not None and not f.empty]
+        if not frames:
+            return parse_klines([])
+        df = pd.concat(frames)
+        return df[~df.index.duplicated(keep='last')].sort_index()
+
+    # --- Sync ---
+    def sync(self, symbol: str, interval: str, min_rows: int = 0, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Ensures the newest candles and at least `min_rows` of history (with non-null
+        `columns`) are available for (symbol, interval). Network access happens only on the
+        first call per key, or when a later call needs more history than was ensured.
+        """
+        key = (symbol.upper(), interval)
+        symbol = key[0]
+        min_rows = min(int(min_rows), MAX_ROWS_TO_KEEP_IN_CACHE)
+        columns = columns or []
+        ensured_rows, ensured_columns = self._synced.get(key, (-1, frozenset()))
+        if ensured_rows >= min_rows and ensured_columns.issuperset(columns):
+            return self._frames[key]
+
+        df = self._frames.get(key)
+        if df is None:
+            df = self._load_cache(symbol, interval)
+        delta = INTERVAL_DELTAS[interval]
+        changed = False
+
+        if key not in self._synced:
+            if df.empty:
+                warmup_rows = max(min_rows, MAX_ROWS_TO_KEEP_IN_CACHE)
+                start = max(pd.Timestamp(EARLIEST_START), pd.Timestamp(utc_now()) - delta * warmup_rows)
+                logging.warning(f"[{symbol}/{interval}] No valid cache found. Performing a large historical fetch.")
+            else:
+                start = df.index[-1]
+            df_new = self._fetch_range(symbol, interval, start)
+            if df_new is None:
+                self._stale.add(key)
+                newest = df.index[-1].strftime('%Y-%m-%d %H:%M:%S') if not df.empty else 'none'
+                logging.error(f"[{symbol}/{interval}] Tail sync failed; cached data is stale (newest candle {newest}).")
+            else:
+                df = self._merge([df, df_new])
+                changed = True
+
+        if not df.empty and len(df) < min_rows:
+            start = max(pd.Timestamp(EARLIEST_START), df.index[-1] - delta * min_rows)
+            if start < df.index[0]:
+                df = self._merge([self._fetch_range(symbol, interval, start, df.index[0] - pd.Timedelta(milliseconds=1)), df])
+                changed = True
+
+        missing = self._missing_mask(df, min_rows, columns)
+        if missing is not None and missing.any():
+            window = df.tail(len(missing))
+            gap_index = window.index[missing]
+            logging.info(f"[{symbol}/{interval}] Re-fetching {len(gap_index)} cached candles missing {columns}.")
+            df = self._merge([df, self._fetch_range(symbol, interval, gap_index[0], gap_index[-1])])
+            changed = True
+
+        if changed:
+            self._save_cache(df, symbol, interval)
+        self._frames[key] = df.tail(MAX_ROWS_TO_KEEP_IN_CACHE)
+        self._synced[key] = (max(ensured_rows, min_rows), ensured_columns.union(columns))
+        return self._frames[key]
+
+    @staticmethod
+    def _missing_mask(df: pd.DataFrame, min_rows: int, columns: List[str]) -> Optional[np.ndarray]:
+        if not columns or df.empty:
+            return None
+        window = df[columns].tail(min_rows) if min_rows else df[columns]
+        return window.isna().any(axis=1).to_numpy()
+
+    def is_current(self, symbol: str, interval: str) -> bool:
+        """
+        True when the newest candle of (symbol, interval) is still forming, i.e. is no older than
+        one interval. False after a failed tail sync left only an outdated cache; callers then
+        emit None (or skip the key) instead of presenting the last cached candle as current.
+        """
+        key = (symbol.upper(), interval)
+        df = self._frames.get(key)
+        if df is None:
+            df = self.sync(symbol, interval)
+        if df.empty:
+            return False
+        if df.index[-1] + interval_to_offset(interval) > pd.Timestamp(utc_now()):
+            return True
+        reason = "tail sync failed" if key in self._stale else "no newer candle returned"
+        logging.warning(f"[{key[0]}/{interval}] Newest candle {df.index[-1]} is older than one interval ({reason}).")
+        return False
+
+    # --- Read-only views ---
+    def get_frame(self, symbol: str, interval: str, last_n: Optional[int] = None, lookback_days: Optional[int] = None,
+                  closed_only: bool = False, columns: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the newest candles for (symbol, interval).
+
+        `last_n` limits the result to a number of candles, `lookback_days` to a time window
+        ending at the newest candle. With `closed_only` the still-forming candle is dropped.
+        """
+        columns = columns or OHLCV_COLUMNS
+        min_rows = last_n or 0
+        if lookback_days:
+            min_rows = max(min_rows, int(pd.Timedelta(days=lookback_days) / INTERVAL_DELTAS[interval]) + 1)
+        df = self.sync(symbol, interval, min_rows=min_rows + int(closed_only),
+                       columns=[c for c in columns if c not in OHLCV_COLUMNS])
+        if df.empty:
+            return df[columns]
+        stop = len(df)
+        if closed_only and df.index[-1] + interval_to_offset(interval) > pd.Timestamp(utc_now()):
+            stop -= 1
+        start = 0
+        if last_n:
+            start = max(start, stop - last_n)
+        if lookback_days:
+            start = max(start, int(df.index.searchsorted(df.index[stop - 1] - pd.Timedelta(days=lookback_days), side='right')))
+        return df.iloc[start:stop][columns]
+
+    def get_arrays(self, symbol: str, interval: str, **kwargs) -> Dict[str, np.ndarray]:
+        """Same selection as `get_frame`, returned as read-only column arrays plus `open_time` (int64 ns)."""
+        df = self.get_frame(symbol, interval, **kwargs)
+        arrays = {col: df[col].to_numpy(dtype=float, copy=False) for col in df.columns}
+        arrays['open_time'] = df.index.asi8
+        for arr in arrays.values():
+            arr.flags.writeable = False
+        return arrays
+
+    def close(self):
+        self.session.close()
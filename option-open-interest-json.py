@@ -7,26 +7,71 @@ import time
 import argparse
 from datetime import datetime, timedelta, timezone
 from collections import defaultdict
+from functools import lru_cache
 from math import inf, isclose
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Dict, Any, Optional, Tuple, Set
 
+import numpy as np
+import pandas as pd
+
+from black76 import black76_scenarios, GREEK_KEYS
+from options_history import OptionsHistoryStore
+from chain_archive import ChainArchive, VALUE_FIELDS, EXCHANGE_GREEK_FIELDS
+from run_metrics import span, traced, count, write_run_metrics
+from clock import utc_now
+
 # --- Default Configuration ---
 TARGET_CURRENCIES = ['BTC', 'ETH']
 DEFAULT_OUTPUT_TEMPLATE = "deribit_options_{currency}_analysis.json"
+# Retired JSON history, replaced by the options_history Parquet store. A local copy seeds an empty
+# store once and is then renamed to *.imported, so nothing keeps reading a file that no longer updates
 DEFAULT_HISTORICAL_TEMPLATE = "historical_market_data_{currency}.json"
+LEGACY_IMPORTED_SUFFIX = ".imported"
 
 # --- Constants ---
 END_DATE = datetime(2025, 12, 31)
-DERIBIT_API_URL = "https://www.deribit.com/api/v2/public/"
+DERIBIT_API_URL = os.environ.get("DERIBIT_API_URL", "https://www.deribit.com/api/v2/public/")  # replay_server.py overrides it
 MAX_WORKERS = 8
 TOP_N_OI_WALLS = 5
-MAX_HISTORY_POINTS = 288
 STATIC_STRIKES_BY_CURRENCY = {
     'BTC': {80000, 90000, 100000, 110000, 120000, 130000, 140000, 150000},
     'ETH': {3000, 3500, 4000, 4500, 5000, 5500, 6000}
 }
 
+# --- Snapshot Source ---
+# 'bulk' reads the whole chain from one get_book_summary_by_currency call and computes greeks
+# locally (Black-76 on mark IV and the expiry's forward); 'ticker' requests every instrument's
+# ticker, which takes 1000+ calls per currency and is kept as the fallback.
+SNAPSHOT_SOURCE = 'bulk'
+TICKER_FALLBACK = True
+# The book summary has no 24h OI change; it is measured against the archived chain instead
+OI_CHANGE_HOURS = 24
+SECONDS_PER_YEAR = 365 * 86400
+# Every live run archives the raw chain (no greeks, see chain_archive.py) so all dealer-exposure
+# metrics can be recomputed offline with `--source snapshot`, for the latest or any archived time
+# (`--as-of`) and optionally under a spot/vol scenario, without touching the API
+SCENARIO_OUTPUT_TEMPLATE = "deribit_options_{currency}_scenario.json"
+STATS_FIELDS = ('volume', 'open_interest_change')
+
+# --- Option Chain Table ---
+# One row per option; greek columns hold dealer exposure (dealers short, times OI).
+CHAIN_COLUMNS = ['expiry', 'strike', 'is_call', 'oi', 'iv', 'forward', 'rate', 'volume_24h', 'call_oi', 'put_oi',
+                 'call_volume_24h', 'put_volume_24h', *GREEK_KEYS]
+EXPIRY_SUM_COLUMNS = ['call_oi', 'put_oi', 'volume_24h', 'call_volume_24h', 'put_volume_24h', *GREEK_KEYS]
+EXPIRY_BUCKETS = {"0DTE": 1, "1-7 Days": 7, "8-30 Days": 30, "30-90 Days": 90, "90+ Days": inf}  # Upper bound, days
+
+# --- GEX Curve ---
+# Dealer gamma exposure is repriced on a grid of hypothetical spot prices (every forward moved
+# proportionally, IV and time held fixed); the gamma flip is the zero crossing nearest spot.
+# The dealer totals above treat dealers as short every option, so their GEX can never change
+# sign; the curve uses the usual flip model instead: dealers long calls, short puts.
+GEX_CURVE_DEALER_SIGN = {'call': 1.0, 'put': -1.0}
+GEX_CURVE_RANGE = 0.25  # Grid spans spot * (1 +/- range)
+GEX_CURVE_POINTS = 201  # Odd, so spot itself is a grid point
+GEX_FLIP_TOLERANCE = 1e-5  # Relative to spot
+GEX_FLIP_MAX_ITERATIONS = 60
+
 # --- API Client Configuration ---
 API_TIMEOUT = 15
 API_RETRY_ATTEMPTS = 5
@@ -46,7 +91,9 @@ class DeribitAPIClient:
         delay = API_RETRY_DELAY
         for attempt in range(API_RETRY_ATTEMPTS):
             try:
+                count(requests=1)
                 response = self.session.get(url, params=params, timeout=API_TIMEOUT)
+                count(bytes_downloaded=len(response.content or b''))
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.HTTPError as e:
@@ -58,6 +105,7 @@ class DeribitAPIClient:
             except requests.exceptions.RequestException as e:
                 logging.error(f"Request failed for '{endpoint}'. Attempt {attempt + 1}/{API_RETRY_ATTEMPTS}: {e}")
             if attempt < API_RETRY_ATTEMPTS - 1:
+                count(retries=1)
                 time.sleep(delay)
                 delay *= 2
         logging.critical(f"API request to '{endpoint}' failed after {API_RETRY_ATTEMPTS} attempts.")
@@ -65,31 +113,52 @@ class DeribitAPIClient:
 
 
 class DeribitMarketAnalyzer:
-    def __init__(self, currency: str, output_file: str, historical_file: str):
+    def __init__(self, currency: str, output_file: str, historical_file: str, source: str = SNAPSHOT_SOURCE,
+                 spot_shift: float = 0.0, vol_shift: float = 0.0, replay_as_of: Optional[datetime] = None):
         self.currency = currency.upper()
         self.cur_lower = currency.lower()
         self.output_file = output_file
         self.historical_file = historical_file
+        self.source = source
+        self.history = OptionsHistoryStore(self.currency)
+        self.archive = ChainArchive(self.currency)
+        # Scenario applied to snapshot replays: relative spot/forward move and absolute IV change
+        self.spot_shift, self.vol_shift = spot_shift, vol_shift
+        self.replay_as_of = replay_as_of
         self.api_client = DeribitAPIClient(DERIBIT_API_URL)
         self.spot_price: Optional[float] = None
+        # Valuation time for greeks and expiry buckets; the snapshot's own time when replaying one
+        self.as_of = utc_now()
         self.statically_tracked_strikes = STATIC_STRIKES_BY_CURRENCY.get(self.currency, set())
         self.all_tickers: List[Dict[str, Any]] = []
 
     def run_analysis(self):
         logging.info(f"--- Starting Deribit Market Analysis for {self.currency} ---")
         start_time = time.time()
-        if not self._fetch_initial_market_state():
-            raise SystemExit(f"Fatal: Could not fetch initial market state for {self.currency}.")
-        instrument_names = self._fetch_instrument_names()
-        if not instrument_names:
-            raise SystemExit(f"Fatal: No active {self.currency} instruments found.")
-        self.all_tickers = self._get_all_tickers_in_parallel(instrument_names)
+        if self.source == 'snapshot':
+            with span('read.chain_snapshot', currency=self.currency):
+                self.all_tickers = self._load_chain_snapshot()
+        else:
+            with span('fetch.index_price', currency=self.currency):
+                market_state_ok = self._fetch_initial_market_state()
+            if not market_state_ok:
+                raise SystemExit(f"Fatal: Could not fetch initial market state for {self.currency}.")
+            with span('fetch.chain', currency=self.currency, source=self.source) as chain_span:
+                self.all_tickers = self._get_chain_snapshot()
+                chain_span.count(rows=len(self.all_tickers))
+            if self.all_tickers:
+                with span('write.chain_archive', currency=self.currency):
+                    self._save_chain_snapshot()
         if not self.all_tickers:
             raise SystemExit(f"Fatal: Could not fetch any ticker data for {self.currency}.")
-        grouped_options, total_greeks = self._aggregate_market_data()
-        if not grouped_options:
+        with span('parse.chain', currency=self.currency) as parse_span:
+            parse_span.count(rows=len(self.all_tickers))
+            chain = self._aggregate_market_data()
+        if chain.empty:
             raise SystemExit(f"Fatal: No valid options data after processing for {self.currency}.")
-        self._process_and_save_data(grouped_options, total_greeks)
+        with span('compute.metrics', currency=self.currency) as metrics_span:
+            metrics_span.count(rows=len(chain))
+            self._process_and_save_data(chain)
         end_time = time.time()
         logging.info(
             f"--- Analysis for {self.currency} finished successfully in {end_time - start_time:.2f} seconds! ---")
@@ -109,6 +178,140 @@ class DeribitMarketAnalyzer:
         logging.error(f"Could not extract {self.currency} index price from API response.")
         return None
 
+    def _get_chain_snapshot(self) -> List[Dict[str, Any]]:
+        if self.source == 'bulk':
+            tickers = self._get_tickers_from_book_summary()
+            if tickers or not TICKER_FALLBACK:
+                return tickers
+            logging.warning(f"Bulk snapshot unavailable for {self.currency}; falling back to per-instrument tickers.")
+        instrument_names = self._fetch_instrument_names()
+        if not instrument_names:
+            raise SystemExit(f"Fatal: No active {self.currency} instruments found.")
+        tickers = self._get_all_tickers_in_parallel(instrument_names)
+        # Exchange greeks are kept (and archived, as they cannot be recomputed); instruments the
+        # exchange sent none for are priced locally
+        for t in tickers:
+            if t.get('greeks'):
+                t['greeks_source'] = 'exchange'
+        self._attach_local_greeks(tickers, overwrite=False)
+        return tickers
+
+    @traced('compute.greeks')
+    def _attach_local_greeks(self, tickers: List[Dict[str, Any]], overwrite: bool = True):
+        """
+        Sets each record's 'greeks' from one vectorized Black-76 call over the chain (only records
+        without greeks unless `overwrite`). The instance's spot/vol scenario is applied here.
+        """
+        targets = [t for t in tickers if overwrite or not t.get('greeks')]
+        parsed = [self._parse_instrument(t.get('instrument_name', '')) for t in targets]
+        targets = [t for t, p in zip(targets, parsed) if p]
+        parsed = [p for p in parsed if p]
+        if not targets:
+            return
+        count(rows=len(targets))
+        greeks = black76_scenarios(
+            forward=np.array([float(t.get('underlying_price') or 0.0) for t in targets]),
+            strike=np.array([p[2] for p in parsed]),
+            years=np.array([(p[1] - self.as_of).total_seconds() / SECONDS_PER_YEAR for p in parsed]),
+            iv=np.array([float(t.get('mark_iv') or 0.0) / 100.0 for t in targets]),
+            is_call=np.array([p[3] == 'call' for p in parsed]),
+            rate=np.array([float(t.get('interest_rate') or 0.0) for t in targets]),
+            spot_moves=[self.spot_shift], vol_moves=[self.vol_shift])
+        greeks = {key: values[0, 0] for key, values in greeks.items()}
+        has_greeks = np.all([np.isfinite(greeks[key]) for key in GREEK_KEYS], axis=0)
+        for i, t in enumerate(targets):
+            t['greeks'] = {key: float(greeks[key][i]) for key in GREEK_KEYS} if has_greeks[i] else {}
+        logging.info(f"Computed local greeks for {int(has_greeks.sum())}/{len(targets)} {self.currency} options.")
+
+    def _save_chain_snapshot(self):
+        columns = {'instrument_name': [t.get('instrument_name') for t in self.all_tickers]}
+        exchange_greeks = [t['greeks'] if t.get('greeks_source') == 'exchange' else {} for t in self.all_tickers]
+        for field in VALUE_FIELDS:
+            if field in EXCHANGE_GREEK_FIELDS:
+                values = [greeks.get(field.split('_', 1)[1]) for greeks in exchange_greeks]
+            else:
+                values = [(t.get('stats') or {}).get(field) if field in STATS_FIELDS else t.get(field)
+                          for t in self.all_tickers]
+            columns[field] = [float(v) if v is not None else np.nan for v in values]
+        self.archive.append(self.as_of, self.spot_price, pd.DataFrame(columns))
+        self.archive.compact(self.as_of)
+
+    def _load_chain_snapshot(self) -> List[Dict[str, Any]]:
+        """Rebuilds ticker-shaped records from an archived chain and reprices them under the scenario."""
+        snapshot = self.archive.load(self.replay_as_of)
+        if snapshot is None:
+            raise SystemExit(f"Fatal: No archived {self.currency} chain snapshot"
+                             f"{f' at or before {self.replay_as_of}' if self.replay_as_of else ''}.")
+        timestamp, spot_price, chain = snapshot
+        self.as_of = timestamp.to_pydatetime()
+        self.spot_price = spot_price * (1.0 + self.spot_shift)
+        # Counts default to 0, prices to None (no local greeks), as in a live response
+        chain = chain.astype(object).where(chain.notna(), None)
+        # Exchange greeks (ticker-source runs) reproduce the published figures; a scenario reprices everything
+        scenario = bool(self.spot_shift or self.vol_shift)
+        tickers = []
+        for row in chain.itertuples(index=False):
+            ticker = {
+                'instrument_name': row.instrument_name,
+                'open_interest': row.open_interest or 0.0,
+                'mark_iv': (row.mark_iv or 0.0) + self.vol_shift * 100.0,
+                'underlying_price': row.underlying_price,
+                'interest_rate': row.interest_rate,
+                'stats': {'volume': row.volume or 0.0, 'open_interest_change': row.open_interest_change or 0.0}
+            }
+            exchange_greeks = {field.split('_', 1)[1]: getattr(row, field) for field in EXCHANGE_GREEK_FIELDS}
+            if not scenario and all(value is not None for value in exchange_greeks.values()):
+                ticker['greeks'], ticker['greeks_source'] = exchange_greeks, 'exchange'
+            tickers.append(ticker)
+        logging.info(f"Replaying {len(tickers)} {self.currency} options from the {timestamp.isoformat()} snapshot "
+                     f"(spot {self.spot_shift:+.1%}, IV {self.vol_shift * 100:+.1f} pts).")
+        # The IV shift is already in mark_iv; only the forward moves with the scenario
+        vol_shift, self.vol_shift = self.vol_shift, 0.0
+        self._attach_local_greeks(tickers, overwrite=scenario)
+        self.vol_shift = vol_shift
+        return tickers
+
+    def _get_tickers_from_book_summary(self) -> List[Dict[str, Any]]:
+        """
+        Ticker-shaped records for the whole chain from one book-summary call, so the rest of the
+        pipeline is unchanged. Greeks come from the vectorized Black-76 engine.
+        """
+        logging.info(f"Fetching {self.currency} option book summary (bulk snapshot)...")
+        data = self.api_client.make_request("get_book_summary_by_currency", {'currency': self.currency, 'kind': 'option'})
+        rows = [row for row in (data or {}).get('result') or [] if self._parse_instrument(row.get('instrument_name', ''))]
+        if not rows:
+            return []
+
+        oi_change = self._get_oi_change_from_archive({row['instrument_name']: float(row.get('open_interest') or 0.0)
+                                                      for row in rows}, self.as_of)
+        tickers = []
+        for row in rows:
+            name = row['instrument_name']
+            tickers.append({
+                'instrument_name': name,
+                'open_interest': float(row.get('open_interest') or 0.0),
+                'mark_iv': float(row.get('mark_iv') or 0.0),
+                'mark_price': row.get('mark_price'),
+                'underlying_price': row.get('underlying_price'),
+                'interest_rate': row.get('interest_rate'),
+                'stats': {'volume': float(row.get('volume') or 0.0), 'open_interest_change': oi_change.get(name, 0.0)}
+            })
+        logging.info(f"Built {len(tickers)} {self.currency} option records from the book summary.")
+        self._attach_local_greeks(tickers)
+        return tickers
+
+    def _get_oi_change_from_archive(self, current_oi: Dict[str, float], now: datetime) -> Dict[str, float]:
+        """OI change per instrument against the newest archived chain at least OI_CHANGE_HOURS old."""
+        with span('read.chain_archive', currency=self.currency):
+            reference = self.archive.load(now - timedelta(hours=OI_CHANGE_HOURS))
+        if reference is None:
+            logging.info(f"No {OI_CHANGE_HOURS}h-old archived chain yet; OI change by strike will be empty.")
+            return {}
+        timestamp, _, chain = reference
+        reference_oi = dict(zip(chain['instrument_name'], chain['open_interest'].fillna(0.0)))
+        logging.info(f"Measuring OI change against the {timestamp.isoformat()} archived chain.")
+        return {name: oi - reference_oi.get(name, 0.0) for name, oi in current_oi.items()}
+
     def _fetch_instrument_names(self) -> List[str]:
         logging.info(f"Fetching instrument names for {self.currency} options...")
         params = {'currency': self.currency, 'kind': 'option', 'expired': 'false'}
@@ -140,8 +343,9 @@ class DeribitMarketAnalyzer:
         logging.info(f"Successfully fetched data for {len(all_tickers)}/{total} instruments.")
         return all_tickers
 
-    def _aggregate_market_data(self) -> Tuple[Dict, Dict]:
-        grouped_options, total_greeks = defaultdict(list), defaultdict(lambda: defaultdict(float))
+    def _aggregate_market_data(self) -> pd.DataFrame:
+        """Builds the option chain table; every per-expiry and per-strike figure is a group-by over it."""
+        columns = {name: [] for name in CHAIN_COLUMNS}
         logging.info(f"Processing {len(self.all_tickers)} {self.currency} tickers...")
         for tk in self.all_tickers:
             if (oi := float(tk.get('open_interest', 0.0))) == 0: continue
@@ -152,90 +356,94 @@ class DeribitMarketAnalyzer:
             greeks = tk.get('greeks')
             if not greeks: continue
 
-            gamma, delta = -float(greeks.get('gamma', 0.0)), -float(greeks.get('delta', 0.0))
-            vega, theta = -float(greeks.get('vega', 0.0)), -float(greeks.get('theta', 0.0))
-
-            contributions = {'gamma': gamma * oi, 'delta': delta * oi, 'vega': vega * oi, 'theta': theta * oi}
-            grouped_options[expiry_dt].append({
-                'strike': strike, 'type': opt_type, 'oi': oi,
-                'iv': float(tk.get('mark_iv', 0.0)) / 100.0,
-                'volume_24h': float(tk.get('stats', {}).get('volume', 0.0)),
-                'contributions': contributions
-            })
-            for key in contributions:
-                total_greeks[key][strike] += contributions[key]
+            is_call = opt_type == 'call'
+            volume = float(tk.get('stats', {}).get('volume', 0.0))
+            row = [expiry_dt, strike, is_call, oi, float(tk.get('mark_iv', 0.0)) / 100.0,
+                   float(tk.get('underlying_price') or 0.0), float(tk.get('interest_rate') or 0.0), volume,
+                   oi if is_call else 0.0, 0.0 if is_call else oi, volume if is_call else 0.0, 0.0 if is_call else volume,
+                   *(-float(greeks.get(key, 0.0)) * oi for key in GREEK_KEYS)]
+            for name, value in zip(CHAIN_COLUMNS, row):
+                columns[name].append(value)
         logging.info("Finished processing tickers.")
-        return grouped_options, total_greeks
+        return pd.DataFrame(columns)
 
     ### MODIFIED ### Main processing function now includes new calculations
-    def _process_and_save_data(self, grouped_options: Dict, total_greeks: Dict):
+    def _process_and_save_data(self, chain: pd.DataFrame):
         logging.info("Calculating final metrics and preparing JSON files...")
-        now_timestamp = datetime.now(timezone.utc).isoformat()
-        expirations_list, market_totals = self._build_expirations_list(grouped_options)
+        now_timestamp = self.as_of.isoformat()
+        by_expiry = chain.groupby('expiry')[EXPIRY_SUM_COLUMNS].sum()
+        total_greeks = chain.groupby('strike')[list(GREEK_KEYS)].sum()
+        with span('compute.expirations', currency=self.currency):
+            expirations_list, market_totals = self._build_expirations_list(chain, by_expiry)
 
         # ### NEW ### Calculate the three new features
-        exposure_by_expiry_buckets = self._calculate_exposure_by_expiry(grouped_options)
+        exposure_by_expiry_buckets = self._calculate_exposure_by_expiry(by_expiry)
         oi_change_by_strike = self._calculate_oi_change_by_strike()
         volatility_summary = self._calculate_volatility_summary()
         
+        with span('compute.gex_curve', currency=self.currency):
+            gex_curve = self._calculate_gex_curve(chain)
+
         # ### MODIFIED ### Build market summary and add it to the final output
-        market_summary = self._build_market_summary(market_totals, total_greeks)
+        market_summary = self._build_market_summary(market_totals, total_greeks, gex_curve['gamma_flip_level_usd'])
 
         output_data = {
             "metadata": {
                 "calculation_timestamp_utc": now_timestamp,
-                "asset": self.currency
+                "asset": self.currency,
+                "source": self.source
             },
             "market_summary": market_summary,
             "volatility_summary": volatility_summary,
             "exposure_by_expiry": exposure_by_expiry_buckets,
             "oi_change_by_strike": oi_change_by_strike,
+            "gex_curve": gex_curve,
             "expirations": expirations_list
         }
 
+        if self.source == 'snapshot':
+            output_data["metadata"]["scenario"] = {"spot_shift": self.spot_shift, "vol_shift": self.vol_shift}
         self._save_json_file(self.output_file, output_data)
-        self._update_historical_data(now_timestamp, market_summary, total_greeks['gamma'])
-
-
-    def _build_expirations_list(self, grouped_options: Dict) -> Tuple[List[Dict], Dict]:
-        expirations_list, market_totals = [], defaultdict(float)
-        for expiry_dt, options_list in sorted(grouped_options.items()):
-            expiry_call_oi = sum(o['oi'] for o in options_list if o['type'] == 'call')
-            expiry_put_oi = sum(o['oi'] for o in options_list if o['type'] == 'put')
-            expiry_total_oi, expiry_volume = expiry_call_oi + expiry_put_oi, sum(o['volume_24h'] for o in options_list)
-
-            market_totals['total_call_oi'] += expiry_call_oi
-            market_totals['total_put_oi'] += expiry_put_oi
-            market_totals['total_oi'] += expiry_total_oi
-            market_totals['total_volume_24h'] += expiry_volume
-            for opt in options_list:
-                if opt['type'] == 'call':
-                    market_totals['total_call_volume_24h'] += opt['volume_24h']
-                else:
-                    market_totals['total_put_volume_24h'] += opt['volume_24h']
-
+        # A replay describes a past (or hypothetical) market, so it must not extend the history
+        if self.source != 'snapshot':
+            self._update_historical_data(now_timestamp, market_summary, total_greeks['gamma'].to_dict())
+
+
+    def _build_expirations_list(self, chain: pd.DataFrame, by_expiry: pd.DataFrame) -> Tuple[List[Dict], Dict]:
+        by_strike = chain.groupby(['expiry', 'strike'])[['call_oi', 'put_oi', 'gamma']].sum()
+        iv_by_strike = chain.groupby(['expiry', 'strike', 'is_call'])['iv'].last().unstack('is_call')
+        surfaces = self._build_volatility_surfaces(iv_by_strike.reindex(columns=[True, False]))
+        totals = by_expiry.sum()
+        market_totals = {
+            'total_call_oi': totals['call_oi'], 'total_put_oi': totals['put_oi'],
+            'total_oi': totals['call_oi'] + totals['put_oi'], 'total_volume_24h': totals['volume_24h'],
+            'total_call_volume_24h': totals['call_volume_24h'], 'total_put_volume_24h': totals['put_volume_24h']
+        }
+        expirations_list = []
+        for expiry_dt, expiry in by_expiry.iterrows():
+            strikes = by_strike.loc[expiry_dt]
+            expiry_call_oi, expiry_put_oi = expiry['call_oi'], expiry['put_oi']
+            expiry_total_oi = expiry_call_oi + expiry_put_oi
             otype = self._get_option_type(expiry_dt)
-            max_pain = self._calculate_max_pain(options_list) if otype in ["Monthly", "Quarterly"] else None
-
-            gex_by_strike = defaultdict(float)
-            for opt in options_list: gex_by_strike[opt['strike']] += opt['contributions']['gamma']
+            max_pain, pain_curve = self._calculate_max_pain(strikes)
 
             expirations_list.append({
                 "expiration_date": expiry_dt.strftime('%Y-%m-%d'), "option_type": otype,
                 f"open_interest_{self.cur_lower}": round(expiry_total_oi, 2),
                 "notional_value_usd": round(expiry_total_oi * self.spot_price, 2),
-                f"total_volume_24h_{self.cur_lower}": round(expiry_volume, 2),
+                f"total_volume_24h_{self.cur_lower}": round(expiry['volume_24h'], 2),
                 "pcr_by_oi": round(expiry_put_oi / expiry_call_oi, 4) if expiry_call_oi > 0 else 0,
                 "max_pain_strike": max_pain,
-                "greeks_summary": self._summarize_greeks_for_expiry(options_list),
-                "open_interest_walls": self._find_oi_walls(options_list),
-                "dealer_gamma_by_strike": sorted([{'strike': s, 'dealer_gamma': g} for s, g in gex_by_strike.items()],
-                                                 key=lambda x: x['strike']),
-                "volatility_surface": self._build_volatility_surface(options_list)
+                "pain_curve": pain_curve,
+                "greeks_summary": self._summarize_greeks_for_expiry(expiry),
+                "open_interest_walls": self._find_oi_walls(strikes),
+                "dealer_gamma_by_strike": [{'strike': s, 'dealer_gamma': g} for s, g in strikes['gamma'].items()],
+                "volatility_surface": surfaces[expiry_dt]
             })
         return expirations_list, market_totals
 
-    def _build_market_summary(self, market_totals: Dict, total_greeks: Dict) -> Dict:
+    def _build_market_summary(self, market_totals: Dict, total_greeks: pd.DataFrame,
+                              gamma_flip: Optional[float]) -> Dict:
         pcr_by_oi = market_totals['total_put_oi'] / market_totals['total_call_oi'] if market_totals[
                                                                                           'total_call_oi'] > 0 else 0
         call_vol, put_vol = market_totals['total_call_volume_24h'], market_totals['total_put_volume_24h']
@@ -249,49 +457,86 @@ class DeribitMarketAnalyzer:
             "total_notional_oi_usd": round(market_totals['total_oi'] * self.spot_price, 2),
             f"total_volume_24h_{self.cur_lower}": round(market_totals['total_volume_24h'], 2),
             "pcr_by_open_interest": round(pcr_by_oi, 4), "pcr_by_24h_volume": pcr_by_24h_volume,
-            "total_dealer_gamma_exposure": round(sum(total_greeks['gamma'].values()) * (self.spot_price**2) / 100, 2),
-            f"total_dealer_delta_exposure_{self.cur_lower}": round(sum(total_greeks['delta'].values()), 2),
-            "total_dealer_vega_exposure_usd": round(sum(total_greeks['vega'].values()) / 100, 2), # Per 1% IV change
-            "total_dealer_theta_exposure_usd": round(sum(total_greeks['theta'].values()), 2),
-            "gamma_flip_level_usd": self._calculate_gamma_flip(total_greeks['gamma'], self.spot_price)
+            "total_dealer_gamma_exposure": round(total_greeks['gamma'].sum() * (self.spot_price**2) / 100, 2),
+            f"total_dealer_delta_exposure_{self.cur_lower}": round(total_greeks['delta'].sum(), 2),
+            "total_dealer_vega_exposure_usd": round(total_greeks['vega'].sum() / 100, 2), # Per 1% IV change
+            "total_dealer_theta_exposure_usd": round(total_greeks['theta'].sum(), 2),
+            "gamma_flip_level_usd": gamma_flip
         }
-    
-    ### NEW ### GEX/DEX by Expiry Buckets
-    def _calculate_exposure_by_expiry(self, grouped_options: Dict) -> List[Dict]:
-        logging.info("Calculating GEX/DEX by expiry buckets...")
-        now = datetime.now(timezone.utc)
-        buckets = {
-            "0DTE": {"gamma": 0.0, "delta": 0.0},
-            "1-7 Days": {"gamma": 0.0, "delta": 0.0},
-            "8-30 Days": {"gamma": 0.0, "delta": 0.0},
-            "30-90 Days": {"gamma": 0.0, "delta": 0.0},
-            "90+ Days": {"gamma": 0.0, "delta": 0.0},
+
+    def _calculate_gex_curve(self, chain: pd.DataFrame) -> Dict:
+        """
+        Dealer GEX (units of total_dealer_gamma_exposure) at every spot on the grid, from one
+        (grid x options) gamma evaluation, and its zero crossings refined inside their brackets.
+        """
+        options = chain[chain['forward'] > 0]
+        grid = self.spot_price * (1.0 + np.linspace(-GEX_CURVE_RANGE, GEX_CURVE_RANGE, GEX_CURVE_POINTS))
+        if options.empty:
+            return {"dealer_sign": GEX_CURVE_DEALER_SIGN, "spot_grid_usd": [], "dealer_gamma_exposure_usd": [],
+                    "zero_crossings_usd": [], "gamma_flip_level_usd": None}
+        inputs = {
+            'forward': options['forward'].to_numpy(),
+            'strike': options['strike'].to_numpy(),
+            'years': ((options['expiry'] - self.as_of).dt.total_seconds() / SECONDS_PER_YEAR).to_numpy(),
+            'iv': options['iv'].to_numpy(),
+            'is_call': options['is_call'].to_numpy(),
+            'rate': options['rate'].to_numpy(),
+        }
+        dealer_oi = options['oi'].to_numpy() * np.where(inputs['is_call'], GEX_CURVE_DEALER_SIGN['call'],
+                                                         GEX_CURVE_DEALER_SIGN['put'])
+
+        def gex_at(spots: np.ndarray) -> np.ndarray:
+            gamma = black76_scenarios(**inputs, spot_moves=spots / self.spot_price - 1.0)['gamma'][:, 0, :]
+            return np.nan_to_num(gamma) @ dealer_oi * spots ** 2 / 100
+
+        curve = gex_at(grid)
+        brackets = np.flatnonzero(np.sign(curve[:-1]) * np.sign(curve[1:]) < 0)
+        crossings = [self._solve_bracketed_root(lambda x: float(gex_at(np.array([x]))[0]),
+                                                grid[i], grid[i + 1], curve[i], curve[i + 1]) for i in brackets]
+        crossings += [float(grid[i]) for i in np.flatnonzero(curve == 0)]
+        crossings.sort()
+        flip = min(crossings, key=lambda x: abs(x - self.spot_price)) if crossings else None
+        logging.info(f"GEX curve: {len(crossings)} zero crossing(s) within +/-{GEX_CURVE_RANGE:.0%} of spot.")
+        return {
+            "dealer_sign": GEX_CURVE_DEALER_SIGN,
+            "spot_grid_usd": [round(float(x), 2) for x in grid],
+            "dealer_gamma_exposure_usd": [round(float(g), 2) for g in curve],
+            "zero_crossings_usd": [round(x, 2) for x in crossings],
+            "gamma_flip_level_usd": round(flip, 2) if flip is not None else None
         }
 
-        for expiry_dt, options_list in grouped_options.items():
-            days_to_expiry = (expiry_dt - now).total_seconds() / 86400
-            
-            summary = self._summarize_greeks_for_expiry(options_list)
-            gex = summary['total_gamma_exposure'] * (self.spot_price**2) / 100 # Notional Gamma
-            dex = summary[f'total_delta_exposure_{self.cur_lower}'] * self.spot_price # Notional Delta
-            
-            if days_to_expiry <= 1:
-                bucket_name = "0DTE"
-            elif 1 < days_to_expiry <= 7:
-                bucket_name = "1-7 Days"
-            elif 7 < days_to_expiry <= 30:
-                bucket_name = "8-30 Days"
-            elif 30 < days_to_expiry <= 90:
-                bucket_name = "30-90 Days"
+    def _solve_bracketed_root(self, f, lo: float, hi: float, f_lo: float, f_hi: float) -> float:
+        """Illinois false position on a sign-changing bracket; converges superlinearly and never leaves it."""
+        tolerance, side, x = GEX_FLIP_TOLERANCE * self.spot_price, 0, lo
+        for _ in range(GEX_FLIP_MAX_ITERATIONS):
+            previous, x = x, (lo * f_hi - hi * f_lo) / (f_hi - f_lo)
+            f_x = f(x)
+            if f_x == 0 or abs(x - previous) < tolerance:
+                break
+            if np.sign(f_x) == np.sign(f_hi):
+                hi, f_hi = x, f_x
+                if side == -1: f_lo /= 2
+                side = -1
             else:
-                bucket_name = "90+ Days"
-            
-            buckets[bucket_name]["gamma"] += gex
-            buckets[bucket_name]["delta"] += dex
+                lo, f_lo = x, f_x
+                if side == 1: f_hi /= 2
+                side = 1
+        return float(x)
+    
+    ### NEW ### GEX/DEX by Expiry Buckets
+    def _calculate_exposure_by_expiry(self, by_expiry: pd.DataFrame) -> List[Dict]:
+        logging.info("Calculating GEX/DEX by expiry buckets...")
+        days_to_expiry = ((by_expiry.index - self.as_of).total_seconds() / 86400).to_numpy()
+        # Each bucket includes its upper bound, e.g. exactly 7 days is still "1-7 Days"
+        bucket = np.searchsorted(list(EXPIRY_BUCKETS.values()), days_to_expiry, side='left')
+        gex = np.bincount(bucket, weights=by_expiry['gamma'].to_numpy() * (self.spot_price**2) / 100,  # Notional Gamma
+                          minlength=len(EXPIRY_BUCKETS))
+        dex = np.bincount(bucket, weights=by_expiry['delta'].to_numpy() * self.spot_price,  # Notional Delta
+                          minlength=len(EXPIRY_BUCKETS))
 
         return [
-            {"bucket": name, "total_gamma_exposure": round(data["gamma"], 2), "total_delta_exposure": round(data["delta"], 2)}
-            for name, data in buckets.items()
+            {"bucket": name, "total_gamma_exposure": round(float(g), 2), "total_delta_exposure": round(float(d), 2)}
+            for name, g, d in zip(EXPIRY_BUCKETS, gex, dex)
         ]
 
     ### NEW ### OI Change by Strike (24h)
@@ -318,7 +563,7 @@ class DeribitMarketAnalyzer:
     ### NEW ### Volatility Summary including 25-delta Skew
     def _calculate_volatility_summary(self, term_days: int = 30) -> Dict:
         logging.info(f"Calculating {term_days}-day 25-delta skew...")
-        now = datetime.now(timezone.utc)
+        now = self.as_of
         target_expiry = now + timedelta(days=term_days)
         
         # Find the expiry date closest to the target term
@@ -382,6 +627,7 @@ class DeribitMarketAnalyzer:
         return interpolated_iv / 100.0 # Return as decimal
 
 
+    @traced('write.history')
     def _update_historical_data(self, timestamp: str, market_summary: Dict, total_gamma_by_strike: Dict):
         key_gamma_data = self._get_key_gamma_strikes_for_history(total_gamma_by_strike)
         new_entry = {
@@ -396,52 +642,55 @@ class DeribitMarketAnalyzer:
             "total_thex": market_summary["total_dealer_theta_exposure_usd"],
             "gamma_flip_level": market_summary["gamma_flip_level_usd"], "per_strike_gamma": key_gamma_data
         }
-        history = []
         if os.path.exists(self.historical_file):
             try:
-                with open(self.historical_file, 'r') as f:
-                    history = json.load(f)
-                if not isinstance(history, list): history = []
-            except (json.JSONDecodeError, IOError):
-                history = []
-        history.append(new_entry)
-        self._save_json_file(self.historical_file, history[-MAX_HISTORY_POINTS:])
+                if self.history.is_empty():
+                    with open(self.historical_file, 'r') as f:
+                        legacy = json.load(f)
+                    if isinstance(legacy, list) and legacy: self.history.import_entries(legacy)
+                os.replace(self.historical_file, self.historical_file + LEGACY_IMPORTED_SUFFIX)
+                logging.info(f"Retired {self.historical_file}: the {self.history.base_dir} store replaces it "
+                             f"(old copy kept as {self.historical_file + LEGACY_IMPORTED_SUFFIX}).")
+            except (json.JSONDecodeError, IOError, KeyError, ValueError) as e:
+                logging.warning(f"Could not import legacy history {self.historical_file}: {e}")
+        self.history.append(new_entry)
+        self.history.compact(self.as_of)
 
     def _save_json_file(self, filename: str, data: Any):
         try:
-            with open(filename, 'w') as f:
+            with span('write.json', file=filename), open(filename, 'w') as f:
                 json.dump(data, f, indent=2)
             logging.info(f"✅ Data successfully saved to {filename}")
         except IOError as e:
             logging.error(f"Could not write to file {filename}. Error: {e}")
 
-    def _find_oi_walls(self, options_list: List[Dict]) -> Dict[str, List[Dict]]:
-        calls, puts = defaultdict(float), defaultdict(float)
-        for opt in options_list: (calls if opt['type'] == 'call' else puts)[opt['strike']] += opt['oi']
-        sorted_calls = sorted(calls.items(), key=lambda i: i[1], reverse=True)
-        sorted_puts = sorted(puts.items(), key=lambda i: i[1], reverse=True)
-        return {"top_call_strikes": [{"strike": k, f"open_interest_{self.cur_lower}": round(v, 2)} for k, v in
-                                     sorted_calls[:TOP_N_OI_WALLS]],
-                "top_put_strikes": [{"strike": k, f"open_interest_{self.cur_lower}": round(v, 2)} for k, v in
-                                    sorted_puts[:TOP_N_OI_WALLS]]}
+    def _find_oi_walls(self, strikes: pd.DataFrame) -> Dict[str, List[Dict]]:
+        walls = {}
+        for side, column in (("top_call_strikes", 'call_oi'), ("top_put_strikes", 'put_oi')):
+            oi = strikes[column].to_numpy()
+            top = [i for i in np.argsort(-oi, kind='stable')[:TOP_N_OI_WALLS] if oi[i] > 0]
+            walls[side] = [{"strike": float(strikes.index[i]), f"open_interest_{self.cur_lower}": round(float(oi[i]), 2)}
+                           for i in top]
+        return walls
 
     @staticmethod
     def _get_definitions() -> Dict[str, str]:
         return {
             "total_dealer_gamma_exposure": "Total Gamma Exposure for dealers. Negative values amplify volatility. Positive values suppress volatility.",
             "total_dealer_delta_exposure": "Total Delta Exposure for dealers, in the base currency (e.g., BTC/ETH).",
-            "gamma_flip_level_usd": "The estimated asset price where total dealer gamma exposure flips sign. A key pivot point for the market's volatility regime.",
+            "gamma_flip_level_usd": "The asset price nearest spot where repriced total dealer gamma exposure crosses zero (see gex_curve). A key pivot point for the market's volatility regime.",
         }
 
-    def _summarize_greeks_for_expiry(self, options_list: List[Dict]) -> Dict:
+    def _summarize_greeks_for_expiry(self, expiry: pd.Series) -> Dict:
         return {
-            f"total_delta_exposure_{self.cur_lower}": round(sum(o['contributions']['delta'] for o in options_list), 2),
-            "total_gamma_exposure": round(sum(o['contributions']['gamma'] for o in options_list), 4),
-            "total_vega_exposure_usd": round(sum(o['contributions']['vega'] for o in options_list), 2),
-            "total_theta_exposure_usd": round(sum(o['contributions']['theta'] for o in options_list), 2),
+            f"total_delta_exposure_{self.cur_lower}": round(expiry['delta'], 2),
+            "total_gamma_exposure": round(expiry['gamma'], 4),
+            "total_vega_exposure_usd": round(expiry['vega'], 2),
+            "total_theta_exposure_usd": round(expiry['theta'], 2),
         }
 
     @staticmethod
+    @lru_cache(maxsize=None)  # Instrument names are re-parsed by several metrics; strptime dominates
     def _parse_instrument(instrument_name: str) -> Optional[Tuple[str, datetime, float, str]]:
         try:
             parts = instrument_name.split('-');
@@ -461,37 +710,34 @@ class DeribitMarketAnalyzer:
         return "Daily"
 
     @staticmethod
-    def _calculate_max_pain(options_list: List[Dict]) -> Optional[float]:
-        if not options_list: return None
-        strikes, (min_pain, max_pain_strike) = sorted(list(set(opt['strike'] for opt in options_list))), (inf, None)
-        for test_price in strikes:
-            pain = sum((test_price - opt['strike']) * opt['oi'] for opt in options_list if
-                       opt['type'] == 'call' and test_price > opt['strike']) + sum(
-                (opt['strike'] - test_price) * opt['oi'] for opt in options_list if
-                opt['type'] == 'put' and test_price < opt['strike'])
-            if pain < min_pain: min_pain, max_pain_strike = pain, test_price
-        return max_pain_strike
-
-    def _calculate_gamma_flip(self, total_gamma_by_strike: Dict[float, float], spot_price: float) -> Optional[float]:
-        if not total_gamma_by_strike: return None
-        cumulative_gamma = sum(total_gamma_by_strike.values())
-        if cumulative_gamma > 0:
-            for strike in sorted(total_gamma_by_strike.keys(), reverse=True):
-                if strike >= spot_price: continue
-                cumulative_gamma -= total_gamma_by_strike[strike]
-                if cumulative_gamma < 0: return strike
-        else:
-            for strike in sorted(total_gamma_by_strike.keys()):
-                if strike <= spot_price: continue
-                cumulative_gamma += total_gamma_by_strike[strike]
-                if cumulative_gamma > 0: return strike
-        return None
+    def _calculate_max_pain(strikes: pd.DataFrame) -> Tuple[Optional[float], List[Dict]]:
+        """
+        Total option payout (USD) if the expiry settles at each listed strike, and the strike where
+        it is smallest, from the expiry's call/put OI per sorted strike. Prefix sums make this linear:
+        calls pay P*sum(OI) - sum(OI*K) over strikes below P, puts sum(OI*K) - P*sum(OI) above it.
+        """
+        if strikes.empty: return None, []
+        strike = strikes.index.to_numpy(dtype=float)
+        call_oi, put_oi = strikes['call_oi'].to_numpy(), strikes['put_oi'].to_numpy()
+        # Cumulative sums over strikes strictly below each strike (calls)...
+        calls_below_oi = np.concatenate(([0.0], np.cumsum(call_oi)[:-1]))
+        calls_below_value = np.concatenate(([0.0], np.cumsum(call_oi * strike)[:-1]))
+        # ...and strictly above it (puts)
+        puts_above_oi = np.concatenate((np.cumsum(put_oi[::-1])[::-1][1:], [0.0]))
+        puts_above_value = np.concatenate((np.cumsum((put_oi * strike)[::-1])[::-1][1:], [0.0]))
+        pain = (strike * calls_below_oi - calls_below_value) + (puts_above_value - strike * puts_above_oi)
+        pain_curve = [{'strike': float(k), 'payout_usd': round(float(p), 2)} for k, p in zip(strike, pain)]
+        return float(strike[np.argmin(pain)]), pain_curve
 
     @staticmethod
-    def _build_volatility_surface(options_list: List[Dict]) -> List[Dict]:
-        surface = defaultdict(lambda: {'call_iv': None, 'put_iv': None})
-        for opt in options_list: surface[opt['strike']][f"{opt['type']}_iv"] = round(opt['iv'], 4)
-        return [{"strike": s, **ivs} for s, ivs in sorted(surface.items())]
+    def _build_volatility_surfaces(iv_by_strike: pd.DataFrame) -> Dict[datetime, List[Dict]]:
+        """Call and put IV per strike for every expiry, from the ((expiry, strike) x is_call) IV table."""
+        surfaces = defaultdict(list)
+        ivs = iv_by_strike.round(4)
+        for (expiry_dt, strike), call_iv, put_iv in zip(ivs.index, ivs[True], ivs[False]):
+            surfaces[expiry_dt].append({"strike": strike, "call_iv": None if np.isnan(call_iv) else call_iv,
+                                        "put_iv": None if np.isnan(put_iv) else put_iv})
+        return surfaces
 
     def _get_key_gamma_strikes_for_history(self, total_gamma_by_strike: Dict) -> Dict[str, float]:
         short_gamma = [{'s': s, 'dist': abs(s - self.spot_price)} for s, g in total_gamma_by_strike.items() if g < 0]
@@ -506,17 +752,35 @@ def main():
         description="Fetch and analyze Deribit options market data for multiple currencies.")
     parser.add_argument('-c', '--currencies', nargs='+', default=TARGET_CURRENCIES,
                         help=f"Space-separated list of currencies to analyze (e.g., BTC ETH). Default: {' '.join(TARGET_CURRENCIES)}")
+    parser.add_argument('-s', '--source', choices=['bulk', 'ticker', 'snapshot'], default=SNAPSHOT_SOURCE,
+                        help="'bulk': one book-summary call per currency with locally computed greeks; "
+                             "'ticker': one ticker call per instrument with exchange greeks; "
+                             "'snapshot': recompute offline from the last stored chain snapshot.")
+    parser.add_argument('--spot-shift', type=float, default=0.0,
+                        help="Snapshot scenario: relative move of spot and forwards (0.05 = +5%%).")
+    parser.add_argument('--vol-shift', type=float, default=0.0,
+                        help="Snapshot scenario: absolute IV change as a decimal (0.05 = +5 vol points).")
+    parser.add_argument('--as-of', type=datetime.fromisoformat, default=None,
+                        help="Snapshot source: replay the last archived chain at or before this ISO time (UTC if no offset).")
     args = parser.parse_args()
+    if args.as_of is not None and args.as_of.tzinfo is None:
+        args.as_of = args.as_of.replace(tzinfo=timezone.utc)
+    if args.source != 'snapshot' and (args.spot_shift or args.vol_shift or args.as_of):
+        parser.error("--spot-shift/--vol-shift/--as-of only apply to --source snapshot")
     for currency in args.currencies:
         try:
-            output_file = DEFAULT_OUTPUT_TEMPLATE.format(currency=currency.lower())
+            template = SCENARIO_OUTPUT_TEMPLATE if args.source == 'snapshot' else DEFAULT_OUTPUT_TEMPLATE
+            output_file = template.format(currency=currency.lower())
             historical_file = DEFAULT_HISTORICAL_TEMPLATE.format(currency=currency.lower())
-            analyzer = DeribitMarketAnalyzer(currency, output_file, historical_file)
+            analyzer = DeribitMarketAnalyzer(currency, output_file, historical_file, source=args.source,
+                                             spot_shift=args.spot_shift, vol_shift=args.vol_shift,
+                                             replay_as_of=args.as_of)
             analyzer.run_analysis()
         except SystemExit as e:
             logging.critical(f"Execution halted for {currency}: {e}")
         except Exception as e:
             logging.exception(f"An unexpected error occurred during analysis for {currency}: {e}")
+    write_run_metrics('option-open-interest-json')
 
 
 if __name__ == "__main__":
@@ -0,0 +1,151 @@
+# filename: options_history.py
+#
+# Append-only history of the options market summary, one store per currency. Each run adds
+# a one-row Parquet segment under `hot/` (O(1), nothing is rewritten); compaction later folds
+# closed UTC days into `15m/<day>.parquet` and, past the full-resolution window, downsamples
+# them into `1h/<month>.parquet`. Range reads only open the segments whose name overlaps.
+
+import os
+import json
+import glob
+import logging
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any
+
+import pandas as pd
+
+from clock import utc_now
+
+# --- Configuration ---
+HISTORY_DIR = "options_history"
+HISTORY_FULL_RES_DAYS = 7  # Every snapshot (one per 15m refresh) is kept this long...
+HISTORY_HOURLY_DAYS = 365  # ...then the last snapshot of each hour, this long
+DOWNSAMPLE_FREQ = 'h'
+# Reading many one-row files costs ~1 ms each, so today's segments are folded early past this count
+HOT_MAX_SEGMENTS = 8
+# Variable-keyed fields are stored as JSON text so every segment keeps the same schema
+JSON_COLUMNS = ['per_strike_gamma']
+
+HOT, FULL_RES, HOURLY = 'hot', '15m', '1h'
+
+
+class OptionsHistoryStore:
+    def __init__(self, currency: str, root_dir: str = HISTORY_DIR):
+        self.currency = currency.upper()
+        self.base_dir = os.path.join(root_dir, currency.lower())
+
+    # --- Writes ---
+    def append(self, entry: Dict[str, Any]):
+        """Stores one summary entry (a dict with an ISO `timestamp`) as its own segment."""
+        frame = self._to_frame([entry])
+        timestamp = frame['timestamp'].iloc[0]
+        self._write(frame, self._path(HOT, timestamp.strftime('%Y%m%dT%H%M%S%f')))
+
+    def import_entries(self, entries: List[Dict[str, Any]]):
+        """Bulk-loads entries (e.g. the old JSON history) straight into the full-resolution tier."""
+        frame = self._to_frame(entries)
+        for day, rows in frame.groupby(frame['timestamp'].dt.strftime('%Y-%m-%d')):
+            self._merge_into(self._path(FULL_RES, day), rows)
+        logging.info(f"[{self.currency}] Imported {len(frame)} history entries.")
+
+    def compact(self, now: Optional[datetime] = None):
+        """
+        Folds hot segments into daily files (closed UTC days, or all once there are more than
+        HOT_MAX_SEGMENTS), downsamples daily files older than HISTORY_FULL_RES_DAYS into monthly
+        hourly files, and drops hourly rows past retention.
+        """
+        now = pd.Timestamp(now or utc_now())
+        today = now.strftime('%Y-%m-%d')
+        hot_segments = self._segments(HOT)
+        hot_by_day: Dict[str, List[str]] = {}
+        for path in hot_segments:
+            day = datetime.strptime(self._name(path)[:8], '%Y%m%d').strftime('%Y-%m-%d')
+            if day < today or len(hot_segments) > HOT_MAX_SEGMENTS:
+                hot_by_day.setdefault(day, []).append(path)
+        for day, paths in hot_by_day.items():
+            self._merge_into(self._path(FULL_RES, day), pd.read_parquet(paths))
+            for path in paths:
+                os.remove(path)
+
+        full_res_cutoff = (now - timedelta(days=HISTORY_FULL_RES_DAYS)).strftime('%Y-%m-%d')
+        for path in self._segments(FULL_RES):
+            if self._name(path) >= full_res_cutoff:
+                continue
+            frame = pd.read_parquet(path)
+            hourly = frame.groupby(frame['timestamp'].dt.floor(DOWNSAMPLE_FREQ), sort=True).tail(1)
+            self._merge_into(self._path(HOURLY, self._name(path)[:7]), hourly)
+            os.remove(path)
+
+        hourly_cutoff = now - timedelta(days=HISTORY_HOURLY_DAYS)
+        for path in self._segments(HOURLY):
+            if self._name(path) > hourly_cutoff.strftime('%Y-%m'):
+                continue
+            frame = pd.read_parquet(path)
+            frame = frame[frame['timestamp'] >= hourly_cutoff]
+            if frame.empty:
+                os.remove(path)
+            else:
+                self._write(frame, path)
+        if hot_by_day:
+            logging.info(f"[{self.currency}] Compacted {sum(map(len, hot_by_day.values()))} history segment(s).")
+
+    # --- Reads ---
+    def read(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> pd.DataFrame:
+        """Entries with start <= timestamp <= end (either bound optional), oldest first."""
+        start = pd.Timestamp(start) if start is not None else None
+        end = pd.Timestamp(end) if end is not None else None
+        frames = []
+        for tier, key_format in ((HOURLY, '%Y-%m'), (FULL_RES, '%Y-%m-%d'), (HOT, '%Y%m%dT%H%M%S%f')):
+            # Segment names sort like the time range they cover, so out-of-range files are skipped unread
+            paths = [path for path in self._segments(tier)
+                     if (start is None or self._name(path) >= start.strftime(key_format))
+                     and (end is None or self._name(path) <= end.strftime(key_format))]
+            if paths:
+                frames.append(pd.read_parquet(paths))
+        if not frames:
+            return self._to_frame([])
+        frame = pd.concat(frames).drop_duplicates('timestamp', keep='last').sort_values('timestamp')
+        if start is not None:
+            frame = frame[frame['timestamp'] >= start]
+        if end is not None:
+            frame = frame[frame['timestamp'] <= end]
+        for column in JSON_COLUMNS:
+            frame[column] = frame[column].map(json.loads)
+        return frame.reset_index(drop=True)
+
+    def is_empty(self) -> bool:
+        return not any(self._segments(tier) for tier in (HOT, FULL_RES, HOURLY))
+
+    # --- Segment files ---
+    def _path(self, tier: str, name: str) -> str:
+        return os.path.join(self.base_dir, tier, f"{name}.parquet")
+
+    def _segments(self, tier: str) -> List[str]:
+        return sorted(glob.glob(os.path.join(self.base_dir, tier, "*.parquet")))
+
+    @staticmethod
+    def _name(path: str) -> str:
+        return os.path.splitext(os.path.basename(path))[0]
+
+    @staticmethod
+    def _to_frame(entries: List[Dict[str, Any]]) -> pd.DataFrame:
+        frame = pd.DataFrame(entries, columns=list(entries[0]) if entries else ['timestamp', *JSON_COLUMNS])
+        frame['timestamp'] = pd.to_datetime(frame['timestamp'], utc=True, format='ISO8601').dt.as_unit('us')
+        for column in frame.columns:
+            if column in JSON_COLUMNS:
+                frame[column] = frame[column].map(json.dumps)
+            elif column != 'timestamp':
+                frame[column] = pd.to_numeric(frame[column]).astype(float)  # None -> NaN keeps the dtype fixed
+        return frame
+
+    def _merge_into(self, path: str, frame: pd.DataFrame):
+        if os.path.exists(path):
+            frame = pd.concat([pd.read_parquet(path), frame])
+        self._write(frame.drop_duplicates('timestamp', keep='last').sort_values('timestamp'), path)
+
+    @staticmethod
+    def _write(frame: pd.DataFrame, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        frame.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, path)
@@ -0,0 +1,471 @@
+# filename: replay_server.py
+#
+# Local stand-in for the Binance and Deribit REST APIs, so the whole pipeline can be run and
+# timed offline. Every fetcher reads its base URL from the environment (BINANCE_API_URL in
+# kline_store.py, DERIBIT_API_URL in option-open-interest-json.py), so no script changes are
+# needed to point it here.
+#
+#   record  forwards each request upstream and appends the response to <dir>/responses.jsonl
+#   replay  serves the recording back, with optional latency, injected 429s and smaller pages
+#   check   fetches every recorded kline series with full and with --page-size pages; the frames must match
+#
+# Usage:
+#   python replay_server.py record --dir recordings/run1 -- python3 generate_accurate_ma.py
+#   python replay_server.py replay --dir recordings/run1 --latency-ms 80 --rate-limit-rate 0.05 \
+#       -- python3 option-open-interest-json.py
+#   python replay_server.py check --dir recordings/run1 --page-size 500
+# Without a command the server runs until interrupted and prints the environment to export.
+#
+# A command never runs in the caller's directory: the scripts keep their caches and stores in
+# the working directory, so a run there would move them forward (and a replay would append
+# fake snapshots to the real history). The first record into <dir> copies STATE_PATHS from the
+# caller's directory to <dir>/state/; every record and replay then runs in a fresh temporary
+# copy of that snapshot, so each replay starts from the state the recording was made from.
+# The snapshot time is kept in <dir>/recording.json and exported as ANALYSIS_NOW_UTC (clock.py),
+# so recorded and replayed runs also share one "now" for candle freshness, greeks and state age.
+
+import os
+import sys
+import json
+import time
+import glob
+import random
+import shutil
+import tempfile
+import logging
+import argparse
+import threading
+import subprocess
+from collections import deque
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from typing import Optional, Dict, List, Tuple, Any
+from urllib.parse import urlsplit, parse_qsl
+
+import requests
+
+from clock import FROZEN_NOW_ENV, utc_now
+
+# --- Configuration ---
+UPSTREAMS = {
+    'binance': "https://api.binance.com",
+    'deribit': "https://www.deribit.com",
+}
+# Environment variable and path (below the upstream prefix) each fetcher uses as its base URL
+CLIENT_BASE_PATHS = {
+    'BINANCE_API_URL': ('binance', "/api/v3"),
+    'DERIBIT_API_URL': ('deribit', "/api/v2/public/"),
+}
+RECORDING_FILE = "responses.jsonl"
+# Caches and stores the scripts read and write in their working directory (kline_store.py,
+# s_signal_analysis.py, volume-profile.py, options_history.py, chain_archive.py)
+STATE_PATHS = ('warmup_ohlc_data_fixed', 'signal_state', 'volume_profile_state', 'options_history',
+               'options_chain_archive')
+STATE_DIR = "state"
+RECORDING_META_FILE = "recording.json"
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+CHECK_PAGE_SIZE = 500
+UPSTREAM_TIMEOUT = 30
+# Response headers worth keeping in a recording (the rest are connection details)
+RECORDED_HEADERS = ('Content-Type', 'X-MBX-USED-WEIGHT-1M', 'Retry-After')
+
+# Binance /klines semantics the replay reproduces
+KLINES_PATH = "/api/v3/klines"
+KLINE_DEFAULT_LIMIT = 500
+KLINE_MAX_LIMIT = 1000
+KLINE_REQUEST_WEIGHT = 2
+USED_WEIGHT_HEADER = 'X-MBX-USED-WEIGHT-1M'
+WEIGHT_WINDOW_SECONDS = 60
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+RequestKey = Tuple[str, str, Tuple[Tuple[str, str], ...]]
+
+
+def request_key(upstream: str, path: str, params: Dict[str, str]) -> RequestKey:
+    return upstream, path, tuple(sorted((str(k), str(v)) for k, v in params.items()))
+
+
+class Recording:
+    """
+    A directory of recorded responses. Klines are also merged into one candle series per
+    (symbol, interval), so a replay can answer any time window the recording covers, not
+    just the exact pages that were requested (KlineStore pages end at "now", which moves).
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.path = os.path.join(directory, RECORDING_FILE)
+        self.responses: Dict[RequestKey, Dict[str, Any]] = {}
+        self.klines: Dict[Tuple[str, str], Dict[int, List[Any]]] = {}
+        self._sorted_klines: Dict[Tuple[str, str], List[List[Any]]] = {}
+        self._lock = threading.Lock()
+
+    def load(self) -> "Recording":
+        if not os.path.exists(self.path):
+            logging.warning(f"No recording at '{self.path}'; every request will be a miss.")
+            return self
+        with open(self.path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    self._index(json.loads(line))
+        logging.info(f"Loaded {len(self.responses)} recorded responses "
+                     f"({sum(map(len, self.klines.values()))} candles) from '{self.path}'.")
+        return self
+
+    def add(self, upstream: str, path: str, params: Dict[str, str], status: int, headers: Dict[str, str], body: str):
+        entry = {'upstream': upstream, 'path': path, 'params': params, 'status': status,
+                 'headers': headers, 'body': body}
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+            self._index(entry)
+
+    def _index(self, entry: Dict[str, Any]):
+        self.responses[request_key(entry['upstream'], entry['path'], entry['params'])] = entry
+        if entry['upstream'] == 'binance' and entry['path'] == KLINES_PATH and entry['status'] == 200:
+            series = self.klines.setdefault((entry['params'].get('symbol'), entry['params'].get('interval')), {})
+            for row in json.loads(entry['body']):
+                series[int(row[0])] = row
+            self._sorted_klines.pop((entry['params'].get('symbol'), entry['params'].get('interval')), None)
+
+    def lookup(self, upstream: str, path: str, params: Dict[str, str]) -> Optional[Dict[str, Any]]:
+        return self.responses.get(request_key(upstream, path, params))
+
+    def kline_page(self, params: Dict[str, str], page_size: Optional[int]) -> Optional[List[List[Any]]]:
+        """Candles of the recorded series inside [startTime, endTime], capped like Binance's `limit`."""
+        key = (params.get('symbol'), params.get('interval'))
+        if key not in self.klines:
+            return None
+        with self._lock:
+            if key not in self._sorted_klines:
+                self._sorted_klines[key] = [self.klines[key][t] for t in sorted(self.klines[key])]
+            rows = self._sorted_klines[key]
+        start = int(params.get('startTime', 0))
+        end = int(params.get('endTime', sys.maxsize))
+        limit = min(int(params.get('limit', KLINE_DEFAULT_LIMIT)), KLINE_MAX_LIMIT)
+        if page_size:
+            limit = min(limit, page_size)
+        if 'startTime' not in params and 'endTime' in params:
+            selected = [row for row in rows if row[0] <= end][-limit:]  # Binance returns the newest then
+        else:
+            selected = [row for row in rows if start <= row[0] <= end][:limit]
+        return selected
+
+
+class ReplayServer:
+    """
+    Threaded HTTP server routing /binance/... and /deribit/... to a recording. Replay knobs:
+    `latency_ms` (+ uniform `jitter_ms`) per response, `rate_limit_rate` chance of a 429 with
+    Retry-After, `weight_limit` to enforce Binance's per-minute request weight, and `page_size`
+    to serve fewer candles per /klines call than asked for. `seed` makes the 429s reproducible.
+    """
+
+    def __init__(self, directory: str, mode: str = 'replay', host: str = DEFAULT_HOST, port: int = DEFAULT_PORT,
+                 latency_ms: float = 0.0, jitter_ms: float = 0.0, rate_limit_rate: float = 0.0,
+                 retry_after: int = 1, weight_limit: int = 0, page_size: Optional[int] = None, seed: int = 0):
+        if mode not in ('record', 'replay'):
+            raise ValueError(f"Unknown mode '{mode}'")
+        self.mode = mode
+        self.recording = Recording(directory)
+        if mode == 'replay':
+            self.recording.load()
+        self.latency_ms, self.jitter_ms = latency_ms, jitter_ms
+        self.rate_limit_rate, self.retry_after = rate_limit_rate, retry_after
+        self.weight_limit, self.page_size = weight_limit, page_size
+        self.random = random.Random(seed)
+        self.upstream_session = requests.Session() if mode == 'record' else None
+        self.stats = {'requests': 0, 'served': 0, 'misses': 0, 'rate_limited': 0, 'upstream_errors': 0}
+        self._weight_log: deque = deque()
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), self._handler_class())
+        self.httpd.daemon_threads = True
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def client_env(self) -> Dict[str, str]:
+        """Environment that points every fetcher at this server."""
+        return {name: f"{self.url}/{upstream}{path}" for name, (upstream, path) in CLIENT_BASE_PATHS.items()}
+
+    def start(self) -> "ReplayServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        logging.info(f"{self.mode.capitalize()} server listening on {self.url} ({self.recording.directory}).")
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        logging.info(f"{self.mode.capitalize()} server stopped: {self.stats}")
+
+    # --- Request handling ---
+    def _handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                status, headers, body = server.handle(self.path)
+                payload = body.encode('utf-8')
+                self.send_response(status)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logging.debug(f"{self.address_string()} {format % args}")
+
+        return Handler
+
+    def handle(self, raw_path: str) -> Tuple[int, Dict[str, str], str]:
+        split = urlsplit(raw_path)
+        upstream, _, path = split.path.lstrip('/').partition('/')
+        path = '/' + path
+        params = dict(parse_qsl(split.query, keep_blank_values=True))
+        with self._lock:
+            self.stats['requests'] += 1
+        if upstream not in UPSTREAMS:
+            return self._error(404, f"Unknown upstream '{upstream}'; expected one of {sorted(UPSTREAMS)}")
+        if self.mode == 'record':
+            return self._forward(upstream, path, params)
+
+        self._sleep()
+        headers = {'Content-Type': 'application/json'}
+        if upstream == 'binance':
+            used_weight = self._use_weight(KLINE_REQUEST_WEIGHT if path == KLINES_PATH else 1)
+            headers[USED_WEIGHT_HEADER] = str(used_weight)
+            if self.weight_limit and used_weight > self.weight_limit:
+                return self._rate_limited(headers)
+        if self.rate_limit_rate and self._roll() < self.rate_limit_rate:
+            return self._rate_limited(headers)
+
+        if upstream == 'binance' and path == KLINES_PATH:
+            rows = self.recording.kline_page(params, self.page_size)
+            if rows is not None:
+                self._count('served')
+                return 200, headers, json.dumps(rows)
+        entry = self.recording.lookup(upstream, path, params)
+        if entry is None:
+            self._count('misses')
+            logging.warning(f"No recorded response for {upstream}{path} {params}")
+            return self._error(404, f"Not recorded: {upstream}{path}")
+        self._count('served')
+        return entry['status'], {**entry['headers'], **headers}, entry['body']
+
+    def _forward(self, upstream: str, path: str, params: Dict[str, str]) -> Tuple[int, Dict[str, str], str]:
+        try:
+            response = self.upstream_session.get(UPSTREAMS[upstream] + path, params=params, timeout=UPSTREAM_TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            self._count('upstream_errors')
+            return self._error(502, f"Upstream request failed: {e}")
+        headers = {name: response.headers[name] for name in RECORDED_HEADERS if name in response.headers}
+        # Only successes are recorded; a replay injects its own errors
+        if response.status_code == 200:
+            self.recording.add(upstream, path, params, response.status_code, headers, response.text)
+            self._count('served')
+        else:
+            self._count('upstream_errors')
+        return response.status_code, headers, response.text
+
+    def _rate_limited(self, headers: Dict[str, str]) -> Tuple[int, Dict[str, str], str]:
+        self._count('rate_limited')
+        headers = {**headers, 'Retry-After': str(self.retry_after)}
+        return 429, headers, json.dumps({'code': -1003, 'msg': "Too many requests (injected by replay server)."})
+
+    @staticmethod
+    def _error(status: int, message: str) -> Tuple[int, Dict[str, str], str]:
+        return status, {'Content-Type': 'application/json'}, json.dumps({'error': message})
+
+    def _sleep(self):
+        delay = self.latency_ms
+        if self.jitter_ms:
+            delay += self._roll() * self.jitter_ms
+        if delay > 0:
+            time.sleep(delay / 1000.0)
+
+    def _roll(self) -> float:
+        with self._lock:
+            return self.random.random()
+
+    def _use_weight(self, weight: int) -> int:
+        """Adds `weight` to the rolling one-minute window and returns the window's total."""
+        now = time.monotonic()
+        with self._lock:
+            self._weight_log.append((now, weight))
+            while self._weight_log and self._weight_log[0][0] <= now - WEIGHT_WINDOW_SECONDS:
+                self._weight_log.popleft()
+            return sum(w for _, w in self._weight_log)
+
+    def _count(self, name: str):
+        with self._lock:
+            self.stats[name] += 1
+
+
+def snapshot_state(source_dir: str, state_dir: str):
+    """Copies the STATE_PATHS found in `source_dir` to `state_dir` (written once per recording)."""
+    tmp_dir = state_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    for pattern in STATE_PATHS:
+        for path in glob.glob(os.path.join(source_dir, pattern)):
+            target = os.path.join(tmp_dir, os.path.basename(path))
+            if os.path.isdir(path):
+                shutil.copytree(path, target)
+            else:
+                shutil.copy2(path, target)
+    os.replace(tmp_dir, state_dir)
+    logging.info(f"Snapshot of {sorted(os.listdir(state_dir))} from '{source_dir}' saved to '{state_dir}'.")
+
+
+def recorded_at(directory: str) -> Optional[str]:
+    """The frozen "now" (ISO-8601 UTC) of a recording, set when its state snapshot was taken."""
+    path = os.path.join(directory, RECORDING_META_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f).get('recorded_at')
+
+
+def _write_recorded_at(directory: str, timestamp: str):
+    path = os.path.join(directory, RECORDING_META_FILE)
+    with open(path + ".tmp", 'w') as f:
+        json.dump({'recorded_at': timestamp}, f)
+    os.replace(path + ".tmp", path)
+
+
+def _resolve_command(command: List[str], base_dir: str) -> List[str]:
+    """Makes arguments naming existing files in `base_dir` absolute, so `python3 script.py` still finds the script."""
+    return [os.path.abspath(os.path.join(base_dir, arg)) if os.path.exists(os.path.join(base_dir, arg)) else arg
+            for arg in command]
+
+
+def run_command(server: ReplayServer, command: List[str], source_dir: Optional[str] = None,
+                keep_workdir: bool = False) -> int:
+    """
+    Runs `command` with the fetchers pointed at `server`, in a temporary copy of the recording's
+    state snapshot, and returns its exit code. Recording into a directory without a snapshot
+    first takes one from `source_dir` (default: the current directory).
+    """
+    source_dir = os.path.abspath(source_dir or os.getcwd())
+    state_dir = os.path.join(server.recording.directory, STATE_DIR)
+    if not os.path.isdir(state_dir):
+        if server.mode == 'record':
+            snapshot_state(source_dir, state_dir)
+            _write_recorded_at(server.recording.directory, utc_now().isoformat())
+        else:
+            logging.warning(f"Recording has no state snapshot at '{state_dir}'; replaying from empty caches.")
+    frozen_now = recorded_at(server.recording.directory)
+    workdir = tempfile.mkdtemp(prefix=f"{server.mode}_")
+    if os.path.isdir(state_dir):
+        shutil.copytree(state_dir, workdir, dirs_exist_ok=True)
+    command = _resolve_command(command, source_dir)
+    env = {**os.environ, **server.client_env()}
+    if frozen_now:
+        env[FROZEN_NOW_ENV] = frozen_now
+    else:
+        logging.warning(f"Recording has no {RECORDING_META_FILE}; the command runs on the wall clock.")
+    start = time.perf_counter()
+    try:
+        exit_code = subprocess.call(command, env=env, cwd=workdir)
+    finally:
+        if keep_workdir:
+            logging.info(f"Working directory kept at '{workdir}'.")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    logging.info(f"'{' '.join(command)}' exited with {exit_code} after {time.perf_counter() - start:.2f}s.")
+    return exit_code
+
+
+def check_pagination(directory: str, page_size: int = CHECK_PAGE_SIZE) -> bool:
+    """
+    Downloads every recorded kline series through AsyncKlineDownloader from two replays, one
+    serving full pages and one capped at `page_size` candles, and checks the frames are equal.
+    """
+    from kline_store import AsyncKlineDownloader, parse_klines
+    recording = Recording(directory).load()
+    full = ReplayServer(directory, port=0).start()
+    paged = ReplayServer(directory, port=0, page_size=page_size).start()
+    ok = True
+    try:
+        for (symbol, interval), series in sorted(recording.klines.items()):
+            start_ms, end_ms = min(series), max(series)
+            frames = []
+            for server in (full, paged):
+                with requests.Session() as session:
+                    downloader = AsyncKlineDownloader(session, base_url=server.client_env()['BINANCE_API_URL'])
+                    klines = downloader.fetch(symbol, interval, start_ms, end_ms)
+                frames.append(parse_klines(klines) if klines is not None else None)
+            if frames[0] is None or frames[1] is None or not frames[0].equals(frames[1]):
+                ok = False
+                logging.error(f"[{symbol}/{interval}] Page size {page_size} returned "
+                              f"{len(frames[1]) if frames[1] is not None else 'no'} candles, full pages "
+                              f"{len(frames[0]) if frames[0] is not None else 'no'}; the frames differ.")
+            else:
+                logging.info(f"[{symbol}/{interval}] {len(frames[0])} candles identical with page size {page_size}.")
+    finally:
+        full.stop()
+        paged.stop()
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Record or replay Binance/Deribit API responses locally.",
+                                     usage="%(prog)s {record,replay,check} --dir DIR [options] [-- command ...]")
+    parser.add_argument('mode', choices=['record', 'replay', 'check'])
+    parser.add_argument('--dir', required=True, help="Recording directory.")
+    parser.add_argument('--host', default=DEFAULT_HOST)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="0 picks a free port.")
+    parser.add_argument('--latency-ms', type=float, default=0.0, help="Added delay per replayed response.")
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help="Extra uniform random delay on top.")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Share of requests answered with 429.")
+    parser.add_argument('--retry-after', type=int, default=1, help="Retry-After seconds on injected 429s.")
+    parser.add_argument('--weight-limit', type=int, default=0,
+                        help="Binance request weight per minute before 429s (0 disables).")
+    parser.add_argument('--page-size', type=int, default=None,
+                        help=f"Max candles per /klines response (check mode default: {CHECK_PAGE_SIZE}).")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for jitter and injected 429s.")
+    parser.add_argument('--state-from', default=None,
+                        help="Directory the first record snapshots caches and stores from (default: current).")
+    parser.add_argument('--keep-workdir', action='store_true',
+                        help="Keep the command's temporary working directory (and its outputs).")
+    # Anything after '--' is a command to run against the server, which stops when it exits
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args, command = parser.parse_args(argv[:split]), argv[split + 1:]
+    if args.mode == 'check':
+        sys.exit(0 if check_pagination(args.dir, args.page_size or CHECK_PAGE_SIZE) else 1)
+
+    server = ReplayServer(args.dir, mode=args.mode, host=args.host, port=args.port, latency_ms=args.latency_ms,
+                          jitter_ms=args.jitter_ms, rate_limit_rate=args.rate_limit_rate,
+                          retry_after=args.retry_after, weight_limit=args.weight_limit,
+                          page_size=args.page_size, seed=args.seed).start()
+    exit_code = 0
+    try:
+        if command:
+            exit_code = run_command(server, command, source_dir=args.state_from, keep_workdir=args.keep_workdir)
+        else:
+            env = server.client_env()
+            if recorded_at(args.dir):
+                env[FROZEN_NOW_ENV] = recorded_at(args.dir)
+            for name, value in env.items():
+                print(f"export {name}={value}")
+            logging.info("Run the scripts from a scratch copy of the caches and stores, not from the repo.")
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
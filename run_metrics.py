@@ -0,0 +1,242 @@
+# filename: run_metrics.py
+#
+# Stage tracing for the analysis scripts. Stages are wrapped in `span(name)` blocks (or the
+# `traced(name)` decorator); names start with their kind - fetch., read., parse., compute.,
+# write. - so a slow refresh can be pinned on pagination, DataFrame building, clustering or
+# JSON dumping. Fetchers report `count(requests=1, bytes_downloaded=n, retries=1)` into the
+# innermost open span and every span around it; `rows` stays with the span that processed them.
+#
+# Each script calls `write_run_metrics(<script>)` at the end. run_metrics.json keeps the latest
+# report of every script plus `traceEvents`, so the same file also opens in chrome://tracing
+# or Perfetto with all scripts on one timeline. Worker processes (the parallel S/R jobs) wrap
+# their job in `capture_spans()` and return the spans with the result; the parent passes them
+# to `merge_spans`, which nests them under its span around the pool, each under its worker pid.
+
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import threading
+import contextvars
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Optional, List, Dict, Any, Iterator
+
+# --- Configuration ---
+RUN_METRICS_FILE = "run_metrics.json"
+COUNTERS = ('requests', 'bytes_downloaded', 'retries', 'rows')
+# Network costs add up through the enclosing spans and into the run totals
+ROLLUP_COUNTERS = ('requests', 'bytes_downloaded', 'retries')
+
+
+class Span:
+    __slots__ = ('name', 'parent', 'start', 'end', 'thread', 'pid', 'counters', 'attrs')
+
+    def __init__(self, name: str, parent: Optional["Span"], attrs: Dict[str, Any]):
+        self.name = name
+        self.parent = parent
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        self.thread = threading.get_ident()
+        self.pid = os.getpid()
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.attrs = attrs
+
+    def count(self, **amounts: int):
+        """Adds to this span's counters; ROLLUP_COUNTERS also to every span around it."""
+        for key, amount in amounts.items():
+            span = self
+            while span is not None:
+                span.counters[key] = span.counters.get(key, 0) + amount
+                span = span.parent if key in ROLLUP_COUNTERS else None
+
+
+class Tracer:
+    def __init__(self):
+        self.started = datetime.now(timezone.utc)
+        self.origin = time.perf_counter()
+        self.spans: List[Span] = []
+        self.totals = dict.fromkeys(ROLLUP_COUNTERS, 0)
+        self._current: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+        self._open: List[Span] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name: str, **attrs) -> Iterator[Span]:
+        """Times the block as one span, nested under the span that is current where it opens."""
+        span = Span(name, self._current.get(), attrs)
+        token = self._current.set(span)
+        with self._lock:
+            self._open.append(span)
+        try:
+            yield span
+        finally:
+            span.end = time.perf_counter()
+            self._current.reset(token)
+            with self._lock:
+                self._open.remove(span)
+                self.spans.append(span)
+
+    def traced(self, name: Optional[str] = None):
+        """Decorator form of `span`; the span is named after the function unless `name` is given."""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name or func.__name__):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, **amounts: int):
+        """
+        Adds to the run totals and the current span. Plain worker threads carry no span context,
+        so their counts go to the newest span still open anywhere (e.g. the one around the pool).
+        """
+        with self._lock:
+            for key, amount in amounts.items():
+                if key in ROLLUP_COUNTERS:
+                    self.totals[key] = self.totals.get(key, 0) + amount
+            span = self._current.get() or (self._open[-1] if self._open else None)
+            if span is not None:
+                span.count(**amounts)
+
+    # --- Worker processes ---
+    def _epoch(self, t: float) -> float:
+        return self.started.timestamp() + (t - self.origin)
+
+    @contextmanager
+    def capture_spans(self) -> Iterator[List[Dict[str, Any]]]:
+        """
+        For worker processes: yields a list that, once the block exits, holds every span closed in
+        it as picklable dicts (epoch-second times, so they line up with the parent's clock). The
+        block's spans are roots, even in a forked worker that inherited the parent's open spans.
+        """
+        captured: List[Dict[str, Any]] = []
+        with self._lock:
+            mark = len(self.spans)
+        token = self._current.set(None)
+        try:
+            yield captured
+        finally:
+            self._current.reset(token)
+            with self._lock:
+                spans, self.spans = self.spans[mark:], self.spans[:mark]
+            ids = {id(span): i for i, span in enumerate(spans)}
+            captured.extend({'name': span.name, 'parent': ids.get(id(span.parent)),
+                             'start': self._epoch(span.start), 'end': self._epoch(span.end),
+                             'thread': span.thread, 'pid': span.pid, 'counters': span.counters, 'attrs': span.attrs}
+                            for span in spans)
+
+    def merge_spans(self, captured: List[Dict[str, Any]]):
+        """Adds spans from `capture_spans` in another process, nested under the current span."""
+        parent = self._current.get()
+        spans = []
+        for record in captured:
+            span = Span(record['name'], None, record['attrs'])
+            span.start = self.origin + record['start'] - self.started.timestamp()
+            span.end = self.origin + record['end'] - self.started.timestamp()
+            span.thread, span.pid, span.counters = record['thread'], record['pid'], dict(record['counters'])
+            spans.append(span)
+        with self._lock:
+            for span, record in zip(spans, captured):
+                if record['parent'] is not None:
+                    span.parent = spans[record['parent']]
+                    continue
+                # A worker's root span already holds its children's network counts
+                span.parent = parent
+                amounts = {key: span.counters.get(key, 0) for key in ROLLUP_COUNTERS}
+                for key, amount in amounts.items():
+                    self.totals[key] = self.totals.get(key, 0) + amount
+                if parent is not None:
+                    parent.count(**amounts)
+            self.spans.extend(spans)
+
+    # --- Report ---
+    def _ms(self, t: float) -> float:
+        return round((t - self.origin) * 1000, 3)
+
+    def report(self, script: str) -> Dict[str, Any]:
+        with self._lock:
+            spans = sorted(self.spans, key=lambda s: s.start)
+        ids = {id(span): i for i, span in enumerate(spans)}
+        stages: Dict[str, Dict[str, Any]] = {}
+        for span in spans:
+            duration = (span.end - span.start) * 1000
+            stage = stages.setdefault(span.name, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0,
+                                                  **dict.fromkeys(COUNTERS, 0)})
+            stage['calls'] += 1
+            stage['total_ms'] = round(stage['total_ms'] + duration, 3)
+            stage['max_ms'] = round(max(stage['max_ms'], duration), 3)
+            for key, amount in span.counters.items():
+                stage[key] = stage.get(key, 0) + amount
+        pid = os.getpid()
+        return {
+            'script': script,
+            'pid': pid,
+            'worker_pids': sorted({span.pid for span in spans} - {pid}),
+            'started_utc': self.started.isoformat(),
+            'wall_ms': self._ms(time.perf_counter()),
+            'totals': dict(self.totals),
+            'stages': stages,
+            'spans': [{'id': ids[id(span)], 'name': span.name,
+                       'parent': ids.get(id(span.parent)) if span.parent is not None else None,
+                       'start_ms': self._ms(span.start), 'duration_ms': round((span.end - span.start) * 1000, 3),
+                       'pid': span.pid, 'thread': span.thread,
+                       'counters': {k: v for k, v in span.counters.items() if v}, 'attrs': span.attrs}
+                      for span in spans],
+        }
+
+    def trace_events(self, script: str) -> List[Dict[str, Any]]:
+        """Chrome trace 'complete' events, timestamped in epoch microseconds so scripts line up."""
+        epoch_us = self.started.timestamp() * 1e6
+        pid = os.getpid()
+        with self._lock:
+            spans = list(self.spans)
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': script}}]
+        events += [{'name': 'process_name', 'ph': 'M', 'pid': worker, 'args': {'name': f"{script} worker"}}
+                   for worker in sorted({span.pid for span in spans} - {pid})]
+        for span in spans:
+            events.append({
+                'name': span.name, 'cat': span.name.split('.', 1)[0], 'ph': 'X', 'pid': span.pid, 'tid': span.thread,
+                'ts': round(epoch_us + (span.start - self.origin) * 1e6, 1),
+                'dur': round((span.end - span.start) * 1e6, 1),
+                'args': {**{k: v for k, v in span.counters.items() if v}, **span.attrs},
+            })
+        return events
+
+    def write(self, script: Optional[str] = None, path: str = RUN_METRICS_FILE):
+        """Replaces this script's report (and its trace events) in `path`, keeping the other scripts'."""
+        script = script or os.path.splitext(os.path.basename(sys.argv[0]))[0]
+        data = {}
+        if os.path.exists(path):
+            try:
+                with open(path, 'r') as f:
+                    data = json.load(f)
+            except (IOError, json.JSONDecodeError):
+                data = {}
+        runs = data.get('runs', {}) if isinstance(data, dict) else {}
+        previous = runs.get(script) or {}
+        previous_pids = {previous.get('pid'), *previous.get('worker_pids', [])} - {None}
+        runs[script] = self.report(script)
+        events = [e for e in (data.get('traceEvents', []) if isinstance(data, dict) else [])
+                  if e.get('pid') not in previous_pids]
+        data = {'runs': runs, 'traceEvents': events + self.trace_events(script), 'displayTimeUnit': 'ms'}
+        tmp_path = path + ".tmp"
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(data, f, default=str)
+            os.replace(tmp_path, path)
+            logging.info(f"Run metrics for {script} written to {path}.")
+        except IOError as e:
+            logging.error(f"Could not write run metrics to {path}: {e}")
+
+
+TRACER = Tracer()
+span = TRACER.span
+traced = TRACER.traced
+count = TRACER.count
+capture_spans = TRACER.capture_spans
+merge_spans = TRACER.merge_spans
+write_run_metrics = TRACER.write
@@ -1,109 +1,105 @@
-import requests
+import argparse
+import os
+import numpy as np
 import pandas as pd
 from datetime import datetime
 import json
 
+from kline_store import KlineStore
+from run_metrics import span, write_run_metrics
+
+STORE = KlineStore()
+
+SYMBOLS = ["BTCUSDT", "ETHUSDT"]
+TIMEFRAMES = ["1h", "2h", "4h", "1d", "1w", "1M"]
+OUTPUT_FILENAME = "crypto_signals.json"
+EVENTS_DATASET_DIR = "signal_events"
+SIGNAL_STATE_DIR = "signal_state"
+# Advance a persisted per-(symbol, timeframe) state instead of recomputing 1000 candles every run
+INCREMENTAL_SIGNAL_STATE = True
+EVENT_COLUMNS = ["signal_type", "s0", "s1", "s2", "s3", "s4", "s1_level", "support_value", "next_crossover"]
+
 
 # --- [1] FULL ANALYSIS LOGIC ---
 # (These functions remain unchanged as they correctly define the analysis logic)
 
 def get_historical_data(symbol, interval, limit):
-    """Fetches historical candlestick data, ignoring the current unclosed candle."""
-    url = "https://api.binance.com/api/v3/klines"
-    params = {"symbol": symbol, "interval": interval, "limit": limit}
-    try:
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        # Return all but the last (unclosed) candle
-        return response.json()[:-1]
-    except requests.RequestException as e:
-        print(f"Error fetching data for {symbol} on {interval}: {e}")
+    """Reads candles from the shared kline store, ignoring the current unclosed candle."""
+    with span('fetch.frame', symbol=symbol, interval=interval) as frame_span:
+        df = STORE.get_frame(symbol, interval, last_n=limit - 1, closed_only=True)
+        frame_span.count(rows=len(df))
+    if df.empty:
+        print(f"Error fetching data for {symbol} on {interval}: no candles available")
         return None
-
-
-def find_s1_signal(df, crossover_iloc, signal_type, initial_level):
-    df_after_crossover = df.iloc[crossover_iloc + 1:]
-    effective_level = initial_level
-    for index, candle in df_after_crossover.iterrows():
-        if signal_type == "Bullish Confirmation":
-            if candle['Open'] > initial_level and candle['Close'] > effective_level:
-                return {"raw_date": index}
-            elif candle['High'] > effective_level:
-                effective_level = candle['High']
-        elif signal_type == "Bearish Confirmation":
-            if candle['Open'] < initial_level and candle['Close'] < effective_level:
-                return {"raw_date": index}
-            elif candle['Low'] < effective_level:
-                effective_level = candle['Low']
-    return None
-
-
-def find_s2_signal(df, s1_signal_info, signal_type):
-    s1_iloc = df.index.get_loc(s1_signal_info['raw_date'])
-    s1_candle = df.iloc[s1_iloc]
-    s1_open_level = s1_candle['Open']
-    effective_level = s1_candle['High'] if signal_type == "Bullish Confirmation" else s1_candle['Low']
-    for index, candle in df.iloc[s1_iloc + 1:].iterrows():
-        if signal_type == "Bullish Confirmation":
-            if candle['Open'] > s1_open_level and candle['Close'] > effective_level:
-                return {"raw_date": index}
-            elif candle['High'] > effective_level:
-                effective_level = candle['High']
-        elif signal_type == "Bearish Confirmation":
-            if candle['Open'] < s1_open_level and candle['Close'] < effective_level:
-                return {"raw_date": index}
-            elif candle['Low'] < effective_level:
-                effective_level = candle['Low']
-    return None
-
-
-def find_s3_signal(df, s2_signal_info, signal_type):
-    s2_iloc = df.index.get_loc(s2_signal_info['raw_date'])
-    s2_candle = df.iloc[s2_iloc]
-    open_req = s2_candle['High'] if signal_type == "Bullish Confirmation" else s2_candle['Low']
-    effective_level = open_req
-    for index, candle in df.iloc[s2_iloc + 1:].iterrows():
-        if signal_type == "Bullish Confirmation":
-            if candle['Open'] > open_req and candle['Close'] > effective_level and candle['Close'] > candle['Open']:
-                return {"raw_date": index}
-            elif candle['High'] > effective_level:
-                effective_level = candle['High']
-        elif signal_type == "Bearish Confirmation":
-            if candle['Open'] < open_req and candle['Close'] < effective_level and candle['Close'] < candle['Open']:
-                return {"raw_date": index}
-            elif candle['Low'] < effective_level:
-                effective_level = candle['Low']
-    return None
-
-
-def find_s4_signal(df, s3_signal_info, signal_type):
-    s3_iloc = df.index.get_loc(s3_signal_info['raw_date'])
-    s3_candle = df.iloc[s3_iloc]
-    open_req = s3_candle['High'] if signal_type == "Bullish Confirmation" else s3_candle['Low']
-    effective_level = open_req
-    for index, candle in df.iloc[s3_iloc + 1:].iterrows():
-        if signal_type == "Bullish Confirmation":
-            if candle['Open'] > open_req and candle['Close'] > effective_level and candle['Close'] > candle['Open']:
-                return {"raw_date": index}
-            elif candle['High'] > effective_level:
-                effective_level = candle['High']
-        elif signal_type == "Bearish Confirmation":
-            if candle['Open'] < open_req and candle['Close'] < effective_level and candle['Close'] < candle['Open']:
-                return {"raw_date": index}
-            elif candle['Low'] < effective_level:
-                effective_level = candle['Low']
-    return None
-
-
-def find_latest_combined_signal(data):
-    if not data or len(data) < 49: return None
-    columns = ["Open_time", "Open", "High", "Low", "Close", "Volume", "Close_time", "Quote_asset_volume",
-               "Number_of_trades", "Taker_buy_base_asset_volume", "Taker_buy_quote_asset_volume", "Ignore"]
-    df = pd.DataFrame(data, columns=columns)
-    for col in ['Open', 'High', 'Low', 'Close']:
-        df[col] = pd.to_numeric(df[col], errors='coerce')
-    df['DateTime'] = pd.to_datetime(df['Close_time'], unit='ms')
-    df.set_index('DateTime', inplace=True)
+    if not STORE.is_current(symbol, interval):
+        print(f"Error fetching data for {symbol} on {interval}: cached candles are stale, skipping")
+        return None
+    return df
+
+
+# S2-S4 rules: (source of the open requirement on the previous stage's candle, candle body must agree).
+# Each stage starts its effective level at the previous stage's High (bullish) / Low (bearish);
+# S1 takes both its open requirement and level from the pre-crossover range instead.
+S_STAGE_RULES = {
+    "s2": ("open", False),
+    "s3": ("extreme", True),
+    "s4": ("extreme", True),
+}
+
+
+def find_first_confirmation(o, h, l, c, start, stop, bullish, open_req, level, require_body=False):
+    """
+    Position of the first candle in [start, stop) that confirms a signal, or None.
+
+    A bullish candle confirms when it opens above `open_req` and closes above the effective
+    level, which starts at `level` and is raised to every prior candle's High that did not
+    confirm. Because scanning stops at the first confirmation, the effective level at each
+    candle is simply max(level, running max of the preceding Highs), so the whole scan is one
+    accumulate plus a first-hit search. Bearish mirrors this with Lows and running minima.
+    """
+    if start >= stop:
+        return None
+    o, h, l, c = o[start:stop], h[start:stop], l[start:stop], c[start:stop]
+    effective = np.empty(len(c))
+    effective[0] = level
+    if bullish:
+        np.maximum(np.maximum.accumulate(h[:-1]), level, out=effective[1:])
+        hit = (o > open_req) & (c > effective)
+        if require_body: hit &= c > o
+    else:
+        np.minimum(np.minimum.accumulate(l[:-1]), level, out=effective[1:])
+        hit = (o < open_req) & (c < effective)
+        if require_body: hit &= c < o
+    first = int(np.argmax(hit))
+    return start + first if hit[first] else None
+
+
+def find_confirmation_chain(o, h, l, c, crossover_pos, bullish, s1_level, stop=None):
+    """
+    Runs the S1 -> S4 confirmation chain after a crossover on NumPy OHLC arrays.
+
+    Returns the positions of S1..S4 (None once the chain breaks). `stop` bounds the search,
+    e.g. at the next crossover when walking the full history.
+    """
+    stop = len(c) if stop is None else stop
+    extreme = h if bullish else l
+    positions = []
+    pos = find_first_confirmation(o, h, l, c, crossover_pos + 1, stop, bullish, s1_level, s1_level)
+    positions.append(pos)
+    for open_src, require_body in S_STAGE_RULES.values():
+        if pos is None:
+            positions.append(None)
+            continue
+        open_req = o[pos] if open_src == "open" else extreme[pos]
+        pos = find_first_confirmation(o, h, l, c, pos + 1, stop, bullish, open_req, extreme[pos], require_body)
+        positions.append(pos)
+    return positions
+
+
+def add_signal_states(data):
+    """Adds the 13/49 SMA/EMA columns and the bullish/bearish/grey regime flags."""
+    if data is None or len(data) < 49: return None
+    df = data[['open', 'high', 'low', 'close']].rename(columns=str.capitalize)
     df['SMA_13'] = df['Close'].rolling(window=13).mean()
     df['EMA_13'] = df['Close'].ewm(span=13, adjust=False).mean()
     df['SMA_49'] = df['Close'].rolling(window=49).mean()
@@ -114,6 +110,12 @@ def find_latest_combined_signal(data):
     df['bullish_state'] = (df[['EMA_13', 'SMA_13']].min(axis=1)) > (df[['EMA_49', 'SMA_49']].max(axis=1))
     df['bearish_state'] = (df[['EMA_13', 'SMA_13']].max(axis=1)) < (df[['EMA_49', 'SMA_49']].min(axis=1))
     df['grey_state'] = ~(df['bullish_state'] | df['bearish_state'])
+    return df
+
+
+def find_latest_combined_signal(data):
+    df = add_signal_states(data)
+    if df is None: return None
 
     if df.iloc[-1]['grey_state']:
         return {"type": "Grey Crossover", "support_value": None}
@@ -149,23 +151,265 @@ def find_latest_combined_signal(data):
 
     s1, s2, s3, s4 = None, None, None, None
     if s1_test_level is not None:
-        s1 = find_s1_signal(df, crossover_iloc, signal_type, s1_test_level)
-        if s1:
-            s2 = find_s2_signal(df, s1, signal_type)
-            if s2:
-                s3 = find_s3_signal(df, s2, signal_type)
-                if s3: s4 = find_s4_signal(df, s3, signal_type)
+        ohlc = [df[col].to_numpy(dtype=float) for col in ['Open', 'High', 'Low', 'Close']]
+        positions = find_confirmation_chain(*ohlc, crossover_iloc, signal_type == "Bullish Confirmation", s1_test_level)
+        s1, s2, s3, s4 = [{"raw_date": df.index[pos]} if pos is not None else None for pos in positions]
 
     return {"type": signal_type, "s1": s1, "s2": s2, "s3": s3, "s4": s4, "support_value": support_value}
 
 
+def find_all_signal_events(data):
+    """
+    Every crossover in `data` with its S0-S4 confirmation timestamps, in one linear pass.
+
+    Each event is evaluated exactly as `find_latest_combined_signal` would while it was the
+    most recent crossover, so its confirmation chain is searched only up to the next
+    crossover. Returns one row per crossover (S0 = crossover candle, missing stages NaT).
+    """
+    df = add_signal_states(data)
+    if df is None: return pd.DataFrame(columns=EVENT_COLUMNS)
+
+    bullish, bearish = df['bullish_state'].to_numpy(), df['bearish_state'].to_numpy()
+    grey = df['grey_state'].to_numpy()
+    o, h, l, c = [df[col].to_numpy(dtype=float) for col in ['Open', 'High', 'Low', 'Close']]
+    n = len(df)
+
+    bull_events = np.flatnonzero(bullish[1:] & ~bullish[:-1]) + 1
+    bear_events = np.flatnonzero(bearish[1:] & ~bearish[:-1]) + 1
+    event_pos = np.concatenate([bull_events, bear_events])
+    order = np.argsort(event_pos, kind='stable')
+    event_pos = event_pos[order]
+    event_bullish = np.concatenate([np.ones(len(bull_events), bool), np.zeros(len(bear_events), bool)])[order]
+    next_event = np.append(event_pos[1:], n)
+
+    # Position of the last coloured candle at or before each index (-1 if none yet)
+    last_colored = np.maximum.accumulate(np.where(grey, -1, np.arange(n)))
+
+    times = df.index
+    rows = []
+    for pos, is_bull, stop in zip(event_pos, event_bullish, next_event):
+        start_grey = last_colored[pos - 1] + 1
+        period_high, period_low = h[start_grey:pos + 1].max(), l[start_grey:pos + 1].min()
+        s1_level, support_value = (period_high, period_low) if is_bull else (period_low, period_high)
+        stages = find_confirmation_chain(o, h, l, c, pos, is_bull, s1_level, stop=stop)
+        rows.append([
+            "Bullish Confirmation" if is_bull else "Bearish Confirmation", times[pos],
+            *[times[p] if p is not None else pd.NaT for p in stages],
+            float(s1_level), float(support_value), times[stop] if stop < n else pd.NaT
+        ])
+    events = pd.DataFrame(rows, columns=EVENT_COLUMNS)
+    for col in ['s0', 's1', 's2', 's3', 's4', 'next_crossover']:
+        events[col] = pd.to_datetime(events[col], utc=True)
+    return events
+
+
+def build_signal_event_history(symbols, timeframes, dataset_dir=EVENTS_DATASET_DIR):
+    """Writes the full-history event table as a Parquet dataset partitioned by symbol/timeframe."""
+    tables = []
+    for symbol in symbols:
+        for tf in timeframes:
+            events = find_all_signal_events(STORE.get_frame(symbol, tf, closed_only=True))
+            events.insert(0, 'timeframe', tf)
+            events.insert(0, 'symbol', symbol)
+            tables.append(events)
+            print(f"  {symbol} {tf}: {len(events)} crossover events")
+    events = pd.concat(tables, ignore_index=True)
+    events.to_parquet(dataset_dir, partition_cols=['symbol', 'timeframe'], index=False,
+                      existing_data_behavior='delete_matching')
+    return events
+
+
+def load_signal_events(dataset_dir=EVENTS_DATASET_DIR, symbol=None, timeframe=None):
+    """Reads the event table back, optionally restricted to one symbol and/or timeframe partition."""
+    filters = [(col, '==', val) for col, val in [('symbol', symbol), ('timeframe', timeframe)] if val]
+    events = pd.read_parquet(dataset_dir, filters=filters or None)
+    for col in ['symbol', 'timeframe']:
+        events[col] = events[col].astype(str)
+    return events
+
+
+def summarize_signal_hit_rates(events):
+    """Share of crossovers that went on to reach each S-stage, per symbol/timeframe/direction."""
+    reached = events[['s1', 's2', 's3', 's4']].notna()
+    reached[['symbol', 'timeframe', 'signal_type']] = events[['symbol', 'timeframe', 'signal_type']]
+    grouped = reached.groupby(['symbol', 'timeframe', 'signal_type'])
+    summary = grouped.mean().add_suffix('_rate')
+    summary.insert(0, 'events', grouped.size())
+    return summary.reset_index()
+
+
+class SignalState:
+    """
+    Incremental version of `find_latest_combined_signal` for one (symbol, timeframe).
+
+    Holds everything needed to advance by one closed candle: the last 49 closes for the SMAs,
+    the 13/49 EMAs, the current regime, the High/Low range of the grey run before a crossover,
+    and the active crossover with its next S-stage open requirement and effective level.
+    `update` is O(1) per candle, so a refresh only touches candles closed since the last run.
+    """
+
+    SHORT, LONG = 13, 49
+    STAGES = ["s1", "s2", "s3", "s4"]
+
+    def __init__(self):
+        self.last_time = None            # open time (ns) of the last candle applied
+        self.closes = []                 # last LONG closes
+        self.ema = {self.SHORT: None, self.LONG: None}
+        self.regime = None               # "bullish" / "bearish" / "grey" once the SMAs are warm
+        self.grey_high, self.grey_low = None, None
+        self.signal_type = None
+        self.crossover_time = None
+        self.support_value = None
+        self.stage_times = {}            # stage -> open time (ns)
+        self.open_req, self.effective_level, self.require_body = None, None, False
+
+    @staticmethod
+    def _ema_step(prev, value, span):
+        # Same recurrence as pandas' ewm(span, adjust=False), so values match bit for bit
+        if prev is None:
+            return value
+        alpha = 1.0 / (1.0 + (span - 1) / 2.0)
+        if prev == value:
+            return prev
+        return ((1.0 - alpha) * prev + alpha * value) / ((1.0 - alpha) + alpha)
+
+    def update(self, candle):
+        """Applies one closed candle given as (open_time, open, high, low, close)."""
+        open_time, o, h, l, c = candle
+        self.last_time = pd.Timestamp(open_time).value
+        for span in self.ema:
+            self.ema[span] = self._ema_step(self.ema[span], c, span)
+        self.closes = (self.closes + [c])[-self.LONG:]
+        if len(self.closes) < self.LONG:
+            return
+
+        sma_short = sum(self.closes[-self.SHORT:]) / self.SHORT
+        sma_long = sum(self.closes) / self.LONG
+        fast = (self.ema[self.SHORT], sma_short)
+        slow = (self.ema[self.LONG], sma_long)
+        regime = "bullish" if min(fast) > max(slow) else "bearish" if max(fast) < min(slow) else "grey"
+        prev_regime, self.regime = self.regime, regime
+
+        grey_high = h if self.grey_high is None else max(self.grey_high, h)
+        grey_low = l if self.grey_low is None else min(self.grey_low, l)
+        if regime != "grey" and prev_regime is not None and regime != prev_regime:
+            bullish = regime == "bullish"
+            self.signal_type = "Bullish Confirmation" if bullish else "Bearish Confirmation"
+            self.crossover_time = self.last_time
+            self.support_value = grey_low if bullish else grey_high
+            self.stage_times = {}
+            self.open_req = self.effective_level = grey_high if bullish else grey_low
+            self.require_body = False
+        elif self.signal_type and len(self.stage_times) < len(self.STAGES):
+            self._advance_chain(o, h, l, c)
+
+        # Coloured candles end the grey run that the next crossover's range is taken from
+        if regime == "grey":
+            self.grey_high, self.grey_low = grey_high, grey_low
+        else:
+            self.grey_high, self.grey_low = None, None
+
+    def _advance_chain(self, o, h, l, c):
+        bullish = self.signal_type == "Bullish Confirmation"
+        if bullish:
+            hit = o > self.open_req and c > self.effective_level and (not self.require_body or c > o)
+        else:
+            hit = o < self.open_req and c < self.effective_level and (not self.require_body or c < o)
+        extreme = h if bullish else l
+        if not hit:
+            self.effective_level = max(self.effective_level, h) if bullish else min(self.effective_level, l)
+            return
+        self.stage_times[self.STAGES[len(self.stage_times)]] = self.last_time
+        if len(self.stage_times) < len(self.STAGES):
+            open_src, self.require_body = S_STAGE_RULES[self.STAGES[len(self.stage_times)]]
+            self.open_req = o if open_src == "open" else extreme
+            self.effective_level = extreme
+
+    def signal(self):
+        """The latest signal in the same shape `find_latest_combined_signal` returns."""
+        if self.regime is None:
+            return None
+        if self.regime == "grey":
+            return {"type": "Grey Crossover", "support_value": None}
+        if self.signal_type is None:
+            return None
+        result = {stage: ({"raw_date": pd.Timestamp(self.stage_times[stage], tz='UTC')}
+                          if stage in self.stage_times else None) for stage in self.STAGES}
+        return {"type": self.signal_type, **result, "support_value": self.support_value}
+
+    def to_dict(self):
+        return dict(vars(self))
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        for key, value in data.items():
+            setattr(state, key, value)
+        state.ema = {int(span): value for span, value in state.ema.items()}
+        return state
+
+
+def load_signal_state(symbol, interval):
+    path = os.path.join(SIGNAL_STATE_DIR, f"{symbol}_{interval}.json")
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r') as f:
+            return SignalState.from_dict(json.load(f))
+    except (json.JSONDecodeError, IOError, TypeError, AttributeError) as e:
+        print(f"Discarding unreadable signal state {path}: {e}")
+        return None
+
+
+def save_signal_state(symbol, interval, state):
+    os.makedirs(SIGNAL_STATE_DIR, exist_ok=True)
+    path = os.path.join(SIGNAL_STATE_DIR, f"{symbol}_{interval}.json")
+    try:
+        with open(path, 'w') as f:
+            json.dump(state.to_dict(), f)
+    except IOError as e:
+        print(f"Error: Could not write signal state {path}. Reason: {e}")
+
+
+def get_latest_signal_incremental(symbol, interval):
+    """
+    Advances the persisted state by the candles closed since the last run and returns the
+    latest signal. The state is rebuilt from the usual 1000-candle window when it is missing
+    or no longer connects to the cached history.
+    """
+    with span('fetch.frame', symbol=symbol, interval=interval) as frame_span:
+        candles = STORE.get_frame(symbol, interval, closed_only=True)
+        frame_span.count(rows=len(candles))
+    if candles.empty:
+        return None
+    if not STORE.is_current(symbol, interval):
+        print(f"Error fetching data for {symbol} on {interval}: cached candles are stale, skipping")
+        return None
+    state = load_signal_state(symbol, interval)
+    times = candles.index.asi8
+    if state is None or state.last_time is None or state.last_time < times[0] or state.last_time > times[-1]:
+        state = SignalState()
+        candles = candles.iloc[-999:]
+    else:
+        candles = candles.iloc[int(np.searchsorted(times, state.last_time, side='right')):]
+    with span('compute.signal_state', symbol=symbol, interval=interval) as state_span:
+        state_span.count(rows=len(candles))
+        for candle in candles[['open', 'high', 'low', 'close']].itertuples(name=None):
+            state.update(candle)
+    with span('write.signal_state', symbol=symbol, interval=interval):
+        save_signal_state(symbol, interval, state)
+    return state.signal()
+
+
 # --- [2] MAIN EXECUTION BLOCK (FIXED & CLEANED) ---
 
 def main():
     """Main function to run analysis ONCE and save results to a JSON file."""
-    symbols = ["BTCUSDT", "ETHUSDT"]
-    timeframes = ["1h", "2h", "4h", "1d", "1w", "1M"]
-    output_filename = "crypto_signals.json"
+    parser = argparse.ArgumentParser(description="Latest S-signal stage per symbol/timeframe.")
+    parser.add_argument('--history', action='store_true',
+                        help=f"Also write every crossover and its S0-S4 timestamps to '{EVENTS_DATASET_DIR}/'.")
+    args = parser.parse_args()
+    symbols, timeframes, output_filename = SYMBOLS, TIMEFRAMES, OUTPUT_FILENAME
 
     print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Starting analysis for {', '.join(symbols)}...")
     all_results = {}
@@ -174,8 +418,13 @@ def main():
         print(f"--- Analyzing {symbol} ---")
         symbol_results = {}
         for tf in timeframes:
-            klines = get_historical_data(symbol, tf, 1000)
-            signal = find_latest_combined_signal(klines)
+            if INCREMENTAL_SIGNAL_STATE:
+                signal = get_latest_signal_incremental(symbol, tf)
+            else:
+                data = get_historical_data(symbol, tf, 1000)
+                with span('compute.combined_signal', symbol=symbol, interval=tf) as signal_span:
+                    signal_span.count(rows=len(data) if data is not None else 0)
+                    signal = find_latest_combined_signal(data)
 
             stage = "No Signal"
             colour = "Grey"
@@ -228,12 +477,19 @@ def main():
 
     # Save the final results to a file
     try:
-        with open(output_filename, 'w') as f:
+        with span('write.json', file=output_filename), open(output_filename, 'w') as f:
             json.dump(all_results, f, indent=4)
         print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Successfully saved data to {output_filename}")
     except IOError as e:
         print(f"Error: Could not write to file {output_filename}. Reason: {e}")
 
+    if args.history:
+        print(f"Building full-history signal event table in {EVENTS_DATASET_DIR}/ ...")
+        with span('compute.signal_event_history'):
+            build_signal_event_history(symbols, timeframes)
+
+    STORE.close()
+    write_run_metrics('s_signal_analysis')
     print("--- Analysis complete. ---")
 
 
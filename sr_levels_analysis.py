@@ -1,23 +1,32 @@
 import pandas as pd
 import numpy as np
-import requests
 import json
-from datetime import datetime, timezone
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import shared_memory
 import re
-import time
 import logging
 import sys
 from typing import Optional, List, Any, Dict
-from scipy.signal import argrelextrema
-from sklearn.cluster import DBSCAN
+
+from kline_store import KlineStore
+from clock import utc_now
+from run_metrics import span, traced, capture_spans, merge_spans, write_run_metrics
 
 # --- Unified Configuration ---
 SYMBOLS = ['BTCUSDT', 'ETHUSDT']
 TIMEFRAMES_TO_ANALYZE = ['15m', '30m', '1h', '2h', '4h']
 # MODIFIED LINE: Added 270, 180, and 120 day lookbacks
 LOOKBACK_PERIODS_DAYS = [270, 180, 120, 60, 30, 21, 14, 7, 3, 2]
+# Load the longest lookback once per (symbol, timeframe) and slice every shorter one from it
+FETCH_ONCE_SLICE_MANY = True
+ATR_TIMEFRAME = '1h'
 BASE_PIVOT_WINDOWS = [5, 8, 13, 21, 34]
 TOP_N_CLUSTERS_TO_SEND = 10
+# Run the (symbol, lookback) jobs on a process pool over shared-memory OHLCV (needs FETCH_ONCE_SLICE_MANY)
+PARALLEL_SR_JOBS = True
+SR_MAX_WORKERS = None  # None -> os.cpu_count()
 SR_OUTPUT_FILENAME = "sr_levels_analysis.json"
 OPENS_OUTPUT_FILENAME = "market_opens.json"
 
@@ -33,17 +42,11 @@ TIMEFRAME_WEIGHTS = {'15m': 1.0, '30m': 1.2, '1h': 1.5, '2h': 2.0, '4h': 2.5}
 PIVOT_SOURCE_WEIGHTS = {'Wick': 1.0, 'Close': 1.5}
 STRENGTH_CONFIG = {'VOLUME_STRENGTH_FACTOR': 1.0, 'RECENCY_HALFLIFE_DAYS': 45.0}
 
-API_ENDPOINT = "https://api.binance.com/api/v3/klines"
-
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
-SESSION = requests.Session()
-SESSION.headers.update({
-    'User-Agent': 'Mozilla/5.0'
-})
-DEFAULT_TIMEOUT = 20
+STORE = KlineStore()
 
 
 def get_safe_symbol(symbol):
@@ -62,60 +65,131 @@ def get_minutes_from_timeframe(tf_string):
 
 
 def fetch_ohlcv_paginated(symbol, interval, lookback_days=None, limit=1000):
-    all_data = []
-    end_time_ms = None
-    df = pd.DataFrame()
+    """Returns the newest candles (including the forming one) from the shared kline store."""
     try:
         if lookback_days:
             minutes_per_tf = get_minutes_from_timeframe(interval)
             total_candles_needed = (lookback_days * 1440) // minutes_per_tf
-            while len(all_data) < total_candles_needed:
-                url = f'{API_ENDPOINT}?symbol={symbol}&interval={interval}&limit={limit}'
-                if end_time_ms:
-                    url += f'&endTime={end_time_ms}'
-                r = SESSION.get(url, timeout=DEFAULT_TIMEOUT)
-                r.raise_for_status()
-                data_chunk = r.json()
-                if not data_chunk:
-                    break
-                all_data = data_chunk + all_data
-                end_time_ms = data_chunk[0][0] - 1
-                if len(data_chunk) < limit:
-                    break
-                time.sleep(0.3)
-            if not all_data:
-                return None
-            df = pd.DataFrame(all_data, columns=[
-                'Open time', 'Open', 'High', 'Low', 'Close', 'Volume', 'Close time',
-                'Quote asset volume', 'Number of trades', 'Taker buy base asset volume',
-                'Taker buy quote asset volume', 'Ignore'
-            ])
-            # Ensure we don't have more data than needed, which can happen with pagination logic
-            df = df.tail(int(total_candles_needed))
+            df = STORE.get_frame(symbol, interval, last_n=int(total_candles_needed))
         else:
-            url = f'{API_ENDPOINT}?symbol={symbol}&interval={interval}&limit={limit}'
-            r = SESSION.get(url, timeout=DEFAULT_TIMEOUT)
-            r.raise_for_status()
-            df = pd.DataFrame(r.json(), columns=[
-                'Open time', 'Open', 'High', 'Low', 'Close', 'Volume', 'Close time',
-                'Quote asset volume', 'Number of trades', 'Taker buy base asset volume',
-                'Taker buy quote asset volume', 'Ignore'
-            ])
+            df = STORE.get_frame(symbol, interval, last_n=limit)
         if df.empty:
             return None
-
-        df['Date'] = pd.to_datetime(df['Open time'], unit='ms', utc=True)
-        df.set_index('Date', inplace=True)
-        # Ensure numeric
-        for col in ['Open', 'High', 'Low', 'Close', 'Volume']:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        df.dropna(subset=['Open', 'High', 'Low', 'Close', 'Volume'], inplace=True)
-        return df[['Open', 'High', 'Low', 'Close', 'Volume']]
+        return df.rename(columns=str.capitalize)
     except Exception as e:
         logging.error(f'Error fetching {symbol} {interval}: {e}')
         return None
 
 
+def get_lookback_candle_count(timeframe, lookback_days):
+    return int((lookback_days * 1440) // get_minutes_from_timeframe(timeframe))
+
+
+def fetch_lookback_frames(symbol, lookback_days):
+    """Fetches every timeframe the S/R analysis needs once, covering the longest lookback."""
+    frames = {}
+    for tf in dict.fromkeys([ATR_TIMEFRAME] + TIMEFRAMES_TO_ANALYZE):
+        df = fetch_ohlcv_paginated(symbol, tf, lookback_days=lookback_days)
+        if df is not None and not df.empty:
+            frames[tf] = df
+    return frames
+
+
+def slice_lookback(frames, timeframe, lookback_days):
+    """Zero-copy view of the newest candles covering `lookback_days` (same rows a direct fetch returns)."""
+    df = frames.get(timeframe)
+    if df is None:
+        return None
+    return df.iloc[-get_lookback_candle_count(timeframe, lookback_days):]
+
+
+# --- Parallel S/R jobs ---
+# Once the frames are local every (symbol, lookback) job is pure CPU. The parent copies each frame
+# into a shared-memory block once; workers map the blocks instead of unpickling DataFrames per task.
+SHARED_COLUMNS = ['Open', 'High', 'Low', 'Close', 'Volume']
+_WORKER_BLOCKS = []
+_WORKER_FRAMES = {}
+
+
+def share_frames(frames_by_symbol):
+    """Copies every frame into its own shared-memory block. Returns (blocks, spec) for `attach_frames`."""
+    blocks, spec = [], {}
+    for symbol, frames in frames_by_symbol.items():
+        spec[symbol] = {}
+        for tf, df in frames.items():
+            n = len(df)
+            shm = shared_memory.SharedMemory(create=True, size=max(1, n * 8 * (1 + len(SHARED_COLUMNS))))
+            blocks.append(shm)
+            np.ndarray((n,), dtype=np.int64, buffer=shm.buf)[:] = df.index.asi8
+            np.ndarray((n, len(SHARED_COLUMNS)), dtype=float, buffer=shm.buf, offset=n * 8)[:] = \
+                df[SHARED_COLUMNS].to_numpy(dtype=float)
+            spec[symbol][tf] = (shm.name, n)
+    return blocks, spec
+
+
+def attach_frames(spec):
+    """Rebuilds the shared frames as DataFrames viewing the blocks. Returns (blocks, frames_by_symbol)."""
+    blocks, frames_by_symbol = [], {}
+    for symbol, frames in spec.items():
+        frames_by_symbol[symbol] = {}
+        for tf, (name, n) in frames.items():
+            shm = shared_memory.SharedMemory(name=name)
+            blocks.append(shm)
+            times = np.ndarray((n,), dtype=np.int64, buffer=shm.buf)
+            values = np.ndarray((n, len(SHARED_COLUMNS)), dtype=float, buffer=shm.buf, offset=n * 8)
+            index = pd.DatetimeIndex(times.view('datetime64[ns]'), name='open_time').tz_localize('UTC')
+            frames_by_symbol[symbol][tf] = pd.DataFrame(values, index=index, columns=SHARED_COLUMNS, copy=False)
+    return blocks, frames_by_symbol
+
+
+def _init_sr_worker(spec):
+    global _WORKER_BLOCKS, _WORKER_FRAMES
+    _WORKER_BLOCKS, _WORKER_FRAMES = attach_frames(spec)
+
+
+def _run_sr_job(symbol, days):
+    """Worker side of one job: returns its result and its spans (pivots, DBSCAN) for the parent's trace."""
+    logging.info(f"  ... {symbol} using {days}d lookback period.")
+    with capture_spans() as spans, span('compute.sr_job', symbol=symbol, days=days):
+        result = run_analysis_for_lookback(symbol, days, frames=_WORKER_FRAMES.get(symbol, {}))
+    return result, spans
+
+
+def run_sr_jobs(frames_by_symbol, lookbacks):
+    """
+    Runs every (symbol, lookback) analysis and returns the results keyed by (symbol, days).
+    Frames of None mean "fetch per lookback", which always runs sequentially.
+    """
+    jobs = [(symbol, days) for symbol in frames_by_symbol for days in lookbacks]
+    workers = min(len(jobs), SR_MAX_WORKERS or os.cpu_count() or 1)
+    all_local = all(frames is not None for frames in frames_by_symbol.values())
+    if PARALLEL_SR_JOBS and all_local and workers > 1:
+        blocks = []
+        try:
+            blocks, spec = share_frames(frames_by_symbol)
+            with ProcessPoolExecutor(max_workers=workers, initializer=_init_sr_worker, initargs=(spec,)) as pool:
+                futures = [pool.submit(_run_sr_job, symbol, days) for symbol, days in jobs]
+                # Collected in submission order, so the merged output matches a sequential run
+                results = {}
+                for job, future in zip(jobs, futures):
+                    results[job], spans = future.result()
+                    merge_spans(spans)
+                return results
+        except (OSError, BrokenProcessPool) as e:
+            logging.warning(f"Parallel S/R run failed ({e}); falling back to sequential.")
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+    results = {}
+    for symbol, days in jobs:
+        logging.info(f"  ... {symbol} using {days}d lookback period.")
+        with span('compute.sr_job', symbol=symbol, days=days):
+            results[(symbol, days)] = run_analysis_for_lookback(symbol, days, frames=frames_by_symbol[symbol])
+    return results
+
+
 def get_market_opens(symbols_list: List[str]) -> Dict[str, Dict[str, float]]:
     """
     Fetches the current daily, weekly, and monthly open prices for a list of symbols.
@@ -131,7 +205,11 @@ def get_market_opens(symbols_list: List[str]) -> Dict[str, Dict[str, float]]:
         for name, tf in timeframes_map.items():
             # We only need the most recent candle to get the open price
             df = fetch_ohlcv_paginated(symbol, tf, limit=2) 
-            if df is not None and not df.empty:
+            if df is not None and not df.empty and not STORE.is_current(symbol, tf):
+                # A failed sync leaves a past period's candle last; its open is not the current one
+                logging.warning(f"  {symbol} {name} ({tf}) data is stale; not publishing an open.")
+                symbol_opens[name] = None
+            elif df is not None and not df.empty:
                 # The last row is the current, forming candle. Its 'Open' is what we need.
                 current_open = df['Open'].iloc[-1]
                 symbol_opens[name] = float(current_open)
@@ -139,7 +217,6 @@ def get_market_opens(symbols_list: List[str]) -> Dict[str, Dict[str, float]]:
             else:
                 logging.warning(f"  Could not fetch {name} open for {symbol}")
                 symbol_opens[name] = None # Or handle as an error
-            time.sleep(0.5) # Be nice to the API
 
         if symbol_opens:
             opens_data[safe_symbol] = symbol_opens
@@ -157,28 +234,67 @@ def calc_atr(df, period=ATR_LOOKBACK):
     return tr.rolling(period, min_periods=max(2, period // 2)).mean()
 
 
-def find_pivots_scipy(series, window, is_high):
-    if len(series) < (2 * window + 1):
-        return []
-    comp = np.greater if is_high else np.less
-    idxs = argrelextrema(series.values, comp, order=window)[0]
-    return [(series.index[i], series.iloc[i]) for i in idxs]
-
+def pivot_window_reach(values, is_high, max_window):
+    """
+    Largest window (capped at `max_window`) for which each bar is a strict local extremum, 0 for none.
+    A bar is a pivot for window w exactly when its reach is >= w, with the same edge handling as
+    scipy's argrelextrema(order=w) (neighbours beyond the ends clip to the first/last bar).
 
-def generate_pivots_for_timeframe(symbol, timeframe, lookback_days, atr_percent):
-    df = fetch_ohlcv_paginated(symbol, timeframe, lookback_days=lookback_days)
+    Runs of strictly lower (higher) neighbours are measured on both sides by binary lifting over a
+    sparse table of range maxima, so all windows come out of one O(n log w) pass.
+    """
+    x = np.asarray(values, dtype=float) if is_high else -np.asarray(values, dtype=float)
+    n = len(x)
+    reach = np.zeros(n, dtype=np.int64)
+    if n < 3 or max_window < 1:
+        return reach
+    levels = min(int(max_window).bit_length(), n.bit_length())
+    table = [x]
+    for k in range(1, levels):
+        prev, half = table[-1], 1 << (k - 1)
+        table.append(np.maximum(prev[:-half], prev[half:]))
+
+    idx = np.arange(n)
+    sides = []
+    for direction in (-1, 1):
+        run = np.zeros(n, dtype=np.int64)
+        for k in range(levels - 1, -1, -1):
+            span = 1 << k
+            # Block of `span` bars just beyond the current run on this side
+            start = idx - run - span if direction < 0 else idx + run + 1
+            valid = (start >= 0) & (start + span <= n)
+            block_max = table[k][np.clip(start, 0, len(table[k]) - 1)]
+            grow = valid & (block_max < x)
+            run += grow * span
+        blocked = (idx - run > 0) if direction < 0 else (idx + run < n - 1)
+        sides.append(np.where(blocked, run, max_window))
+    reach = np.minimum(np.minimum(sides[0], sides[1]), max_window)
+    reach[[0, -1]] = 0
+    return reach
+
+
+@traced('compute.pivots')
+def generate_pivots_for_timeframe(symbol, timeframe, lookback_days, atr_percent, df=None):
+    if df is None:
+        df = fetch_ohlcv_paginated(symbol, timeframe, lookback_days=lookback_days)
     if df is None or df.empty:
         return pd.DataFrame()
 
+    open_, high, low, close, volume = (df[c].to_numpy(dtype=float) for c in ['Open', 'High', 'Low', 'Close', 'Volume'])
+
     # Normalized volume (guard zero division)
-    vol_min, vol_max = df['Volume'].min(), df['Volume'].max()
+    vol_min, vol_max = volume.min(), volume.max()
     if vol_max > vol_min:
-        df['Volume_Norm'] = (df['Volume'] - vol_min) / (vol_max - vol_min)
+        volume_norm = (volume - vol_min) / (vol_max - vol_min)
     else:
-        df['Volume_Norm'] = 0.5
+        volume_norm = np.full(len(volume), 0.5)
 
+    # Per-bar recency and volume weights; pivots gather them by position
     recency_lambda = np.log(2) / max(1e-9, STRENGTH_CONFIG['RECENCY_HALFLIFE_DAYS'])
-    all_pivots = []
+    now = utc_now()
+    age_us = (pd.Timestamp(now).value - df.index.asi8) // 1000
+    recency_weight = np.exp(-recency_lambda * (age_us / 10**6 / 86400.0))
+    volume_weight = 1.0 + (volume_norm * STRENGTH_CONFIG['VOLUME_STRENGTH_FACTOR'])
 
     # Adaptive windows
     if atr_percent > 0.03:  # high volatility
@@ -187,80 +303,162 @@ def generate_pivots_for_timeframe(symbol, timeframe, lookback_days, atr_percent)
         pivot_windows = BASE_PIVOT_WINDOWS
 
     pivot_defs = {
-        'High_Wick': (df['High'], True, 'Resistance', 'Wick'),
-        'Low_Wick': (df['Low'], False, 'Support', 'Wick'),
-        'Close_High': (df['Close'], True, 'Resistance', 'Close'),
-        'Close_Low': (df['Close'], False, 'Support', 'Close')
+        'High_Wick': (high, True, 'Resistance', 'Wick'),
+        'Low_Wick': (low, False, 'Support', 'Wick'),
+        'Close_High': (close, True, 'Resistance', 'Close'),
+        'Close_Low': (close, False, 'Support', 'Close')
     }
     tf_weight = TIMEFRAME_WEIGHTS.get(timeframe, 1.0)
-    now = datetime.now(timezone.utc)
 
-    for window in pivot_windows:
-        for name, (series, is_high, ptype, source) in pivot_defs.items():
-            s_weight = PIVOT_SOURCE_WEIGHTS.get(source, 1.0)
-            pivots = find_pivots_scipy(series, window, is_high)
-            for ts, price in pivots:
-                base_strength = window * tf_weight * s_weight
-                days_ago = (now - ts).total_seconds() / 86400.0
-                recency_weight = float(np.exp(-recency_lambda * days_ago))
-                volume_weight = 1.0 + (float(df.loc[ts, 'Volume_Norm']) * STRENGTH_CONFIG['VOLUME_STRENGTH_FACTOR'])
-                final_strength = base_strength * recency_weight * volume_weight
-                all_pivots.append({
-                    'Timestamp': ts, 'Price': float(price), 'Strength': float(final_strength),
-                    'Type': ptype, 'Source': source, 'Timeframe': timeframe,
-                    'Volume': float(df.loc[ts, 'Volume']),
-                    'Close': float(df.loc[ts, 'Close']),
-                    'Open': float(df.loc[ts, 'Open'])
-                })
-    return pd.DataFrame(all_pivots)
-
-
-def is_reversal(pivot_row):
-    return ((pivot_row['Type'] == 'Resistance' and pivot_row['Close'] < pivot_row['Open']) or
-            (pivot_row['Type'] == 'Support' and pivot_row['Close'] > pivot_row['Open']))
+    # One reach pass per series; each window's pivots are a threshold on it
+    reaches = {name: pivot_window_reach(values, is_high, max(pivot_windows))
+               for name, (values, is_high, _, _) in pivot_defs.items()}
 
+    positions, strengths, prices, types, sources = [], [], [], [], []
+    for window in pivot_windows:
+        if len(df) < 2 * window + 1:
+            continue
+        for name, (values, is_high, ptype, source) in pivot_defs.items():
+            pos = np.flatnonzero(reaches[name] >= window)
+            if pos.size == 0:
+                continue
+            base_strength = window * tf_weight * PIVOT_SOURCE_WEIGHTS.get(source, 1.0)
+            positions.append(pos)
+            prices.append(values[pos])
+            strengths.append(base_strength * recency_weight[pos] * volume_weight[pos])
+            types.append(np.full(pos.size, ptype, dtype=object))
+            sources.append(np.full(pos.size, source, dtype=object))
+    if not positions:
+        return pd.DataFrame()
 
+    pos = np.concatenate(positions)
+    return pd.DataFrame({
+        'Timestamp': df.index[pos], 'Price': np.concatenate(prices), 'Strength': np.concatenate(strengths),
+        'Type': np.concatenate(types), 'Source': np.concatenate(sources), 'Timeframe': timeframe,
+        'Volume': volume[pos], 'Close': close[pos], 'Open': open_[pos]
+    })
+
+
+def _neighbor_bounds(sorted_prices, eps):
+    """[left, right) index range of the points within `eps` of each point of a sorted array."""
+    n = len(sorted_prices)
+    left = np.searchsorted(sorted_prices, sorted_prices - eps, side='left')
+    right = np.searchsorted(sorted_prices, sorted_prices + eps, side='right')
+    # `p + eps` rounds; step the bounds until they agree with the distance test DBSCAN uses
+    while True:
+        grow = (right < n) & (sorted_prices[np.minimum(right, n - 1)] - sorted_prices <= eps)
+        shrink = sorted_prices[right - 1] - sorted_prices > eps
+        if not (grow.any() or shrink.any()):
+            break
+        right = right + grow - shrink
+    while True:
+        grow = (left > 0) & (sorted_prices - sorted_prices[np.maximum(left - 1, 0)] <= eps)
+        shrink = sorted_prices - sorted_prices[left] > eps
+        if not (grow.any() or shrink.any()):
+            break
+        left = left - grow + shrink
+    return left, right
+
+
+def dbscan_1d(prices, eps, min_samples):
+    """
+    DBSCAN on 1-D points by sorting: same labels as sklearn's DBSCAN(eps, min_samples), with -1
+    for noise and clusters numbered in the order sklearn discovers them.
+    """
+    prices = np.asarray(prices, dtype=float)
+    n = len(prices)
+    labels = np.full(n, -1, dtype=np.int64)
+    if n == 0:
+        return labels
+    order = np.argsort(prices, kind='stable')
+    p = prices[order]
+    left, right = _neighbor_bounds(p, eps)
+    core = (right - left) >= min_samples
+    if not core.any():
+        return labels
+
+    # Cores chain into one cluster while consecutive cores are within eps
+    core_pos = np.flatnonzero(core)
+    component = np.concatenate(([0], np.cumsum(np.diff(p[core_pos]) > eps)))
+    # sklearn numbers clusters by the lowest original index among their core points
+    first_index = np.full(component[-1] + 1, n)
+    np.minimum.at(first_index, component, order[core_pos])
+    rank = np.empty_like(first_index)
+    rank[np.argsort(first_index)] = np.arange(len(first_index))
+    sorted_labels = np.full(n, -1, dtype=np.int64)
+    sorted_labels[core_pos] = rank[component]
+
+    # Border points join the lower-numbered cluster among the nearest cores on either side
+    border = np.flatnonzero(~core)
+    prev_core = np.searchsorted(core_pos, border, side='left') - 1
+    next_core = prev_core + 1
+    big = np.iinfo(np.int64).max
+    prev_label = np.where(prev_core >= 0, sorted_labels[core_pos[np.maximum(prev_core, 0)]], big)
+    prev_label[(prev_core < 0) | (p[border] - p[core_pos[np.maximum(prev_core, 0)]] > eps)] = big
+    has_next = next_core < len(core_pos)
+    next_idx = core_pos[np.minimum(next_core, len(core_pos) - 1)]
+    next_label = np.where(has_next & (p[next_idx] - p[border] <= eps), sorted_labels[next_idx], big)
+    border_label = np.minimum(prev_label, next_label)
+    sorted_labels[border] = np.where(border_label == big, -1, border_label)
+
+    labels[order] = sorted_labels
+    return labels
+
+
+@traced('compute.dbscan')
 def find_clusters_dbscan(pivots_df, symbol, atr_percent):
     if pivots_df.empty or len(pivots_df) < MIN_SAMPLES_FOR_CLUSTER:
         return []
 
-    avg_price = float(np.mean(pivots_df['Price']))
+    prices = pivots_df['Price'].to_numpy(dtype=float)
+    avg_price = float(np.mean(prices))
     # Adaptive epsilon; keep a reasonable floor to avoid epsilon=0
     eps_pct = BASE_EPS_PERCENTAGE_RANGE * max(0.25, (atr_percent / 0.01))  # floor at 0.25x base
     epsilon = max(1e-6, avg_price * eps_pct)
-    
-    pivots_df = pivots_df.copy()
-    db = DBSCAN(eps=epsilon, min_samples=MIN_SAMPLES_FOR_CLUSTER).fit(
-        pivots_df['Price'].values.reshape(-1, 1)
-    )
-    pivots_df['cluster_id'] = db.labels_
 
-    clusters = []
-    for cid in sorted(pivots_df['cluster_id'].unique()):
-        if cid == -1:
-            continue
-        cdf = pivots_df[pivots_df['cluster_id'] == cid]
+    labels = dbscan_1d(prices, epsilon, MIN_SAMPLES_FOR_CLUSTER)
+    in_cluster = np.flatnonzero(labels >= 0)
+    if in_cluster.size == 0:
+        return []
 
-        avg_vol = pivots_df['Volume'].mean()
-        if not any(cdf['Volume'] > avg_vol * LIQUIDITY_VOLUME_MULTIPLIER):
-            continue
-        if not any(cdf.apply(is_reversal, axis=1)):
-            continue
+    volume = pivots_df['Volume'].to_numpy(dtype=float)
+    types = pivots_df['Type'].to_numpy()
+    close, open_ = pivots_df['Close'].to_numpy(dtype=float), pivots_df['Open'].to_numpy(dtype=float)
+    liquid = volume > volume.mean() * LIQUIDITY_VOLUME_MULTIPLIER
+    reversal = ((types == 'Resistance') & (close < open_)) | ((types == 'Support') & (close > open_))
+
+    # Group rows by cluster id, keeping their original order inside each cluster
+    rows = in_cluster[np.argsort(labels[in_cluster], kind='stable')]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(labels[rows])) + 1))
+    counts = np.diff(np.append(starts, len(rows)))
+    cluster_prices = prices[rows]
+    strength = pivots_df['Strength'].to_numpy(dtype=float)[rows]
+    weights = np.maximum(strength, 1e-9)
+    keep = (np.add.reduceat(liquid[rows].astype(np.int64), starts) > 0) & \
+           (np.add.reduceat(reversal[rows].astype(np.int64), starts) > 0)
+    price_start = np.minimum.reduceat(cluster_prices, starts)
+    price_end = np.maximum.reduceat(cluster_prices, starts)
+    center = np.add.reduceat(cluster_prices * weights, starts) / np.add.reduceat(weights, starts)
+    strength_score = np.add.reduceat(strength, starts)
 
-        weighted_avg_price = float(np.average(cdf['Price'], weights=np.maximum(cdf['Strength'], 1e-9)))
+    clusters = []
+    for k in np.flatnonzero(keep):
         clusters.append({
-            'Type': cdf['Type'].iloc[0],
-            'Price Start': float(cdf['Price'].min()),
-            'Price End': float(cdf['Price'].max()),
-            'Center Price': float(round(weighted_avg_price, 2)),
-            'Strength Score': float(cdf['Strength'].sum()),
-            'Pivot Count': int(len(cdf))
+            'Type': types[rows[starts[k]]],
+            'Price Start': float(price_start[k]),
+            'Price End': float(price_end[k]),
+            'Center Price': float(round(center[k], 2)),
+            'Strength Score': float(strength_score[k]),
+            'Pivot Count': int(counts[k])
         })
     return clusters
 
 
-def run_analysis_for_lookback(symbol, days):
-    df_for_atr = fetch_ohlcv_paginated(symbol, '1h', lookback_days=days)
+def run_analysis_for_lookback(symbol, days, frames=None):
+    if frames is not None:
+        df_for_atr = slice_lookback(frames, ATR_TIMEFRAME, days)
+    else:
+        df_for_atr = fetch_ohlcv_paginated(symbol, ATR_TIMEFRAME, lookback_days=days)
     if df_for_atr is None or df_for_atr.empty:
         logging.warning(f'No ATR data for {symbol} lookback {days}d')
         return None
@@ -279,7 +477,10 @@ def run_analysis_for_lookback(symbol, days):
 
     all_pivots = []
     for tf in TIMEFRAMES_TO_ANALYZE:
-        pivots = generate_pivots_for_timeframe(symbol, tf, days, atr_percent)
+        tf_df = slice_lookback(frames, tf, days) if frames is not None else None
+        if frames is not None and tf_df is None:
+            continue
+        pivots = generate_pivots_for_timeframe(symbol, tf, days, atr_percent, df=tf_df)
         if not pivots.empty:
             max_s = pivots['Strength'].max()
             if max_s and max_s > 0:
@@ -315,21 +516,29 @@ def main():
     # --- Part 1: S/R Level Analysis ---
     logging.info("===== STARTING ADAPTIVE S/R ANALYSIS =====")
     results = {}
+    frames_by_symbol = {}
+    for symbol in SYMBOLS:
+        logging.info(f"--- Loading S/R data for {get_safe_symbol(symbol)} ---")
+        with span('fetch.frames', symbol=symbol) as frames_span:
+            frames_by_symbol[symbol] = fetch_lookback_frames(symbol, max(LOOKBACK_PERIODS_DAYS)) \
+                if FETCH_ONCE_SLICE_MANY else None
+            frames_span.count(rows=sum(map(len, (frames_by_symbol[symbol] or {}).values())))
+
+    logging.info(f"--- Analyzing S/R for {len(SYMBOLS)} symbols x {len(LOOKBACK_PERIODS_DAYS)} lookbacks ---")
+    with span('compute.sr_jobs', jobs=len(SYMBOLS) * len(LOOKBACK_PERIODS_DAYS)):
+        job_results = run_sr_jobs(frames_by_symbol, LOOKBACK_PERIODS_DAYS)
     for symbol in SYMBOLS:
         safe_symbol = get_safe_symbol(symbol)
-        logging.info(f"--- Analyzing S/R for {safe_symbol} ---")
         for days in LOOKBACK_PERIODS_DAYS:
-            logging.info(f"  ... using {days}d lookback period.")
-            res = run_analysis_for_lookback(symbol, days)
+            res = job_results.get((symbol, days))
             if res:
                 if safe_symbol not in results:
                     results[safe_symbol] = {}
                 results[safe_symbol][f'{days}d'] = res
-            time.sleep(1) # Be nice to the API
 
     try:
-        sr_payload = {'data': results, 'last_updated': datetime.now(timezone.utc).isoformat()}
-        with open(SR_OUTPUT_FILENAME, 'w') as f:
+        sr_payload = {'data': results, 'last_updated': utc_now().isoformat()}
+        with span('write.json', file=SR_OUTPUT_FILENAME), open(SR_OUTPUT_FILENAME, 'w') as f:
             json.dump(sr_payload, f, indent=4)
         logging.info(f"S/R analysis complete. Saved to {SR_OUTPUT_FILENAME}")
     except IOError as e:
@@ -337,15 +546,16 @@ def main():
 
     # --- Part 2: Market Opens Analysis ---
     logging.info("===== STARTING MARKET OPENS ANALYSIS =====")
-    market_opens_data = get_market_opens(SYMBOLS)
+    with span('fetch.market_opens'):
+        market_opens_data = get_market_opens(SYMBOLS)
     
     if market_opens_data:
         try:
             opens_payload = {
-                'last_updated': datetime.now(timezone.utc).isoformat(),
+                'last_updated': utc_now().isoformat(),
                 'opens': market_opens_data
             }
-            with open(OPENS_OUTPUT_FILENAME, 'w') as f:
+            with span('write.json', file=OPENS_OUTPUT_FILENAME), open(OPENS_OUTPUT_FILENAME, 'w') as f:
                 json.dump(opens_payload, f, indent=4)
             logging.info(f"Market opens data saved to {OPENS_OUTPUT_FILENAME}")
         except IOError as e:
@@ -359,7 +569,8 @@ def main():
     # This line explicitly closes all connections in the session pool,
     # allowing the Python process to terminate cleanly and immediately.
     logging.info("Closing network session...")
-    SESSION.close()
+    STORE.close()
+    write_run_metrics('sr_levels_analysis')
 
 
 if __name__ == "__main__":
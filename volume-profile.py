@@ -2,13 +2,17 @@
 
 import pandas as pd
 import numpy as np
-import requests
 import json
-from datetime import datetime, timezone
+import os
+import glob
+import argparse
 import re
-import time
 import logging
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Tuple
+
+from kline_store import KlineStore, interval_to_offset
+from clock import utc_now
+from run_metrics import span, write_run_metrics
 
 # --- Configuration ---
 SYMBOLS = ['BTCUSDT', 'ETHUSDT']
@@ -25,17 +29,33 @@ VALUE_AREA_PERCENT = 0.70
 HVN_THRESHOLD_MULTIPLIER = 1.5
 LVN_THRESHOLD_MULTIPLIER = 0.5
 
-API_ENDPOINT = "https://api.binance.com/api/v3/klines"
+# Bin resolution of the master grid: 'fixed' uses NUM_BINS, 'atr' sizes bins to a fraction of the
+# median ATR, 'tick' uses the finest multiple of the exchange tick size within MAX_NUM_BINS
+BIN_RESOLUTION_MODE = 'fixed'
+ATR_PERIOD = 14
+ATR_BIN_FRACTION = 0.25
+TICK_SIZES = {'BTCUSDT': 0.01, 'ETHUSDT': 0.01}
+MIN_NUM_BINS = 50
+MAX_NUM_BINS = 5000
+
+# Incremental profile state (see `advance_profile_state`)
+INCREMENTAL_PROFILE_STATE = True
+PROFILE_STATE_DIR = "volume_profile_state"
+PROFILE_STATE_MAX_AGE_HOURS = 24
+PROFILE_STATE_HISTORY_PAD_DAYS = 2
+
+# Optional high-resolution mode for short lookbacks (see `build_high_res_profile`)
+HIGH_RES_MODE = False
+HIGH_RES_LOOKBACK_DAYS = [7, 3, 2]
+HIGH_RES_TIMEFRAME = '5m'
+AGG_TRADES_DIR = "agg_trades"
+AGG_TRADES_CHUNK_ROWS = 1_000_000
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s',
                     datefmt='%Y-%m-%d %H:%M:%S')
 
-SESSION = requests.Session()
-SESSION.headers.update({
-    'User-Agent': 'My Volume Profile Bot'
-})
-DEFAULT_TIMEOUT = 20
+STORE = KlineStore()
 
 
 def get_safe_symbol(symbol: str) -> str:
@@ -54,72 +74,22 @@ def get_minutes_from_timeframe(tf_string: str) -> int:
 
 def fetch_ohlcv_for_profile(symbol: str, interval: str, lookback_days: int, limit: int = 1000) -> Optional[
     pd.DataFrame]:
-    """Fetches all necessary OHLCV data for a given lookback period."""
-    all_data = []
-    df = pd.DataFrame()
+    """Returns all OHLCV data for a given lookback period from the shared kline store."""
     try:
         minutes_per_tf = get_minutes_from_timeframe(interval)
         # Calculate how many candles cover the lookback period
         total_candles_needed = (lookback_days * 1440) // minutes_per_tf
-        end_time_ms = None
 
         logging.info(f"    Target: {total_candles_needed} candles (~{lookback_days} days)")
 
-        while len(all_data) < total_candles_needed:
-            url = f'{API_ENDPOINT}?symbol={symbol}&interval={interval}&limit={limit}'
-            if end_time_ms:
-                url += f'&endTime={end_time_ms}'
-
-            try:
-                r = SESSION.get(url, timeout=DEFAULT_TIMEOUT)
-                r.raise_for_status()
-                data_chunk = r.json()
-            except Exception as req_err:
-                logging.warning(f"    API Request failed, retrying... {req_err}")
-                time.sleep(2)
-                continue
-
-            if not data_chunk:
-                break
-
-            all_data = data_chunk + all_data
-            end_time_ms = data_chunk[0][0] - 1
-            
-            # Progress log for long downloads
-            if len(all_data) % 5000 == 0:
-                logging.info(f"    Downloaded {len(all_data)} / {total_candles_needed} candles...")
-
-            if len(data_chunk) < limit:
-                # Reached the beginning of the coin listing
-                break
-            
-            # Small sleep to avoid hitting API rate limits too hard
-            time.sleep(0.15)
-
-        if not all_data:
+        df = STORE.get_frame(symbol, interval, last_n=int(total_candles_needed),
+                             columns=['open', 'high', 'low', 'close', 'quote_volume'])
+        if df.empty:
             return None
 
-        df = pd.DataFrame(all_data, columns=[
-            'Open time', 'Open', 'High', 'Low', 'Close', 'Volume', 'Close time',
-            'Quote asset volume', 'Number of trades', 'Taker buy base asset volume',
-            'Taker buy quote asset volume', 'Ignore'
-        ])
-        
-        # Trim excess candles if we fetched slightly more than needed
-        df = df.tail(int(total_candles_needed))
-
-        df['Date'] = pd.to_datetime(df['Open time'], unit='ms', utc=True)
-        df.set_index('Date', inplace=True)
-
-        # Convert columns to numeric, including Quote asset volume
-        for col in ['Open', 'High', 'Low', 'Close', 'Volume', 'Quote asset volume']:
-            df[col] = pd.to_numeric(df[col], errors='coerce')
-        
-        df.dropna(inplace=True)
-
         # --- KEY CHANGE: Use Quote Asset Volume (USDT) instead of Base Asset Volume ---
         # This provides a more accurate profile based on money flow rather than coin count.
-        df['Volume'] = df['Quote asset volume']
+        df = df.rename(columns={'quote_volume': 'Volume'}).rename(columns=str.capitalize)
 
         return df[['Open', 'High', 'Low', 'Close', 'Volume']]
 
@@ -128,94 +98,372 @@ def fetch_ohlcv_for_profile(symbol: str, interval: str, lookback_days: int, limi
         return None
 
 
+def expand_candles_to_bins(low: np.ndarray, high: np.ndarray, volume: np.ndarray, min_price: float,
+                           bin_size: float, num_bins: int):
+    """Flat (bin index, volume share) arrays, in candle order, for every bin each candle's range touches."""
+    start_bin = np.maximum(0, (low - min_price) // bin_size).astype(np.int64)
+    end_bin = np.minimum(num_bins - 1, (high - min_price) // bin_size).astype(np.int64)
+    spans = end_bin - start_bin + 1
+    valid = spans > 0
+    start_bin, spans = start_bin[valid], spans[valid]
+
+    share = volume[valid] / spans
+    offsets = np.arange(int(spans.sum())) - np.repeat(np.cumsum(spans) - spans, spans)
+    return np.repeat(start_bin, spans) + offsets, np.repeat(share, spans)
+
+
+def accumulate_volume_by_bin(low: np.ndarray, high: np.ndarray, volume: np.ndarray, min_price: float,
+                             bin_size: float, num_bins: int) -> np.ndarray:
+    """
+    Spreads each candle's volume evenly over the price bins its Low-High range touches.
+
+    Every (candle, bin) pair is expanded into flat index/weight arrays in candle order and
+    summed with `np.bincount`, which adds sequentially. Each bin therefore receives exactly
+    the same additions in the same order as a per-candle loop would make, so the result is
+    bit-identical to it.
+    """
+    bin_idx, weights = expand_candles_to_bins(low, high, volume, min_price, bin_size, num_bins)
+    return np.bincount(bin_idx, weights=weights, minlength=num_bins).astype(float)
+
+
+def get_lookback_start(index: pd.DatetimeIndex, days: int, newest_time: Optional[pd.Timestamp] = None) -> int:
+    """Position of the first candle in the `days` window ending at `newest_time` (default: the newest candle)."""
+    newest_time = index[-1] if newest_time is None else newest_time
+    return int(index.searchsorted(newest_time - pd.Timedelta(days=days), side='right'))
+
+
+def bin_candles(df: pd.DataFrame, price_bins: np.ndarray):
+    """(volume, candle count) per bin for the candles in `df`."""
+    num_bins = len(price_bins) - 1
+    bin_idx, weights = expand_candles_to_bins(df['Low'].to_numpy(dtype=float), df['High'].to_numpy(dtype=float),
+                                              df['Volume'].to_numpy(dtype=float), price_bins[0],
+                                              price_bins[1] - price_bins[0], num_bins)
+    return (np.bincount(bin_idx, weights=weights, minlength=num_bins).astype(float),
+            np.bincount(bin_idx, minlength=num_bins))
+
+
+def accumulate_nested_profiles(df: pd.DataFrame, price_bins: np.ndarray, lookbacks_days: List[int],
+                               newest_time: Optional[pd.Timestamp] = None) -> Dict[int, Tuple[np.ndarray, np.ndarray]]:
+    """
+    (volume, candle count) per bin for several lookbacks that all end at `newest_time`.
+
+    The lookbacks are nested suffixes of `df`, so each candle is binned once: the segment
+    between two consecutive lookback starts is accumulated and added onto the profile of the
+    next shorter lookback.
+    """
+    num_bins = len(price_bins) - 1
+    profiles = {}
+    volume, counts = np.zeros(num_bins), np.zeros(num_bins, dtype=np.int64)
+    segment_end = len(df)
+    for days in sorted(lookbacks_days):
+        start = get_lookback_start(df.index, days, newest_time) if len(df) else 0
+        if start < segment_end:
+            segment_volume, segment_counts = bin_candles(df.iloc[start:segment_end], price_bins)
+            volume, counts = volume + segment_volume, counts + segment_counts
+            segment_end = start
+        profiles[days] = (volume, counts)
+    return profiles
+
+
 def calculate_volume_profile(df: pd.DataFrame, price_bins: np.ndarray) -> Optional[Dict]:
     """
     Calculates an accurate Volume Profile using a pre-defined set of price bins.
     """
     if df is None or df.empty:
         return None
-
-    # Get the overall range and bin size from the master bins
-    min_price = price_bins[0]
-    num_bins = len(price_bins) - 1
-    bin_size = price_bins[1] - price_bins[0]
-    
-    if bin_size <= 0:
+    if price_bins[1] - price_bins[0] <= 0:
         logging.error("Bin size is zero or negative. Cannot process profile.")
         return None
 
-    # Initialize a Series to hold the volume for each master price bin
-    profile = pd.Series(index=price_bins[:-1], data=np.zeros(num_bins), dtype=float)
+    # Distribute every candle's volume evenly over the bins between its Low and High in one pass
+    volume_per_bin = accumulate_volume_by_bin(df['Low'].to_numpy(dtype=float), df['High'].to_numpy(dtype=float),
+                                              df['Volume'].to_numpy(dtype=float), price_bins[0],
+                                              price_bins[1] - price_bins[0], len(price_bins) - 1)
+    return summarize_volume_profile(volume_per_bin, price_bins)
 
-    # ACCURATE VOLUME DISTRIBUTION
-    # This iterates over every candle. For 3 years of data (26k rows), this might take 1-2 seconds.
-    for _, row in df.iterrows():
-        low_price, high_price, volume = row['Low'], row['High'], row['Volume']
-        
-        start_bin_idx = int(max(0, (low_price - min_price) // bin_size))
-        end_bin_idx = int(min(num_bins - 1, (high_price - min_price) // bin_size))
-        
-        num_bins_spanned = (end_bin_idx - start_bin_idx) + 1
-        
-        if num_bins_spanned > 0:
-            volume_per_bin = volume / num_bins_spanned
-            # Vectorized addition for speed
-            if start_bin_idx == end_bin_idx:
-                 profile.iloc[start_bin_idx] += volume
-            else:
-                profile.iloc[start_bin_idx : end_bin_idx + 1] += volume_per_bin
-    
-    volume_by_price = profile[profile > 0]
 
-    if volume_by_price.empty:
+def expand_value_area(volumes: np.ndarray, poc_index: int, target_volume: float) -> Tuple[int, int]:
+    """
+    Grows the value area from the POC, always taking the larger neighbouring bin (the lower one on
+    ties), until it holds `target_volume`. Returns the inclusive (low, high) bin indices.
+
+    Taking the larger head of two sequences first visits them in the same order as merging their
+    running minimums, so the walk order comes from two searchsorted calls instead of a Python loop.
+    """
+    va_volume = volumes[poc_index]
+    below = volumes[poc_index - 1::-1] if poc_index > 0 else volumes[:0]
+    above = volumes[poc_index + 1:]
+    below_keys = np.minimum.accumulate(below) if below.size else below
+    above_keys = np.minimum.accumulate(above) if above.size else above
+    # Merged position of every bin: own rank plus the bins of the other side taken before it
+    below_pos = np.arange(below.size) + np.searchsorted(-above_keys, -below_keys, side='left')
+    above_pos = np.arange(above.size) + np.searchsorted(-below_keys, -above_keys, side='right')
+    walk = np.empty(below.size + above.size)
+    walk[below_pos] = below
+    walk[above_pos] = above
+    # Running total in walk order, summed sequentially like the bin-by-bin expansion
+    running = np.cumsum(np.concatenate(([va_volume], walk)))
+    steps = int(np.argmax(running >= target_volume)) if running[-1] >= target_volume else walk.size
+    taken_below = int(np.count_nonzero(below_pos < steps))
+    return poc_index - taken_below, poc_index + steps - taken_below
+
+
+def summarize_volume_profile(volume_per_bin: np.ndarray, price_bins: np.ndarray) -> Optional[Dict]:
+    """POC, value area, HVN/LVN and the non-empty bins of an accumulated profile."""
+    bin_size = price_bins[1] - price_bins[0]
+    non_empty = volume_per_bin > 0
+    if not non_empty.any():
         return None
+    prices = price_bins[:-1][non_empty]
+    volumes = np.asarray(volume_per_bin, dtype=float)[non_empty]
 
     # Calculate Key Metrics
-    total_volume = volume_by_price.sum()
-    poc_price = volume_by_price.idxmax()
-    poc_volume = volume_by_price.max()
-
-    target_va_volume = total_volume * VALUE_AREA_PERCENT
-    poc_index = volume_by_price.index.get_loc(poc_price)
-    va_volume = poc_volume
-    va_low_idx, va_high_idx = poc_index, poc_index
+    total_volume = volumes.sum()
+    poc_index = int(np.argmax(volumes))
 
     # Value Area Calculation
-    while va_volume < target_va_volume and (va_low_idx > 0 or va_high_idx < len(volume_by_price) - 1):
-        next_low_idx = va_low_idx - 1
-        next_high_idx = va_high_idx + 1
-        vol_low = volume_by_price.iloc[next_low_idx] if next_low_idx >= 0 else -1
-        vol_high = volume_by_price.iloc[next_high_idx] if next_high_idx < len(volume_by_price) else -1
-        if vol_low == -1 and vol_high == -1: break
-        if vol_high > vol_low:
-            va_volume += vol_high
-            va_high_idx = next_high_idx
-        else:
-            va_volume += vol_low
-            va_low_idx = next_low_idx
+    va_low_idx, va_high_idx = expand_value_area(volumes, poc_index, total_volume * VALUE_AREA_PERCENT)
+    value_area_low = prices[va_low_idx]
+    value_area_high = prices[va_high_idx] + bin_size
 
-    value_area_low = volume_by_price.index[va_low_idx]
-    value_area_high = volume_by_price.index[va_high_idx] + bin_size
+    avg_bin_volume = volumes.mean()
+    hvn_idx = np.flatnonzero(volumes > avg_bin_volume * HVN_THRESHOLD_MULTIPLIER)
+    lvn_idx = np.flatnonzero(volumes < avg_bin_volume * LVN_THRESHOLD_MULTIPLIER)
+    hvn_idx = hvn_idx[np.argsort(-volumes[hvn_idx], kind='stable')]
+    lvn_idx = lvn_idx[np.argsort(volumes[lvn_idx], kind='stable')]
 
-    avg_bin_volume = volume_by_price.mean()
-    hvn_threshold = avg_bin_volume * HVN_THRESHOLD_MULTIPLIER
-    lvn_threshold = avg_bin_volume * LVN_THRESHOLD_MULTIPLIER
-    hvns = volume_by_price[volume_by_price > hvn_threshold]
-    lvns = volume_by_price[volume_by_price < lvn_threshold]
-    hvn_list = [{'price_level': float(p), 'volume': float(v)} for p, v in hvns.items()]
-    lvn_list = [{'price_level': float(p), 'volume': float(v)} for p, v in lvns.items()]
+    def as_nodes(idx: np.ndarray) -> List[Dict]:
+        return [{'price_level': p, 'volume': v} for p, v in zip(prices[idx].tolist(), volumes[idx].tolist())]
 
     return {
-        "point_of_control": float(poc_price),
+        "point_of_control": float(prices[poc_index]),
         "value_area_low": float(value_area_low),
         "value_area_high": float(value_area_high),
-        "high_volume_nodes": sorted(hvn_list, key=lambda x: x['volume'], reverse=True),
-        "low_volume_nodes": sorted(lvn_list, key=lambda x: x['volume']),
-        "full_profile": [{'price_level': float(p), 'volume': float(v)} for p, v in volume_by_price.items()]
+        "high_volume_nodes": as_nodes(hvn_idx),
+        "low_volume_nodes": as_nodes(lvn_idx),
+        "full_profile": as_nodes(np.arange(volumes.size))
     }
 
 
+# --- High-resolution mode for short lookbacks ---
+# Spreading a wide 1h candle evenly between its Low and High smears short profiles. In this mode
+# the short lookbacks are rebuilt from lower-timeframe klines, or from local aggregated-trade
+# dumps (data.binance.vision `<SYMBOL>-aggTrades-<date>.csv`) for the part of the window they
+# cover. Trades are streamed in chunks and binned with one bincount per chunk.
+
+def accumulate_trades_by_bin(prices: np.ndarray, quote_volume: np.ndarray, min_price: float, bin_size: float,
+                             num_bins: int) -> np.ndarray:
+    """Adds each trade's quote volume to the bin holding its price (clamped to the grid like candle ranges)."""
+    bin_idx = np.clip((prices - min_price) // bin_size, 0, num_bins - 1).astype(np.int64)
+    return np.bincount(bin_idx, weights=quote_volume, minlength=num_bins).astype(float)
+
+
+def _agg_trade_files(symbol: str) -> List[str]:
+    return sorted(glob.glob(os.path.join(AGG_TRADES_DIR, f"{symbol}-aggTrades-*.csv")))
+
+
+def _to_ms(timestamps: np.ndarray) -> np.ndarray:
+    # Spot dumps switched from millisecond to microsecond timestamps in 2025
+    return np.where(timestamps > 1e14, timestamps // 1000, timestamps)
+
+
+def _read_agg_trade_row_time(path: str, last: bool) -> Optional[int]:
+    """Time (ms) of the first or last trade in a dump without reading the whole file."""
+    try:
+        with open(path, 'rb') as f:
+            if last:
+                f.seek(0, os.SEEK_END)
+                f.seek(max(0, f.tell() - 4096))
+            lines = [line for line in f.read(4096).splitlines() if line.strip()]
+        for line in (reversed(lines) if last else lines):
+            fields = line.split(b',')
+            if len(fields) > 5 and fields[5].strip().isdigit():
+                return int(_to_ms(np.array([int(fields[5])]))[0])
+    except OSError as e:
+        logging.warning(f"  Could not read {path}: {e}")
+    return None
+
+
+def iter_agg_trade_chunks(symbol: str, start_ms: int, end_ms: int, chunksize: int = AGG_TRADES_CHUNK_ROWS):
+    """Streams (price, quote volume) arrays for trades in [start_ms, end_ms) from the local dumps."""
+    for path in _agg_trade_files(symbol):
+        for chunk in pd.read_csv(path, header=None, usecols=[1, 2, 5], chunksize=chunksize):
+            chunk.columns = ['price', 'quantity', 'time']
+            # Coercion also drops the header row some dumps carry
+            chunk = chunk.apply(pd.to_numeric, errors='coerce').dropna()
+            times = _to_ms(chunk['time'].to_numpy(dtype=np.int64))
+            keep = (times >= start_ms) & (times < end_ms)
+            prices = chunk['price'].to_numpy(dtype=float)[keep]
+            yield prices, prices * chunk['quantity'].to_numpy(dtype=float)[keep]
+
+
+def build_high_res_profile(symbol: str, window_start: pd.Timestamp, price_bins: np.ndarray) -> Tuple[
+    Optional[np.ndarray], str]:
+    """
+    Volume-by-bin for candles opening at or after `window_start`, from aggregated trades where
+    the local dumps cover the window and HIGH_RES_TIMEFRAME klines for the rest.
+    """
+    min_price, num_bins, bin_size = price_bins[0], len(price_bins) - 1, price_bins[1] - price_bins[0]
+    volume = np.zeros(num_bins)
+    start_ms = int(window_start.value // 10**6)
+    klines_from = window_start
+    source = HIGH_RES_TIMEFRAME
+
+    files = _agg_trade_files(symbol)
+    first_ms = _read_agg_trade_row_time(files[0], last=False) if files else None
+    last_ms = _read_agg_trade_row_time(files[-1], last=True) if files else None
+    if first_ms is not None and last_ms is not None and first_ms <= start_ms < last_ms:
+        # Trades up to the last complete kline boundary they cover; klines take over from there
+        step_ms = get_minutes_from_timeframe(HIGH_RES_TIMEFRAME) * 60000
+        cutoff_ms = last_ms // step_ms * step_ms
+        for prices, quote_volume in iter_agg_trade_chunks(symbol, start_ms, cutoff_ms):
+            volume += accumulate_trades_by_bin(prices, quote_volume, min_price, bin_size, num_bins)
+        klines_from = pd.Timestamp(cutoff_ms, unit='ms', tz='UTC')
+        source = f"aggTrades+{HIGH_RES_TIMEFRAME}"
+
+    lookback_days = int(np.ceil((pd.Timestamp(utc_now()) - klines_from) / pd.Timedelta(days=1))) + 1
+    df = STORE.get_frame(symbol, HIGH_RES_TIMEFRAME, lookback_days=lookback_days,
+                         columns=['low', 'high', 'quote_volume'])
+    df = df[df.index >= klines_from]
+    if not df.empty:
+        volume += accumulate_volume_by_bin(df['low'].to_numpy(dtype=float), df['high'].to_numpy(dtype=float),
+                                           df['quote_volume'].to_numpy(dtype=float), min_price, bin_size, num_bins)
+    return (volume if volume.any() else None), source
+
+
+# --- Persistent per-lookback profile state ---
+# The state holds, per lookback, the volume and candle count of every bin over the CLOSED
+# candles in its window. A run adds newly closed candles, subtracts the ones that rolled out of
+# each window and adds the still-forming candle transiently. The grid is rebuilt only when
+# price leaves it, the configuration changes, or the state is older than the max age.
+
+def create_price_grid(symbol: str, df: pd.DataFrame) -> np.ndarray:
+    """Master bin edges spanning the full price range, with the bin width set by BIN_RESOLUTION_MODE."""
+    min_price, max_price = df['Low'].min(), df['High'].max()
+    price_range = max_price - min_price
+    if BIN_RESOLUTION_MODE == 'tick' and symbol in TICK_SIZES:
+        tick = TICK_SIZES[symbol]
+        bin_size = tick * max(1, int(np.ceil(price_range / (tick * MAX_NUM_BINS))))
+        grid_min = np.floor(min_price / tick) * tick
+        num_bins = max(1, int(np.ceil((max_price - grid_min) / bin_size)))
+        return grid_min + np.arange(num_bins + 1) * bin_size
+    num_bins = NUM_BINS
+    if BIN_RESOLUTION_MODE == 'atr':
+        prev_close = df['Close'].shift()
+        true_range = np.maximum(df['High'], prev_close.fillna(df['High'])) - np.minimum(df['Low'],
+                                                                                     prev_close.fillna(df['Low']))
+        median_atr = true_range.rolling(ATR_PERIOD).mean().median()
+        if median_atr > 0:
+            num_bins = int(np.clip(np.ceil(price_range / (median_atr * ATR_BIN_FRACTION)), MIN_NUM_BINS, MAX_NUM_BINS))
+    return np.linspace(min_price, max_price, num_bins + 1)
+
+
+def split_forming_candle(df: pd.DataFrame, interval: str):
+    """(closed candles, still-forming candle or empty frame)."""
+    if not df.empty and df.index[-1] + interval_to_offset(interval) > pd.Timestamp(utc_now()):
+        return df.iloc[:-1], df.iloc[-1:]
+    return df, df.iloc[:0]
+
+
+def build_profile_state(closed_df: pd.DataFrame, price_bins: np.ndarray, lookbacks_days: List[int],
+                        newest_time: pd.Timestamp) -> Dict[str, np.ndarray]:
+    lookbacks = np.array(sorted(lookbacks_days), dtype=np.int64)
+    thresholds = np.array([(newest_time - pd.Timedelta(days=int(d))).value for d in lookbacks], dtype=np.int64)
+    nested = accumulate_nested_profiles(closed_df, price_bins, list(lookbacks), newest_time)
+    profiles = np.array([nested[int(d)][0] for d in lookbacks])
+    counts = np.array([nested[int(d)][1] for d in lookbacks])
+    times = closed_df.index.asi8
+    return {
+        'bins': price_bins, 'lookbacks': lookbacks, 'thresholds': thresholds,
+        'last_closed': np.int64(times[-1] if len(times) else np.iinfo(np.int64).min),
+        'bin_mode': np.str_(BIN_RESOLUTION_MODE),
+        'built_at': np.int64(pd.Timestamp(utc_now()).value), 'profiles': profiles, 'counts': counts,
+    }
+
+
+def advance_profile_state(state: Dict[str, np.ndarray], history_df: pd.DataFrame, closed_df: pd.DataFrame,
+                          forming_df: pd.DataFrame, lookbacks_days: List[int], newest_time: pd.Timestamp) -> bool:
+    """
+    Applies candles closed since the state was saved and rolls every window forward in place.
+    Returns False when the state cannot be advanced and has to be rebuilt.
+    """
+    bins = state['bins']
+    bin_mode = str(state.get('bin_mode', 'fixed'))
+    if bin_mode != BIN_RESOLUTION_MODE or (bin_mode == 'fixed' and len(bins) != NUM_BINS + 1):
+        return False
+    if list(state['lookbacks']) != sorted(lookbacks_days) or closed_df.empty:
+        return False
+    if pd.Timestamp(utc_now()).value - int(state['built_at']) > PROFILE_STATE_MAX_AGE_HOURS * 3600 * 10**9:
+        return False
+    new_candles = closed_df[closed_df.index.asi8 > state['last_closed']]
+    outside = pd.concat([new_candles, forming_df])
+    if not outside.empty and (outside['Low'].min() < bins[0] or outside['High'].max() > bins[-1]):
+        logging.info("  Price left the master grid; rebuilding profile state.")
+        return False
+    new_thresholds = np.array([(newest_time - pd.Timedelta(days=int(d))).value for d in state['lookbacks']],
+                              dtype=np.int64)
+    # Roll-outs need the candles that were in the oldest window; they must still be in history
+    if history_df.empty or history_df.index.asi8[0] > state['thresholds'].min():
+        return False
+
+    history_times = history_df.index.asi8
+    new_times = new_candles.index.asi8
+    for i, (old_thr, new_thr) in enumerate(zip(state['thresholds'], new_thresholds)):
+        added = new_candles[new_times > new_thr]
+        if not added.empty:
+            volume, count = bin_candles(added, bins)
+            state['profiles'][i] += volume
+            state['counts'][i] += count
+        dropped = history_df[(history_times > old_thr) & (history_times <= min(new_thr, state['last_closed']))]
+        if not dropped.empty:
+            volume, count = bin_candles(dropped, bins)
+            state['profiles'][i] -= volume
+            state['counts'][i] -= count
+    # Empty bins are reset exactly so subtraction residue never shows up as a low-volume node
+    state['profiles'][state['counts'] == 0] = 0.0
+    state['thresholds'] = new_thresholds
+    state['last_closed'] = np.int64(closed_df.index.asi8[-1])
+    return True
+
+
+def profiles_from_state(state: Dict[str, np.ndarray], forming_df: pd.DataFrame) -> Dict[int, Optional[np.ndarray]]:
+    forming_volume, forming_count = (bin_candles(forming_df, state['bins']) if not forming_df.empty
+                                     else (0.0, 0))
+    profiles = {}
+    for i, days in enumerate(state['lookbacks']):
+        has_candles = state['counts'][i].sum() + np.sum(forming_count) > 0
+        profiles[int(days)] = state['profiles'][i] + forming_volume if has_candles else None
+    return profiles
+
+
+def load_profile_state(symbol: str) -> Optional[Dict[str, np.ndarray]]:
+    path = os.path.join(PROFILE_STATE_DIR, f"{symbol}_{TIMEFRAME_FOR_PROFILE}.npz")
+    if not os.path.exists(path):
+        return None
+    try:
+        with np.load(path) as data:
+            return {key: data[key] for key in data.files}
+    except (OSError, ValueError) as e:
+        logging.warning(f"  Discarding unreadable profile state {path}: {e}")
+        return None
+
+
+def save_profile_state(symbol: str, state: Dict[str, np.ndarray]):
+    os.makedirs(PROFILE_STATE_DIR, exist_ok=True)
+    path = os.path.join(PROFILE_STATE_DIR, f"{symbol}_{TIMEFRAME_FOR_PROFILE}.npz")
+    try:
+        np.savez_compressed(path, **state)
+    except OSError as e:
+        logging.error(f"  Could not write profile state {path}: {e}")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Volume profiles for several lookbacks on a shared price grid.")
+    parser.add_argument('--high-res', action='store_true', default=HIGH_RES_MODE,
+                        help=f"Build the {HIGH_RES_LOOKBACK_DAYS}d profiles from {HIGH_RES_TIMEFRAME} klines "
+                             f"or local aggTrades dumps in '{AGG_TRADES_DIR}/'.")
+    args = parser.parse_args()
+
     logging.info("===== STARTING VOLUME PROFILE ANALYSIS =====")
     results = {}
     
@@ -231,21 +479,50 @@ def main():
         longest_lookback = sorted_lookbacks[0]
         logging.info(f"  Fetching full {longest_lookback}d dataset (approx 3 Years)...")
         
-        full_df = fetch_ohlcv_for_profile(symbol, TIMEFRAME_FOR_PROFILE, lookback_days=longest_lookback)
+        # A few extra days so candles that rolled out of the windows since the last run can be subtracted
+        with span('fetch.frame', symbol=symbol, interval=TIMEFRAME_FOR_PROFILE) as frame_span:
+            history_df = fetch_ohlcv_for_profile(symbol, TIMEFRAME_FOR_PROFILE,
+                                                 lookback_days=longest_lookback + PROFILE_STATE_HISTORY_PAD_DAYS)
+            frame_span.count(rows=len(history_df) if history_df is not None else 0)
         
-        if full_df is None or full_df.empty:
+        if history_df is None or history_df.empty:
             logging.warning(f"  Could not fetch base data for {symbol}. Skipping symbol.")
             continue
-            
-        # 2. Create the MASTER price bins from the full range
-        overall_min_price = full_df['Low'].min()
-        overall_max_price = full_df['High'].max()
-        
-        # Increased bins dynamically based on range might be better, but fixed is fine for now
-        master_price_bins = np.linspace(overall_min_price, overall_max_price, NUM_BINS + 1)
-        logging.info(f"  Master grid created: ${overall_min_price:,.2f} to ${overall_max_price:,.2f}")
+        full_df = history_df.iloc[-(longest_lookback * 1440 // get_minutes_from_timeframe(TIMEFRAME_FOR_PROFILE)):]
+        closed_df, forming_df = split_forming_candle(full_df, TIMEFRAME_FOR_PROFILE)
+        newest_time = full_df.index[-1]
+
+        with span('read.profile_state', symbol=symbol):
+            state = load_profile_state(symbol) if INCREMENTAL_PROFILE_STATE else None
+        with span('compute.advance_profile_state', symbol=symbol):
+            advanced = state is not None and advance_profile_state(state, history_df, closed_df, forming_df,
+                                                                    sorted_lookbacks, newest_time)
+        if advanced:
+            logging.info(f"  Advanced stored profile state to {closed_df.index[-1]}.")
+        else:
+            # 2. Create the MASTER price bins from the full range
+            overall_min_price = full_df['Low'].min()
+            overall_max_price = full_df['High'].max()
+
+            master_price_bins = create_price_grid(symbol, full_df)
+            logging.info(f"  Master grid created: ${overall_min_price:,.2f} to ${overall_max_price:,.2f} "
+                         f"({len(master_price_bins) - 1} bins, {BIN_RESOLUTION_MODE})")
+
+            if master_price_bins[1] - master_price_bins[0] <= 0:
+                logging.error("Bin size is zero or negative. Cannot process profile.")
+                continue
+
+            # 3. Accumulate every lookback over the closed candles of the full dataset
+            with span('compute.build_profile_state', symbol=symbol) as build_span:
+                build_span.count(rows=len(closed_df))
+                state = build_profile_state(closed_df, master_price_bins, sorted_lookbacks, newest_time)
+
+        if INCREMENTAL_PROFILE_STATE:
+            with span('write.profile_state', symbol=symbol):
+                save_profile_state(symbol, state)
+        master_price_bins = state['bins']
+        profiles_by_days = profiles_from_state(state, forming_df)
 
-        # 3. Iterate through all lookbacks, using slices of the full dataset
         for days in sorted_lookbacks:
             label = f'{days}d'
             # Add friendly labels for years
@@ -254,38 +531,45 @@ def main():
             if days == 1095: label = '3y'
 
             logging.info(f"  ... processing {label} ({days} days)")
-            
-            # Slice the DataFrame to the desired lookback period
-            try:
-                # Use pandas' `last` method for time-based slicing
-                df_slice = full_df.last(f'{days}D')
-                if df_slice.empty:
-                    logging.warning(f"  Slice for {label} resulted in empty DataFrame. Skipping.")
-                    continue
-            except Exception as e:
-                logging.error(f"  Error slicing DataFrame for {label}: {e}")
+
+            volume_per_bin = profiles_by_days[days]
+            if volume_per_bin is None:
+                logging.warning(f"  Slice for {label} resulted in empty DataFrame. Skipping.")
                 continue
 
-            # Calculate profile using the slice but with the MASTER bins
-            profile_data = calculate_volume_profile(df_slice, master_price_bins)
+            source = None
+            if args.high_res and days in HIGH_RES_LOOKBACK_DAYS:
+                window_start = full_df.index[get_lookback_start(full_df.index, days)]
+                with span('compute.high_res_profile', symbol=symbol, lookback_days=days):
+                    high_res_volume, source = build_high_res_profile(symbol, window_start, master_price_bins)
+                if high_res_volume is not None:
+                    volume_per_bin = high_res_volume
+                else:
+                    logging.warning(f"  No {source} data for {label}; keeping the {TIMEFRAME_FOR_PROFILE} profile.")
+                    source = None
+
+            # Profile metrics on the MASTER bins
+            with span('compute.summarize_profile', symbol=symbol, lookback_days=days):
+                profile_data = summarize_volume_profile(volume_per_bin, master_price_bins)
+            if profile_data and source:
+                profile_data['source'] = source
             
             if profile_data:
                 results[safe_symbol][label] = profile_data
             else:
                 logging.warning(f"  Could not generate profile for {symbol} {label}.")
-        
-        time.sleep(1) # Be nice to the API between symbols
 
     try:
-        payload = {'data': results, 'last_updated': datetime.now(timezone.utc).isoformat()}
-        with open(OUTPUT_FILENAME, 'w') as f:
+        payload = {'data': results, 'last_updated': utc_now().isoformat()}
+        with span('write.json', file=OUTPUT_FILENAME), open(OUTPUT_FILENAME, 'w') as f:
             json.dump(payload, f, indent=4)
         logging.info(f"Volume profile analysis complete. Saved to {OUTPUT_FILENAME}")
     except IOError as e:
         logging.error(f"Could not write to file {OUTPUT_FILENAME}: {e}")
 
     logging.info("===== ALL ANALYSIS COMPLETE =====")
-    SESSION.close()
+    STORE.close()
+    write_run_metrics('volume-profile')
 
 
 if __name__ == "__main__":